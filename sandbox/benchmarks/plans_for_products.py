@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Compare the time taken to render a product listing's advertised financing plans with the per-product
+``get_plan_for_product`` tag and the batched ``get_plans_for_products`` tag.
+
+This is a benchmark rather than a test, since wall clock timings aren't reliable on a shared CI machine. It builds a
+throwaway test database, so run it from the sandbox directory with the sandbox's database available:
+
+    $ python benchmarks/plans_for_products.py --products 48 --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+
+TEMPLATES = (
+    ('single', '{% for product in products %}{% get_plan_for_product request product as plan %}{{ plan.pk }}{% endfor %}'),
+    ('batched', '{% get_plans_for_products request products as product_plans %}{% for product, plan in product_plans %}{{ plan.pk }}{% endfor %}'),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--products', type=int, default=48, help='Number of products on the listing page.')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of times to render each template.')
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    from decimal import Decimal
+    from django.contrib.auth.models import AnonymousUser
+    from django.db import connection
+    from django.template import Context, Template
+    from django.test import RequestFactory
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from oscar.core.loading import get_class
+    from oscar.test import factories
+    from wellsfargo.core.plans import catalog as plan_catalog
+    from wellsfargo.models import FinancingPlan
+
+    Selector = get_class('partner.strategy', 'Selector')
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        FinancingPlan.objects.create(plan_number=1001, term_months=12, product_price_threshold='100.00', advertising_enabled=True)
+        FinancingPlan.objects.create(plan_number=1002, term_months=24, product_price_threshold='1000.00', advertising_enabled=True)
+        ids = [factories.create_product(price=Decimal(50 * (i + 1))).pk for i in range(args.products)]
+        Product = factories.ProductFactory._meta.model
+        plan_catalog.get_plans()
+
+        for name, template in TEMPLATES:
+            template = Template('{% load wfrs_default_plan %}' + template)
+            timings = []
+            for i in range(args.repeat):
+                request = RequestFactory().get('/catalogue/')
+                request.user = AnonymousUser()
+                request.strategy = Selector().strategy(request)
+                products = list(Product.objects.filter(pk__in=ids))
+                start = time.perf_counter()
+                template.render(Context({'request': request, 'products': products}))
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print('{:>8}: median {:.2f}ms, min {:.2f}ms over {} renders of {} products'.format(
+                name, timings[len(timings) // 2] * 1000, timings[0] * 1000, args.repeat, args.products))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,12 @@ class TransferMetadataAdmin(ReadOnlyAdmin):
     list_filter = ['type_code', 'status']
 
 
+@admin.register(models.TransactionJournalEntry)
+class TransactionJournalEntryAdmin(ReadOnlyAdmin):
+    list_display = ['transaction_uuid', 'type_code', 'ticket_number', 'state', 'attempts', 'modified_datetime']
+    list_filter = ['type_code', 'state']
+
+
 @admin.register(models.USCreditApp)
 @admin.register(models.USJointCreditApp)
 @admin.register(models.CACreditApp)
@@ -82,3 +88,9 @@ class AccountInquiryResultAdmin(ReadOnlyAdmin):
         'created_datetime',
         'modified_datetime',
     )
+
+
+@admin.register(models.SearchIndexQueueEntry)
+class SearchIndexQueueEntryAdmin(ReadOnlyAdmin):
+    list_display = ['content_type', 'object_id', 'created_datetime']
+    list_filter = ['content_type']
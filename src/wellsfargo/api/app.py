@@ -9,6 +9,7 @@ from .views import (
     CAJointCreditAppView,
     FinancingPlanView,
     EstimatedPaymentView,
+    EstimatedPaymentsView,
     UpdateAccountInquiryView,
     SubmitAccountInquiryView,
     PreQualificationResumeView,
@@ -35,6 +36,7 @@ class WFRSAPIApplication(Application):
             url(r'^plans/$', FinancingPlanView.as_view(), name='wfrs-api-plan-list'),
 
             url(r'^estimated-payment/$', EstimatedPaymentView.as_view(), name='wfrs-api-estimated-payment'),
+            url(r'^estimated-payments/$', EstimatedPaymentsView.as_view(), name='wfrs-api-estimated-payments'),
 
             url(r'^inquiry/$', SubmitAccountInquiryView.as_view(), name='wfrs-api-acct-inquiry'),
 
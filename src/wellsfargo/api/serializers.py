@@ -169,6 +169,11 @@ class EstimatedPaymentSerializer(serializers.Serializer):
     loan_cost = serializers.DecimalField(decimal_places=2, max_digits=12)
 
 
+class EstimatedPaymentsSerializer(serializers.Serializer):
+    principal = serializers.DecimalField(decimal_places=2, max_digits=12)
+    estimates = EstimatedPaymentSerializer(many=True)
+
+
 class AccountInquirySerializer(serializers.ModelSerializer):
     account_number = serializers.RegexField('^[0-9]{16}$', max_length=16, min_length=16)
 
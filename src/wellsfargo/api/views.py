@@ -1,9 +1,12 @@
+from django.core.cache import cache
 from django.core.exceptions import ValidationError as DjangoValidationError
 from django.core import signing, exceptions
 from django.db import transaction
 from django.shortcuts import render, redirect
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
 from django.utils.http import is_safe_url
+from django.views.decorators.http import condition
 from rest_framework.response import Response
 from rest_framework.reverse import reverse_lazy
 from rest_framework import views, generics, status, serializers
@@ -28,6 +31,7 @@ from .serializers import (
     CAJointCreditAppSerializer,
     FinancingPlanSerializer,
     EstimatedPaymentSerializer,
+    EstimatedPaymentsSerializer,
     AccountInquirySerializer,
     PreQualificationRequestSerializer,
     PreQualificationResponseSerializer,
@@ -35,7 +39,16 @@ from .serializers import (
     PreQualificationSDKApplicationResultSerializer,
 )
 from .exceptions import CreditApplicationPending
-from ..utils import list_plans_for_basket, calculate_monthly_payments
+from ..core.plans import catalog as plan_catalog
+from ..settings import (
+    WFRS_ESTIMATED_PAYMENT_MAX_AGE,
+    WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT,
+)
+from ..utils import (
+    list_plans_for_basket,
+    get_payment_quote,
+    get_payment_quotes,
+)
 import decimal
 
 INQUIRY_SESSION_KEY = 'wfrs-acct-inquiry-id'
@@ -108,43 +121,142 @@ class FinancingPlanView(views.APIView):
         return Response(ser.data)
 
 
+def _parse_price(value):
+    """Parse a submitted price into a Decimal rounded to the cent, or return ``None`` if it isn't a positive number"""
+    try:
+        price = decimal.Decimal(value)
+        if not price.is_finite():
+            return None
+        price = price.quantize(decimal.Decimal('0.00'))
+    except decimal.InvalidOperation:
+        return None
+    if not price or price <= 0:
+        return None
+    return price
+
+
+def _get_estimated_payment_price(request):
+    return _parse_price(request.GET.get('price', ''))
+
+
+def _estimated_payment_etag(request):
+    price = _get_estimated_payment_price(request)
+    if price is None:
+        return None
+    return '{}:{}'.format(plan_catalog.digest, price)
+
+
 class EstimatedPaymentView(views.APIView):
+    """
+    Estimate the monthly payment for a price, using the best advertisable financing plan.
+
+    Responses only change when the financing plan table does, so they carry an ``ETag`` derived from a digest of the
+    plan data (the same in every worker process) and a public ``Cache-Control`` header (see ``WFRS_ESTIMATED_PAYMENT_MAX_AGE``), which
+    lets browsers and CDNs cache them. Computed responses are also kept in the Django cache, per price, for
+    ``WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT`` seconds.
+    """
+    CACHE_KEY = 'wfrs-estimated-payment:{digest}:{price}'
+
+    @method_decorator(condition(etag_func=_estimated_payment_etag))
     def get(self, request):
         # Validate the price input
-        try:
-            principal_price = request.GET.get('price', '')
-            principal_price = decimal.Decimal(principal_price)\
-                .quantize(decimal.Decimal('0.00'))
-        except decimal.InvalidOperation:
-            principal_price = decimal.Decimal('0.00')
-
-        if not principal_price or principal_price <= 0:
+        principal_price = _get_estimated_payment_price(request)
+        if principal_price is None:
             data = {
                 'price': 'Submitted price parameter was not valid.',
             }
             return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
+        cache_key = self.CACHE_KEY.format(digest=plan_catalog.digest, price=principal_price)
+        cached = cache.get(cache_key) if WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT else None
+        if cached is None:
+            cached = self._estimate_payment(principal_price)
+            if WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT:
+                cache.set(cache_key, cached, WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT)
+
+        status_code, data = cached
+        response = Response(data, status=status_code)
+        patch_cache_control(response, public=True, max_age=WFRS_ESTIMATED_PAYMENT_MAX_AGE)
+        return response
+
+
+    def _estimate_payment(self, principal_price):
+        """Return the ``(status code, data)`` of the response for the given price"""
         # Get the best matching Financing Plan object for the price
         plan = FinancingPlan.get_advertisable_plan_by_price(principal_price)
         if not plan:
-            return Response(status=status.HTTP_204_NO_CONTENT)
-
-        # Calculate the monthly payment
-        monthly_payment = calculate_monthly_payments(principal_price, plan.term_months, plan.apr)
+            return (status.HTTP_204_NO_CONTENT, None)
 
-        # Calculate the total loan cost
-        loan_cost = (monthly_payment * plan.term_months) - principal_price
-        loan_cost = max(decimal.Decimal('0.00'), loan_cost)
-        loan_cost = loan_cost.quantize(principal_price, rounding=decimal.ROUND_UP)
+        # Look up (or calculate) the monthly payment and total loan cost
+        quote = get_payment_quote(plan, principal_price)
 
         # Return the payment data
         ser = EstimatedPaymentSerializer(instance={
             'plan': plan,
             'principal': principal_price,
-            'monthly_payment': monthly_payment,
-            'loan_cost': loan_cost,
+            'monthly_payment': quote.monthly_payment,
+            'loan_cost': quote.loan_cost,
         })
-        return Response(ser.data)
+        return (status.HTTP_200_OK, ser.data)
+
+
+class EstimatedPaymentsView(views.APIView):
+    """
+    Estimate payments for many prices at once, for every plan available at each price. Prices are given as repeated
+    ``price`` query parameters. Alternatively, pass ``basket=1`` to estimate payments for the current basket's total,
+    using the plans made available to the basket by offers.
+    """
+    MAX_PRICES = 100
+
+    def get(self, request):
+        if request.GET.get('basket'):
+            basket = operations.get_basket(request)
+            principal_price = basket.total_incl_tax if basket.is_tax_known else basket.total_excl_tax
+            estimates = self._estimate_payments([principal_price], [list_plans_for_basket(basket)])
+            return Response(estimates)
+
+        # Validate the price inputs
+        principal_prices = []
+        for principal_price in request.GET.getlist('price'):
+            principal_price = _parse_price(principal_price)
+            if principal_price is None:
+                data = {
+                    'price': 'Submitted price parameter was not valid.',
+                }
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+            principal_prices.append(principal_price)
+
+        if not principal_prices or len(principal_prices) > self.MAX_PRICES:
+            data = {
+                'price': 'Submit between 1 and {} price parameters.'.format(self.MAX_PRICES),
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        plans = [FinancingPlan.get_advertisable_plans_by_price(p) for p in principal_prices]
+        return Response(self._estimate_payments(principal_prices, plans))
+
+
+    def _estimate_payments(self, principal_prices, plans_by_price):
+        quotes = iter(get_payment_quotes(
+            (plan, principal_price)
+            for principal_price, plans in zip(principal_prices, plans_by_price)
+            for plan in plans))
+        results = []
+        for principal_price, plans in zip(principal_prices, plans_by_price):
+            estimates = []
+            for plan in plans:
+                quote = next(quotes)
+                estimates.append({
+                    'plan': plan,
+                    'principal': principal_price,
+                    'monthly_payment': quote.monthly_payment,
+                    'loan_cost': quote.loan_cost,
+                })
+            results.append({
+                'principal': principal_price,
+                'estimates': estimates,
+            })
+        return EstimatedPaymentsSerializer(results, many=True).data
 
 
 class UpdateAccountInquiryView(views.APIView):
@@ -7,3 +7,7 @@ class Config(AppConfig):
 
     def ready(self):
         from . import handlers  # NOQA
+        from .settings import WFRS_SOAP_CLIENT_WARM_UP
+        if WFRS_SOAP_CLIENT_WARM_UP:
+            from .connector import clients
+            clients.warm_up()
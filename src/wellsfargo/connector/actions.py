@@ -15,7 +15,9 @@ from ..core.constants import (
     OTB_SUCCESS,
 )
 from ..core.exceptions import TransactionDenied, CreditApplicationPending, CreditApplicationDenied
+from ..core.structures import PreparedTransaction
 from ..models import APICredentials, TransferMetadata, AccountInquiryResult, FinancingPlan, PreQualificationResponse
+from ..security import encrypt_account_number
 from ..settings import (
     WFRS_TRANSACTION_WSDL,
     WFRS_INQUIRY_WSDL,
@@ -23,8 +25,8 @@ from ..settings import (
     WFRS_PRE_QUAL_WSDL,
     WFRS_OTB_WSDL,
 )
+from . import clients, retry
 import urllib.parse
-import soap
 import uuid
 import re
 import logging
@@ -32,15 +34,38 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def submit_transaction(trans_request, current_user=None, transaction_uuid=None, persist=True):
-    client = soap.get_client(WFRS_TRANSACTION_WSDL, 'WFRS')
-    type_name = _find_namespaced_name(client, 'Transaction')
+def prepare_transaction(trans_request, current_user=None):
+    """
+    Do the work needed to submit the given transaction which doesn't depend on WFRS's response: get the SOAP client,
+    pick the API credentials, look up the financing plan and encrypt the account number. This can run ahead of time
+    (e.g. on another thread, while the fraud screen runs), and the result passed to :func:`submit_transaction`.
+    """
+    prepared = PreparedTransaction()
+    prepared.client = clients.get_client(WFRS_TRANSACTION_WSDL)
+    prepared.type_name = _find_namespaced_name(prepared.client, 'Transaction')
+    prepared.credentials = APICredentials.get_credentials(current_user)
+    prepared.plan_number = trans_request.plan_number
+    prepared.financing_plan = FinancingPlan.objects.filter(plan_number=trans_request.plan_number).first()
+    if trans_request.account_number:
+        prepared.account_number = trans_request.account_number
+        prepared.encrypted_account_number = encrypt_account_number(trans_request.account_number)
+    return prepared
+
+
+def submit_transaction(trans_request, current_user=None, transaction_uuid=None, persist=True, prepared=None):
+    if prepared is None:
+        client = clients.get_client(WFRS_TRANSACTION_WSDL)
+        type_name = _find_namespaced_name(client, 'Transaction')
+        creds = APICredentials.get_credentials(current_user)
+    else:
+        client = prepared.client
+        type_name = prepared.type_name
+        creds = prepared.credentials
     request = client.factory.create(type_name)
 
     # If a uuid was given, use that instead of generating a new one. This allows tracing fraud responses through to transactions.
     request.uuid = transaction_uuid if transaction_uuid else uuid.uuid1()
 
-    creds = APICredentials.get_credentials(current_user)
     request.userName = creds.username
     request.setupPassword = creds.password
     request.merchantNumber = creds.merchant_num
@@ -54,18 +79,24 @@ def submit_transaction(trans_request, current_user=None, transaction_uuid=None,
     request.ticketNumber = trans_request.ticket_number
 
     # Submit
-    resp = client.service.submitTransaction(request)
+    resp = retry.call('transaction', client.service.submitTransaction, request)
 
     # Persist transaction data and WF specific metadata
     transfer = TransferMetadata()
     transfer.user = trans_request.user
     transfer.credentials = creds
-    transfer.account_number = resp.accountNumber
+    if prepared is not None and prepared.account_number == resp.accountNumber:
+        transfer.set_account_number(resp.accountNumber, prepared.encrypted_account_number)
+    else:
+        transfer.account_number = resp.accountNumber
     transfer.merchant_reference = resp.uuid
     transfer.amount = _as_decimal(resp.amount)
     transfer.type_code = resp.transactionCode
     transfer.ticket_number = resp.ticketNumber
-    transfer.financing_plan = FinancingPlan.objects.filter(plan_number=resp.planNumber).first()
+    if prepared is not None and str(prepared.plan_number) == str(resp.planNumber):
+        transfer.financing_plan = prepared.financing_plan
+    else:
+        transfer.financing_plan = FinancingPlan.objects.filter(plan_number=resp.planNumber).first()
     transfer.auth_number = resp.authorizationNumber
     transfer.status = resp.transactionStatus
     transfer.message = resp.transactionMessage
@@ -89,7 +120,7 @@ def submit_transaction(trans_request, current_user=None, transaction_uuid=None,
 
 
 def submit_inquiry(account_number, current_user=None, locale=EN_US):
-    client = soap.get_client(WFRS_INQUIRY_WSDL, 'WFRS')
+    client = clients.get_client(WFRS_INQUIRY_WSDL)
     type_name = _find_namespaced_name(client, 'Inquiry')
     request = client.factory.create(type_name)
     request.uuid = uuid.uuid1()
@@ -104,7 +135,7 @@ def submit_inquiry(account_number, current_user=None, locale=EN_US):
     request.accountNumber = account_number
 
     # Submit
-    resp = client.service.submitInquiry(request)
+    resp = retry.call('inquiry', client.service.submitInquiry, request)
 
     # Check for faults
     if resp.faults:
@@ -150,7 +181,7 @@ def submit_inquiry(account_number, current_user=None, locale=EN_US):
 
 
 def submit_credit_application(app, current_user=None):
-    client = soap.get_client(WFRS_CREDIT_APP_WSDL, 'WFRS')
+    client = clients.get_client(WFRS_CREDIT_APP_WSDL)
     type_name = _find_namespaced_name(client, 'CreditApp')
     data = client.factory.create(type_name)
 
@@ -222,7 +253,7 @@ def submit_credit_application(app, current_user=None):
         data.jointPhotoIdExpDate = _format_date( getattr(app, 'joint_photo_id_expiration', None) )
 
     # Submit
-    resp = client.service.submitCreditApp(data)
+    resp = retry.call('credit_app', client.service.submitCreditApp, data)
 
     # Save the status and credentials used to apply
     app.status = resp.transactionStatus or ''
@@ -278,7 +309,7 @@ def submit_credit_application(app, current_user=None):
 
 
 def check_pre_qualification_status(prequal_request, return_url=None, current_user=None):
-    client = soap.get_client(WFRS_PRE_QUAL_WSDL, 'WFRS')
+    client = clients.get_client(WFRS_PRE_QUAL_WSDL)
     type_name = _find_namespaced_name(client, 'WFRS_InstantPreScreenRequest')
     data = client.factory.create(type_name)
 
@@ -309,7 +340,7 @@ def check_pre_qualification_status(prequal_request, return_url=None, current_use
     prequal_request.save()
 
     # Submit the pre-qualification request
-    resp = client.service.instantPreScreen(data)
+    resp = retry.call('pre_qual', client.service.instantPreScreen, data)
 
     # Check for faults
     if resp.faults and resp.faults.item:
@@ -337,7 +368,7 @@ def check_pre_qualification_status(prequal_request, return_url=None, current_use
 
 
 def check_pre_qualification_account_status(prequal_response):
-    client = soap.get_client(WFRS_OTB_WSDL, 'WFRS')
+    client = clients.get_client(WFRS_OTB_WSDL)
     type_name = _find_namespaced_name(client, 'WFRS_OTBRequest')
     data = client.factory.create(type_name)
 
@@ -356,7 +387,7 @@ def check_pre_qualification_account_status(prequal_response):
     data.lastName = prequal_response.request.last_name
 
     # Submit the pre-qualification request
-    resp = client.service.submitOTB(data)
+    resp = retry.call('otb', client.service.submitOTB, data)
 
     # Check for faults
     if resp.faults and resp.faults.item:
@@ -428,10 +459,4 @@ def _as_decimal(string):
 
 
 def _find_namespaced_name(client, bare_name):
-    for stype in client.sd[0].types:
-        namespaced_name = client.sd[0].xlate(stype[0])
-        if ':' in namespaced_name:
-            prefix, bare = namespaced_name.split(':', 1)
-            if bare == bare_name:
-                return namespaced_name
-    return bare_name
+    return clients.get_type_name(client, bare_name)
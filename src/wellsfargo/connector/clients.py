@@ -0,0 +1,157 @@
+from collections import namedtuple
+from ..settings import (
+    WFRS_TRANSACTION_WSDL,
+    WFRS_INQUIRY_WSDL,
+    WFRS_CREDIT_APP_WSDL,
+    WFRS_PRE_QUAL_WSDL,
+    WFRS_OTB_WSDL,
+    WFRS_SOAP_CLIENT_MAX_AGE,
+)
+from soap.http import HttpTransport
+from . import retry
+import soap
+import threading
+import time
+import weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+WFRS_WSDLS = (
+    WFRS_TRANSACTION_WSDL,
+    WFRS_INQUIRY_WSDL,
+    WFRS_CREDIT_APP_WSDL,
+    WFRS_PRE_QUAL_WSDL,
+    WFRS_OTB_WSDL,
+)
+
+PoolEntry = namedtuple('PoolEntry', ('client', 'created'))
+
+# Map of client => {bare type name: namespaced type name}. Weakly keyed, so an index is discarded along with its
+# client whenever the pool rebuilds that client from the WSDL.
+_type_name_indexes = weakref.WeakKeyDictionary()
+_type_name_indexes_lock = threading.Lock()
+
+
+class PolicyTransport(HttpTransport):
+    """
+    SOAP transport whose send timeout can be overridden per thread, so that one pooled client can serve calls with
+    different :class:`wellsfargo.connector.retry.RetryPolicy` timeouts (and deadlines) at the same time.
+    """
+    @property
+    def send_timeout(self):
+        timeout = retry.get_send_timeout()
+        return HttpTransport.send_timeout if timeout is None else timeout
+
+
+
+class SOAPClientPool(object):
+    """
+    Process-wide pool of SOAP client objects, keyed by WSDL URL and log prefix.
+
+    Building a client means fetching and parsing the WSDL and resolving all of its types, which is far too slow to
+    do on the checkout critical path. Clients are built once per worker process (under a lock, so concurrent first
+    requests don't all parse the WSDL) and are then shared by every thread in that process. If ``max_age`` (in
+    seconds) is set, clients older than that are discarded and rebuilt on their next use, so that WSDL changes are
+    eventually picked up by long-running workers.
+
+    Construction is delegated to :func:`soap.get_client`, so ``SOAP_WSDL_INTERCEPTS`` and test transports keep
+    working. If the underlying :attr:`soap.clients` cache is reset (as :class:`soap.tests.SoapTest` does), pooled
+    clients are rebuilt too.
+    """
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+
+
+    def get_client(self, wsdl, log_prefix):
+        key = (wsdl, log_prefix)
+        entry = self._entries.get(key)
+        if entry is not None and self._is_fresh(wsdl, entry):
+            return entry.client
+        with self._lock:
+            # Another thread may have built the client while we were waiting on the lock
+            entry = self._entries.get(key)
+            if entry is None or not self._is_fresh(wsdl, entry):
+                entry = self._build_entry(wsdl, log_prefix, stale=entry)
+                self._entries[key] = entry
+        return entry.client
+
+
+    def warm_up(self, wsdls, log_prefix):
+        """Build clients for each of the given WSDLs ahead of time. Failures are logged, not raised."""
+        for wsdl in wsdls:
+            try:
+                self.get_client(wsdl, log_prefix)
+            except Exception:
+                logger.warning('Failed to warm up SOAP client for WSDL at {}'.format(wsdl), exc_info=True)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+    def _is_fresh(self, wsdl, entry):
+        if soap.clients.get(self._resolve_wsdl(wsdl)) is not entry.client:
+            return False
+        if self.max_age is not None and (time.monotonic() - entry.created) > self.max_age:
+            return False
+        return True
+
+
+    def _build_entry(self, wsdl, log_prefix, stale=None):
+        if stale is not None:
+            # Make sure the soap module builds a brand new client rather than handing back the expired one
+            resolved = self._resolve_wsdl(wsdl)
+            if soap.clients.get(resolved) is stale.client:
+                del soap.clients[resolved]
+        client = soap.get_client(wsdl, log_prefix, plugins=[])
+        # Leave custom transports (e.g. ones patched in by tests) alone
+        if type(client.options.transport) is HttpTransport:
+            client.set_options(transport=PolicyTransport())
+        return PoolEntry(client=client, created=time.monotonic())
+
+
+    def _resolve_wsdl(self, wsdl):
+        return soap.settings.WSDL_INTERCEPTS.get(wsdl, wsdl)
+
+
+pool = SOAPClientPool(max_age=WFRS_SOAP_CLIENT_MAX_AGE)
+
+
+def get_client(wsdl, log_prefix='WFRS'):
+    return pool.get_client(wsdl, log_prefix)
+
+
+def warm_up(log_prefix='WFRS'):
+    pool.warm_up(WFRS_WSDLS, log_prefix)
+
+
+def get_type_name(client, bare_name):
+    """
+    Return the namespaced name (e.g. ``ns1:Transaction``) of the given type in the client's WSDL, or the bare name
+    if the WSDL doesn't namespace it. The index is built once per client, so this is a dict lookup per request rather
+    than a scan of every type in the WSDL.
+    """
+    index = _type_name_indexes.get(client)
+    if index is None:
+        with _type_name_indexes_lock:
+            index = _type_name_indexes.get(client)
+            if index is None:
+                index = _build_type_name_index(client)
+                _type_name_indexes[client] = index
+    return index.get(bare_name, bare_name)
+
+
+def _build_type_name_index(client):
+    index = {}
+    for stype in client.sd[0].types:
+        namespaced_name = client.sd[0].xlate(stype[0])
+        if ':' in namespaced_name:
+            prefix, bare = namespaced_name.split(':', 1)
+            # Keep the first match, same as a linear scan would
+            index.setdefault(bare, namespaced_name)
+    return index
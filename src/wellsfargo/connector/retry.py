@@ -0,0 +1,177 @@
+from contextlib import ContextDecorator, contextmanager
+from requests.exceptions import Timeout, ConnectTimeout, ConnectionError
+from soap.http import HttpTransport
+from ..settings import WFRS_RETRY_POLICIES
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(ConnectTimeout):
+    """
+    Raised instead of sending a request to WFRS once the current deadline has passed. This subclasses
+    :class:`requests.exceptions.ConnectTimeout` because, like a connect timeout, the request never reached WFRS.
+    """
+
+
+
+class Deadline(object):
+    """Point in (monotonic) time by which a unit of work, e.g. a checkout request, should be finished"""
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+
+
+class deadline(ContextDecorator):
+    """
+    Bound the total time spent calling WFRS within the block (or decorated function) on the current thread. Every
+    :class:`RetryPolicy` call made inside it has its timeouts clamped to the time remaining, won't back off past it
+    and fails fast with :class:`DeadlineExceeded` once it has passed. Nested deadlines can only shorten the outer one.
+    Pass ``None`` to suspend the deadline, e.g. to cancel a transaction which may have gone through.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+    def __enter__(self):
+        current = get_deadline()
+        if self.seconds is None:
+            new = None
+        else:
+            new = Deadline(self.seconds)
+            if current is not None and current.expires < new.expires:
+                new = current
+        _get_stack().append(new)
+        return new
+
+
+    def __exit__(self, *exc):
+        _get_stack().pop()
+        return False
+
+
+
+class RetryPolicy(object):
+    """
+    How to call one kind of WFRS API operation: the timeout of each attempt, how many attempts to make and how long
+    to back off between them.
+
+    Requests that time out while connecting never reached WFRS, so they're always safe to retry. Other timeouts and
+    connection errors are only retried for ``idempotent`` operations, since WFRS may have acted on the request. Back
+    off delays grow exponentially from ``backoff`` up to ``max_backoff`` seconds, with full jitter so that workers
+    retrying at the same time don't do so in lockstep.
+    """
+    def __init__(self, operation, timeout=None, max_attempts=1, backoff=0.5, max_backoff=5.0, idempotent=False):
+        self.operation = operation
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idempotent = idempotent
+
+
+    def __repr__(self):
+        return '<RetryPolicy: {}>'.format(self.operation)
+
+
+    @property
+    def retry_on(self):
+        return (Timeout, ConnectionError) if self.idempotent else (ConnectTimeout, )
+
+
+    def get_backoff(self, attempt):
+        """Get how long to wait after the given (1-indexed) attempt before making the next one"""
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        return random.uniform(0, delay)
+
+
+    def get_timeout(self):
+        """
+        Get the ``(connect, read)`` timeout for the next attempt, clamped to the current deadline. Returns ``None``
+        to use the SOAP transport's default. Raises :class:`DeadlineExceeded` if the deadline has already passed.
+        """
+        current = get_deadline()
+        if current is None:
+            return self.timeout
+        remaining = current.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('Deadline exceeded before calling WFRS {}'.format(self.operation))
+        timeout = self.timeout
+        if timeout is None:
+            timeout = HttpTransport.send_timeout
+        if isinstance(timeout, (tuple, list)):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+
+    def sleep(self, attempt):
+        """
+        Back off after the given (1-indexed) attempt. Returns ``False``, without sleeping, if the next attempt
+        wouldn't start before the current deadline.
+        """
+        delay = self.get_backoff(attempt)
+        current = get_deadline()
+        if current is not None and current.remaining() <= delay:
+            return False
+        time.sleep(delay)
+        return True
+
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func`` (usually a SOAP service method), retrying it according to this policy"""
+        attempt = 0
+        while True:
+            attempt += 1
+            with send_timeout(self.get_timeout()):
+                try:
+                    return func(*args, **kwargs)
+                except self.retry_on as e:
+                    if attempt >= self.max_attempts or not self.sleep(attempt):
+                        raise
+                    logger.warning('Retrying WFRS {} after attempt {} failed: {}'.format(self.operation, attempt, e))
+
+
+
+def _get_stack():
+    stack = getattr(_local, 'deadlines', None)
+    if stack is None:
+        stack = _local.deadlines = []
+    return stack
+
+
+def get_deadline():
+    """Get the current thread's :class:`Deadline`, if any"""
+    stack = _get_stack()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def send_timeout(timeout):
+    """Override the send timeout of WFRS SOAP requests made on the current thread"""
+    previous = getattr(_local, 'send_timeout', None)
+    _local.send_timeout = timeout
+    try:
+        yield
+    finally:
+        _local.send_timeout = previous
+
+
+def get_send_timeout():
+    return getattr(_local, 'send_timeout', None)
+
+
+def get_policy(operation):
+    return RetryPolicy(operation, **WFRS_RETRY_POLICIES.get(operation, {}))
+
+
+def call(operation, func, *args, **kwargs):
+    return get_policy(operation).call(func, *args, **kwargs)
@@ -80,6 +80,21 @@ TRANS_TYPES = (
     # (TRANS_TYPE_APPLY, _('Credit Line Application')),
 )
 
+TRANS_JOURNAL_PENDING = 'PENDING'  # Recorded, and about to be sent to WFRS
+TRANS_JOURNAL_APPROVED = 'APPROVED'
+TRANS_JOURNAL_DECLINED = 'DECLINED'
+TRANS_JOURNAL_UNKNOWN = 'UNKNOWN'  # Sent to WFRS, but no response was received
+TRANS_JOURNAL_NOT_SENT = 'NOT_SENT'  # Failed before reaching WFRS (e.g. a connect timeout)
+TRANS_JOURNAL_CANCELED = 'CANCELED'  # No response was received, so the transaction was canceled
+TRANS_JOURNAL_STATES = (
+    (TRANS_JOURNAL_PENDING, _('Pending')),
+    (TRANS_JOURNAL_APPROVED, _('Approved')),
+    (TRANS_JOURNAL_DECLINED, _('Declined')),
+    (TRANS_JOURNAL_UNKNOWN, _('Unknown')),
+    (TRANS_JOURNAL_NOT_SENT, _('Not Sent')),
+    (TRANS_JOURNAL_CANCELED, _('Canceled')),
+)
+
 
 INDIVIDUAL, JOINT = ('I', 'J')
 APP_TYPES = (
@@ -0,0 +1,74 @@
+from django.apps import apps
+from .utils import VersionedTableCache
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialsTable(object):
+    """
+    Immutable snapshot of every :class:`wellsfargo.models.APICredentials` row, in priority order. Resolutions are
+    memoized by the (relevant) set of group IDs a user belongs to.
+    """
+    def __init__(self, version, credentials):
+        self.version = version
+        self.credentials = credentials
+        self.group_ids = frozenset(c.user_group_id for c in credentials if c.user_group_id is not None)
+        self.default = next((c for c in credentials if c.user_group_id is None), None)
+        self._by_group_ids = {}
+
+
+    def resolve(self, group_ids):
+        group_ids = frozenset(group_ids) & self.group_ids
+        if not group_ids:
+            return self.default
+        creds = self._by_group_ids.get(group_ids)
+        if creds is None:
+            creds = next((c for c in self.credentials if c.user_group_id in group_ids), self.default)
+            self._by_group_ids[group_ids] = creds
+        return creds
+
+
+
+class CredentialsResolver(VersionedTableCache):
+    """
+    Process-local cache of the API credentials table, used to pick credentials for WFRS API calls without querying
+    the database on every call.
+
+    The table is reloaded whenever the ``post_save`` / ``post_delete`` / ``m2m_changed`` handlers in
+    :mod:`wellsfargo.handlers` invalidate it (once the change commits), and once it's older than
+    ``WFRS_IN_PROCESS_CACHE_MAX_AGE`` seconds (see :class:`wellsfargo.core.utils.VersionedTableCache`). A user's
+    group IDs are memoized on the user object itself, against the same version, so repeated lookups for the same
+    request don't query group membership again.
+    """
+    VERSION_CACHE_KEY = 'wfrs-api-credentials-version'
+    USER_GROUPS_ATTR = '_wfrs_credentials_group_ids'
+
+    def get_credentials(self, user=None):
+        table = self._get_table()
+        if user and user.is_authenticated and table.group_ids:
+            creds = table.resolve(self._get_user_group_ids(user, table.version))
+        else:
+            creds = table.default
+        if creds:
+            return creds
+        logger.error('Application requested WFRS API Credentials for use by user {}, but none exist in the database for them.'.format(user))
+        return apps.get_model('wellsfargo', 'APICredentials')()
+
+
+    def load_table(self, version):
+        APICredentials = apps.get_model('wellsfargo', 'APICredentials')
+        return CredentialsTable(version, list(APICredentials.objects.all()))
+
+
+    def _get_user_group_ids(self, user, version):
+        cached = getattr(user, self.USER_GROUPS_ATTR, None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        group_ids = frozenset(user.groups.values_list('id', flat=True))
+        setattr(user, self.USER_GROUPS_ATTR, (version, group_ids))
+        return group_ids
+
+
+
+resolver = CredentialsResolver()
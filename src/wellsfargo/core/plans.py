@@ -0,0 +1,102 @@
+from bisect import bisect_right
+from decimal import Decimal
+from django.apps import apps
+from .utils import VersionedTableCache
+import hashlib
+
+
+class FinancingPlanIndex(object):
+    """
+    Immutable snapshot of every :class:`wellsfargo.models.FinancingPlan` row, with advertisable plans sorted by their
+    product price threshold so that finding the best plan for a price is a bisect rather than a query.
+
+    ``digest`` is a hash of the plans' field values, so it only changes when the plan data does and is the same in
+    every process which has loaded the same plans.
+    """
+    def __init__(self, version, plans):
+        self.version = version
+        self.plans = plans
+        self.digest = self._get_digest(plans)
+        self.default_plan = next((p for p in plans if p.advertising_enabled and p.is_default_plan), None)
+        advertisable = [p for p in plans if p.advertising_enabled and p.product_price_threshold >= Decimal('0.00')]
+        # Sorted ascending, so the best plan for a price is the last one whose threshold is <= the price. Ties on
+        # threshold are broken by APR, highest last.
+        self._all = self._build_index(advertisable)
+        self._with_term = self._build_index([p for p in advertisable if p.term_months != 0])
+
+
+    def get_plan_by_price(self, price, include_zero_term=False):
+        plans, thresholds = self._all if include_zero_term else self._with_term
+        i = bisect_right(thresholds, price)
+        if i == 0:
+            return None
+        return plans[i - 1]
+
+
+    def get_plans_by_price(self, price, include_zero_term=False):
+        """Get every plan available for the given price, best first"""
+        plans, thresholds = self._all if include_zero_term else self._with_term
+        return plans[:bisect_right(thresholds, price)][::-1]
+
+
+    def _build_index(self, plans):
+        plans = sorted(plans, key=lambda p: (p.product_price_threshold, p.apr))
+        return plans, [p.product_price_threshold for p in plans]
+
+
+    def _get_digest(self, plans):
+        rows = [tuple(f.value_to_string(p) for f in p._meta.concrete_fields) for p in plans]
+        return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
+
+
+class FinancingPlanCatalog(VersionedTableCache):
+    """
+    Process-local cache of the financing plan table, used to pick which plan to advertise for a product (in template
+    tags and the estimated payment API) without querying the database for every product on a page.
+
+    The table is reloaded whenever the ``post_save`` / ``post_delete`` handlers in :mod:`wellsfargo.handlers`
+    invalidate it (once the change commits), and once it's older than ``WFRS_IN_PROCESS_CACHE_MAX_AGE`` seconds (see
+    :class:`wellsfargo.core.utils.VersionedTableCache`). Code which changes plans without sending signals (e.g.
+    ``QuerySet.update``) should call :meth:`invalidate` itself. Plans returned by the catalog are shared, so treat them
+    as read-only.
+
+    The version only says when to reload the table, and differs between processes which don't share a cache. Use
+    :attr:`digest`, which is derived from the plan data, for anything which must agree between processes (e.g. HTTP
+    validators).
+    """
+    VERSION_CACHE_KEY = 'wfrs-financing-plans-version'
+
+    @property
+    def version(self):
+        return self._get_table().version
+
+
+    @property
+    def digest(self):
+        return self._get_table().digest
+
+
+    def get_plans(self):
+        return list(self._get_table().plans)
+
+
+    def get_default_plan(self):
+        return self._get_table().default_plan
+
+
+    def get_advertisable_plan_by_price(self, price, include_zero_term=False):
+        return self._get_table().get_plan_by_price(price, include_zero_term=include_zero_term)
+
+
+    def get_advertisable_plans_by_price(self, price, include_zero_term=False):
+        return self._get_table().get_plans_by_price(price, include_zero_term=include_zero_term)
+
+
+    def load_table(self, version):
+        FinancingPlan = apps.get_model('wellsfargo', 'FinancingPlan')
+        return FinancingPlanIndex(version, list(FinancingPlan.objects.order_by('plan_number')))
+
+
+
+catalog = FinancingPlanCatalog()
@@ -0,0 +1,57 @@
+from collections import namedtuple
+from decimal import Decimal
+from django.apps import apps
+from .utils import VersionedTableCache
+
+
+PaymentQuote = namedtuple('PaymentQuote', ('monthly_payment', 'loan_cost'))
+
+
+class PaymentQuoteTable(object):
+    """
+    Immutable snapshot of every :class:`wellsfargo.models.FinancingPlanPaymentQuote` row, keyed by plan, APR, term and
+    price.
+    """
+    def __init__(self, version, rows):
+        self.version = version
+        self._quotes = {}
+        for plan_id, apr, term_months, price, monthly_payment, loan_cost in rows:
+            self._quotes[(plan_id, apr, term_months, price)] = PaymentQuote(monthly_payment, loan_cost)
+
+
+    def __len__(self):
+        return len(self._quotes)
+
+
+    def get_quote(self, plan, price):
+        return self._quotes.get((plan.pk, Decimal(plan.apr), plan.term_months, price))
+
+
+
+class PaymentQuoteCatalog(VersionedTableCache):
+    """
+    Process-local cache of the precomputed payment quote table, used to serve monthly payment estimates for common
+    prices without doing the amortization math on every request.
+
+    The ``wfrs_precompute_payment_quotes`` management command invalidates it after rebuilding the table, and it's
+    reloaded once it's older than ``WFRS_IN_PROCESS_CACHE_MAX_AGE`` seconds (see
+    :class:`wellsfargo.core.utils.VersionedTableCache`).
+
+    Quotes are only returned for an exact match on the plan's current APR and term and the (quantized) price, so a
+    missing quote, or one for a plan which has since changed, is never served: callers recompute the payment instead.
+    """
+    VERSION_CACHE_KEY = 'wfrs-payment-quotes-version'
+
+    def get_quote(self, plan, price):
+        return self._get_table().get_quote(plan, price)
+
+
+    def load_table(self, version):
+        FinancingPlanPaymentQuote = apps.get_model('wellsfargo', 'FinancingPlanPaymentQuote')
+        rows = FinancingPlanPaymentQuote.objects.order_by().values_list(
+            'plan_id', 'apr', 'term_months', 'price', 'monthly_payment', 'loan_cost')
+        return PaymentQuoteTable(version, list(rows))
+
+
+
+catalog = PaymentQuoteCatalog()
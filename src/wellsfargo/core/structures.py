@@ -11,3 +11,18 @@ class TransactionRequest(object):
     plan_number = None
     amount = Decimal('0.00')
     ticket_number = None
+
+
+
+class PreparedTransaction(object):
+    """
+    Everything needed to submit a transaction which doesn't depend on WFRS's response, worked out ahead of time.
+    See :func:`wellsfargo.connector.actions.prepare_transaction`.
+    """
+    client = None
+    type_name = None
+    credentials = None
+    account_number = None
+    encrypted_account_number = None
+    plan_number = None
+    financing_plan = None
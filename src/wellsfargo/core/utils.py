@@ -0,0 +1,84 @@
+from django.core.cache import cache
+from ..settings import WFRS_IN_PROCESS_CACHE_MAX_AGE
+import threading
+import time
+import uuid
+
+
+def freeze(value):
+    """
+    Convert a configuration value (e.g. a settings dict of class kwargs) into a hashable equivalent, for use as a key
+    when caching the objects built from it. Dicts become sorted tuples of items and lists become tuples.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def is_current(table, version):
+    """
+    Check whether an in-process snapshot of a table (see :class:`VersionedTableCache`) can still be served:
+    its version must match the one in the Django cache, and it mustn't be older than ``WFRS_IN_PROCESS_CACHE_MAX_AGE``.
+    """
+    if table is None or table.version != version:
+        return False
+    if WFRS_IN_PROCESS_CACHE_MAX_AGE is None:
+        return True
+    return (time.monotonic() - table.loaded) < WFRS_IN_PROCESS_CACHE_MAX_AGE
+
+
+
+class VersionedTableCache(object):
+    """
+    Process-local cache of an immutable snapshot of a database table (anything with a ``version`` attribute), so that
+    reading it doesn't query the database every time.
+
+    The snapshot is loaded once and reused until its version changes. The version lives in the Django cache, under
+    ``VERSION_CACHE_KEY``, so that :meth:`invalidate` reaches every worker process which shares that cache (e.g. Redis
+    or Memcached, not ``LocMemCache``). The snapshot is also reloaded once it's older than
+    ``WFRS_IN_PROCESS_CACHE_MAX_AGE`` seconds, which bounds how stale it can get when the cache isn't shared. Call
+    :meth:`invalidate` after the change commits (e.g. with ``transaction.on_commit``), or another process could
+    reload the old rows under the new version.
+
+    Subclasses set ``VERSION_CACHE_KEY`` and implement :meth:`load_table`.
+    """
+    VERSION_CACHE_KEY = None
+
+    def __init__(self):
+        self._table = None
+        self._lock = threading.Lock()
+
+
+    def load_table(self, version):
+        """Build a new snapshot of the table, with the given version"""
+        raise NotImplementedError()
+
+
+    def invalidate(self):
+        cache.set(self.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        with self._lock:
+            self._table = None
+
+
+    def _get_version(self):
+        version = cache.get(self.VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(self.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(self.VERSION_CACHE_KEY)
+        return version
+
+
+    def _get_table(self):
+        version = self._get_version()
+        table = self._table
+        if is_current(table, version):
+            return table
+        with self._lock:
+            table = self._table
+            if not is_current(table, version):
+                table = self.load_table(version)
+                table.loaded = time.monotonic()
+                self._table = table
+        return table
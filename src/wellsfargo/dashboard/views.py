@@ -202,6 +202,9 @@ class FinancingPlanBenefitListView(generic.ListView):
     template_name = "wfrs/dashboard/benefit_list.html"
     context_object_name = "benefits"
 
+    def get_queryset(self):
+        return FinancingPlanBenefit.objects.with_plans()
+
 
 
 class FinancingPlanBenefitCreateView(generic.CreateView):
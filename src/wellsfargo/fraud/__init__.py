@@ -1,6 +1,12 @@
 from django.core.exceptions import ImproperlyConfigured
+from ..core.utils import freeze
 from ..settings import WFRS_FRAUD_PROTECTION
 import importlib
+import threading
+
+#: Cache of fraud screener instances, keyed by their (frozen) configuration
+_screeners = {}
+_screeners_lock = threading.Lock()
 
 
 def screen_transaction(request, order):
@@ -9,9 +15,28 @@ def screen_transaction(request, order):
     return _get_fraud_screener(klass, kwargs).screen_transaction(request, order)
 
 
+def reset_fraud_screeners():
+    """
+    Discard all cached fraud screener instances, so that they're rebuilt from configuration on next use.
+    """
+    with _screeners_lock:
+        _screeners.clear()
+
+
 def _get_fraud_screener(klass, kwargs):
-    FraudScreener = _load_cls_from_abs_path(klass)
-    screener = FraudScreener(**kwargs)
+    """
+    Get the fraud screener instance for the given class path and keyword arguments. Screeners are built lazily, once
+    per process, and then shared by every thread, so they must be safe to use concurrently.
+    """
+    key = freeze((klass, kwargs))
+    screener = _screeners.get(key)
+    if screener is None:
+        with _screeners_lock:
+            screener = _screeners.get(key)
+            if screener is None:
+                FraudScreener = _load_cls_from_abs_path(klass)
+                screener = FraudScreener(**kwargs)
+                _screeners[key] = screener
     return screener
 
 
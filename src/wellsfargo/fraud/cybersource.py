@@ -1,6 +1,7 @@
 from suds.wsse import Security, UsernameToken
+from ..connector import clients
 from ..models import FraudScreenResult
-import soap
+import threading
 import logging
 import uuid
 
@@ -43,23 +44,41 @@ class DecisionManagerFraudProtection(object):
 
 
     def __init__(self, wsdl, merchant_id, transaction_security_key, soap_log_prefix='CYBERSOURCE'):
+        self.wsdl = wsdl
         self.merchant_id = merchant_id
+        self.soap_log_prefix = soap_log_prefix
 
-        # Build a SOAP client
-        self.client = soap.get_client(wsdl, soap_log_prefix)
-
-        # Add WSSE Security Header to client
-        security = Security()
+        # Build the WSSE Security Header once. It's applied to the SOAP client below.
+        self.security = Security()
         token = UsernameToken(self.merchant_id, transaction_security_key)
-        security.tokens.append(token)
-        self.client.set_options(wsse=security)
+        self.security.tokens.append(token)
+
+        self._client = None
+        self._client_lock = threading.Lock()
+
+
+    @property
+    def client(self):
+        """
+        Get a SOAP client for the Cybersource API. Clients come from the process-wide pool, so the WSDL is only
+        loaded once per process. If the pool hands back a different client (e.g. because it was rebuilt), the WSSE
+        header is applied to the new client first.
+        """
+        client = clients.get_client(self.wsdl, self.soap_log_prefix)
+        if client is not self._client:
+            with self._client_lock:
+                if client is not self._client:
+                    client.set_options(wsse=self.security)
+                    self._client = client
+        return client
 
 
     def screen_transaction(self, request, order):
+        client = self.client
         data = {}
 
         # Run the Advanced Fraud Screen Service
-        data['afsService'] = self.client.factory.create('ns0:AFSService')
+        data['afsService'] = client.factory.create('ns0:AFSService')
         data['afsService']._run = "true"
 
         # Add in request and merchant data
@@ -69,7 +88,7 @@ class DecisionManagerFraudProtection(object):
         data['merchantReferenceCode'] = order.number
 
         # Add order customer data
-        data['billTo'] = self.client.factory.create('ns0:BillTo')
+        data['billTo'] = client.factory.create('ns0:BillTo')
         data['billTo'].email = order.email
         data['billTo'].ipAddress = request.META.get('REMOTE_ADDR')
         if order.user:
@@ -88,7 +107,7 @@ class DecisionManagerFraudProtection(object):
 
         # Add order shipping data
         if order.shipping_address:
-            data['shipTo'] = self.client.factory.create('ns0:ShipTo')
+            data['shipTo'] = client.factory.create('ns0:ShipTo')
             data['shipTo'].phoneNumber = order.shipping_address.phone_number
             data['shipTo'].firstName = order.shipping_address.first_name
             data['shipTo'].lastName = order.shipping_address.last_name
@@ -100,13 +119,13 @@ class DecisionManagerFraudProtection(object):
             data['shipTo'].country = order.shipping_address.country.iso_3166_1_a2
 
         # Add order total data
-        data['purchaseTotals'] = self.client.factory.create('ns0:PurchaseTotals')
+        data['purchaseTotals'] = client.factory.create('ns0:PurchaseTotals')
         data['purchaseTotals'].currency = order.currency
         data['purchaseTotals'].grandTotalAmount = order.total_incl_tax
 
         # Send the transaction to Cybersource to process
         try:
-            resp = self.client.service.runTransaction(**data)
+            resp = client.service.runTransaction(**data)
         except Exception:
             logger.exception("Failed to run Cybersource Advanced Fraud Screen Service on Order {}".format(order.number))
             resp = None
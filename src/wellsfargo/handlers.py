@@ -1,7 +1,12 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from oscarapicheckout.signals import order_payment_authorized
 from .api.views import PREQUAL_SESSION_KEY
-from .models import PreQualificationResponse
+from .core.credentials import resolver as credentials_resolver
+from .core.plans import catalog as plan_catalog
+from .models import APICredentials, FinancingPlan, PreQualificationResponse
 import logging
 
 logger = logging.getLogger(__name__)
@@ -28,3 +33,30 @@ def link_prequal_request_to_order(sender, request, order, **kwargs):
     request.session.get(PREQUAL_SESSION_KEY)
     del request.session[PREQUAL_SESSION_KEY]
     request.session.modified = True
+
+
+@receiver(post_save, sender=APICredentials)
+@receiver(post_delete, sender=APICredentials)
+def invalidate_api_credentials(sender, **kwargs):
+    """
+    When API credentials change, make every process reload its cached copy of the credentials table. Wait for the
+    commit, so that no process can reload the old rows under the new version.
+    """
+    transaction.on_commit(credentials_resolver.invalidate)
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def invalidate_api_credentials_group_membership(sender, action, **kwargs):
+    """When group membership changes, users may now be entitled to different API credentials"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(credentials_resolver.invalidate)
+
+
+@receiver(post_save, sender=FinancingPlan)
+@receiver(post_delete, sender=FinancingPlan)
+def invalidate_financing_plans(sender, **kwargs):
+    """
+    When financing plans change, make every process reload its cached copy of the plan catalog. Wait for the commit,
+    so that no process can reload the old plans under the new version.
+    """
+    transaction.on_commit(plan_catalog.invalidate)
@@ -0,0 +1,84 @@
+from decimal import Decimal, InvalidOperation
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from wellsfargo.core.plans import catalog as plan_catalog
+from wellsfargo.core.quotes import catalog as quote_catalog
+from wellsfargo.models import FinancingPlanPaymentQuote
+from wellsfargo.utils import CENTS, PaymentFactors, calculate_loan_cost
+import argparse
+import time
+
+
+def price_arg(value):
+    try:
+        value = Decimal(value).quantize(CENTS)
+    except InvalidOperation:
+        raise argparse.ArgumentTypeError('{} is not a valid price'.format(value))
+    if value <= 0:
+        raise argparse.ArgumentTypeError('Prices must be greater than zero')
+    return value
+
+
+class Command(BaseCommand):
+    help = (
+        "Precompute the monthly payment and total loan cost of every advertisable financing plan at each price from "
+        "--min-price to --max-price, in increments of --step. The estimated payment API and the get_payment_quote "
+        "template tag serve these instead of recalculating them. Run this again after changing financing plans."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--step', type=price_arg, default=Decimal('10.00'),
+            help='Difference between consecutive prices.')
+        parser.add_argument('--min-price', type=price_arg, default=None,
+            help='Lowest price to precompute. Defaults to --step.')
+        parser.add_argument('--max-price', type=price_arg, default=Decimal('10000.00'),
+            help='Highest price to precompute.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of quotes to insert per query.')
+
+
+    def handle(self, *args, **options):
+        step = options['step']
+        min_price = options['min_price'] or step
+        max_price = options['max_price']
+        if min_price > max_price:
+            raise CommandError('--min-price must not be greater than --max-price')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        started = time.monotonic()
+        prices = []
+        price = min_price
+        while price <= max_price:
+            prices.append(price)
+            price += step
+
+        plans = [plan for plan in plan_catalog.get_plans() if plan.advertising_enabled]
+        quotes = []
+        for plan in plans:
+            quotes.extend(self._build_quotes(plan, prices))
+
+        with transaction.atomic():
+            FinancingPlanPaymentQuote.objects.all().delete()
+            FinancingPlanPaymentQuote.objects.bulk_create(quotes, batch_size=options['batch_size'])
+        quote_catalog.invalidate()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('Precomputed {} payment quotes for {} plans at {} prices, in {:.1f}s'.format(
+            len(quotes), len(plans), len(prices), elapsed))
+
+
+    def _build_quotes(self, plan, prices):
+        # Prices below the plan's threshold never get advertised with it, so don't bother storing them
+        factors = PaymentFactors(plan.term_months, plan.apr)
+        for price in prices:
+            if price < plan.product_price_threshold:
+                continue
+            monthly_payment = factors.calculate_monthly_payments(price)
+            yield FinancingPlanPaymentQuote(
+                plan=plan,
+                apr=plan.apr,
+                term_months=plan.term_months,
+                price=price,
+                monthly_payment=monthly_payment.quantize(CENTS),
+                loan_cost=calculate_loan_cost(price, monthly_payment, plan.term_months))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+from wellsfargo.signals import process_index_queue
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Update the search index documents queued by wellsfargo.signals.QueuedSignalProcessor, --batch-size objects "
+        "at a time, until the queue is empty. With --forever, keep polling the queue every --interval seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--using', default='default',
+            help='Haystack connection to update.')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of queued objects to prepare and post to the search backend at a time.')
+        parser.add_argument('--forever', action='store_true', default=False,
+            help='Keep processing the queue as objects are added to it, rather than exiting once it is empty.')
+        parser.add_argument('--interval', type=float, default=5.0,
+            help='Seconds to wait before polling an empty queue again, with --forever.')
+
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        started = time.monotonic()
+        totals = {
+            'entries': 0,
+            'updated': 0,
+            'removed': 0,
+        }
+        while True:
+            counts = process_index_queue(using=options['using'], batch_size=options['batch_size'])
+            for key, count in counts.items():
+                totals[key] += count
+            # Don't let DEBUG query logging grow without bound in a long running worker
+            reset_queries()
+            if counts['entries']:
+                self.stdout.write('Updated {updated} and removed {removed} documents'.format(**counts))
+            if counts['entries'] < options['batch_size']:
+                if not options['forever']:
+                    break
+                time.sleep(options['interval'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('Processed {} queued objects in {:.1f}s ({:.0f} objects/s)'.format(
+            totals['entries'], elapsed, totals['entries'] / max(elapsed, 0.001)))
@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from wellsfargo.models import AccountNumberMixin
+from wellsfargo.security import (
+    decrypt_account_numbers,
+    encrypt_account_numbers,
+    account_number_needs_reencryption,
+)
+import json
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt stored account numbers using the primary encryptor in WFRS_SECURITY. Run this after rotating "
+        "keys with MultiEncryption, so that old blobs don't need to be decrypted with old keys forever."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models', default=[],
+            help='Model to re-encrypt, as app_label.ModelName. May be given more than once. Defaults to every model using AccountNumberMixin.')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of rows to re-encrypt per batch.')
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of batches to re-encrypt concurrently.')
+        parser.add_argument('--throttle', type=float, default=0,
+            help='Seconds for each worker to sleep after each batch.')
+        parser.add_argument('--checkpoint', default=None,
+            help='Path of a file in which to record progress. If the file exists, the job resumes from where it left off.')
+        parser.add_argument('--all', action='store_true', dest='reencrypt_all',
+            help='Re-encrypt every blob, even those which were already written by the primary encryptor.')
+
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.throttle = options['throttle']
+        self.reencrypt_all = options['reencrypt_all']
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = self._load_checkpoint()
+        for Model in self._get_models(options['models']):
+            self._reencrypt_model(Model)
+
+
+    def _get_models(self, labels):
+        if not labels:
+            return [m for m in apps.get_models() if issubclass(m, AccountNumberMixin)]
+        models = []
+        for label in labels:
+            try:
+                Model = apps.get_model(label)
+            except (LookupError, ValueError):
+                raise CommandError('Unknown model: {}'.format(label))
+            if not issubclass(Model, AccountNumberMixin):
+                raise CommandError('{} does not store encrypted account numbers'.format(label))
+            models.append(Model)
+        return models
+
+
+    def _reencrypt_model(self, Model):
+        label = Model._meta.label_lower
+        start_pk = self.checkpoint.get(label)
+        if start_pk is not None:
+            self.stdout.write('Resuming {} after pk {}'.format(label, start_pk))
+
+        # Batches are processed out of order when running in parallel, so only move the checkpoint past batches
+        # once every batch before them is done too.
+        pending = []
+        done = set()
+        totals = {'updated': 0, 'skipped': 0, 'failed': 0}
+        lock = threading.Lock()
+        started = time.monotonic()
+
+        def batch_done(bounds, counts):
+            with lock:
+                for key, value in counts.items():
+                    totals[key] += value
+                done.add(bounds)
+                while pending and pending[0] in done:
+                    finished = pending.pop(0)
+                    done.discard(finished)
+                    self._save_checkpoint(label, finished[1])
+
+        if self.workers == 1:
+            for bounds in self._iter_batches(Model, start_pk):
+                pending.append(bounds)
+                batch_done(bounds, self._reencrypt_batch(Model, bounds))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = []
+                for bounds in self._iter_batches(Model, start_pk):
+                    with lock:
+                        pending.append(bounds)
+                    future = executor.submit(self._reencrypt_batch, Model, bounds)
+                    future.add_done_callback(lambda f, bounds=bounds: f.exception() or batch_done(bounds, f.result()))
+                    futures.append(future)
+                    # Don't queue up batches faster than the workers can process them
+                    while len(futures) >= self.workers * 2:
+                        futures.pop(0).result()
+                for future in futures:
+                    future.result()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('{}: re-encrypted {} rows, skipped {}, failed to decrypt {}, in {:.1f}s'.format(
+            label, totals['updated'], totals['skipped'], totals['failed'], elapsed))
+
+
+    def _iter_batches(self, Model, start_pk):
+        """Yield ``(after_pk, last_pk)`` bounds of each batch, using keyset pagination on the primary key"""
+        qs = Model._default_manager.filter(encrypted_account_number__isnull=False).order_by('pk')
+        after_pk = start_pk
+        while True:
+            page = qs if after_pk is None else qs.filter(pk__gt=after_pk)
+            pks = list(page.values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                return
+            yield (after_pk, pks[-1])
+            after_pk = pks[-1]
+
+
+    def _reencrypt_batch(self, Model, bounds):
+        after_pk, last_pk = bounds
+        try:
+            with transaction.atomic():
+                qs = Model._default_manager.filter(pk__lte=last_pk).order_by('pk')
+                if after_pk is not None:
+                    qs = qs.filter(pk__gt=after_pk)
+                objs = list(qs.select_for_update().only('pk', 'encrypted_account_number'))
+                counts = self._reencrypt_objects(Model, objs)
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+        if self.throttle:
+            time.sleep(self.throttle)
+        return counts
+
+
+    def _reencrypt_objects(self, Model, objs):
+        counts = {'updated': 0, 'skipped': 0, 'failed': 0}
+        objs = [obj for obj in objs if obj.encrypted_account_number]
+        if not self.reencrypt_all:
+            stale = [obj for obj in objs if account_number_needs_reencryption(obj.encrypted_account_number)]
+            counts['skipped'] = len(objs) - len(stale)
+            objs = stale
+        values = decrypt_account_numbers(obj.encrypted_account_number for obj in objs)
+        to_update = []
+        for obj, value in zip(objs, values):
+            if value is None:
+                logger.warning('Unable to decrypt account number for %s %s. Leaving it as is.', Model._meta.label, obj.pk)
+                counts['failed'] += 1
+                continue
+            to_update.append((obj, value))
+        blobs = encrypt_account_numbers(value for obj, value in to_update)
+        # Called inside the batch's transaction, so the rows are written together. Using update() rather than save()
+        # leaves modified_datetime alone and doesn't send signals.
+        for (obj, value), blob in zip(to_update, blobs):
+            obj.encrypted_account_number = blob
+            Model._default_manager.filter(pk=obj.pk).update(encrypted_account_number=blob)
+        counts['updated'] = len(to_update)
+        return counts
+
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path, 'r') as f:
+            return json.load(f)
+
+
+    def _save_checkpoint(self, label, pk):
+        self.checkpoint[label] = pk
+        if not self.checkpoint_path:
+            return
+        tmp_path = '{}.tmp'.format(self.checkpoint_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
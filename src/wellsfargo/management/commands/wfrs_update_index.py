@@ -0,0 +1,230 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, reset_queries
+from django.db.models import Min, Max
+from haystack import connections as haystack_connections
+from haystack.exceptions import NotHandled
+import json
+import os
+import time
+
+WFRS_INDEXED_MODELS = (
+    'wellsfargo.USCreditApp',
+    'wellsfargo.USJointCreditApp',
+    'wellsfargo.CACreditApp',
+    'wellsfargo.CAJointCreditApp',
+    'wellsfargo.TransferMetadata',
+    'wellsfargo.PreQualificationRequest',
+)
+
+
+def index_batch(using, label, after_pk, last_pk, batch_size):
+    """
+    Index the next (up to) ``batch_size`` rows of the given model whose primary keys are in ``(after_pk, last_pk]``,
+    posting them to the search backend in one request. Returns the number of rows indexed and the last primary key
+    indexed. This runs in the worker processes, so it only takes (and returns) simple, picklable values.
+    """
+    Model = apps.get_model(label)
+    index = haystack_connections[using].get_unified_index().get_index(Model)
+    backend = haystack_connections[using].get_backend()
+    qs = index.index_queryset(using=using).filter(pk__gt=after_pk, pk__lte=last_pk).order_by('pk')
+    objs = list(qs[:batch_size])
+    if objs:
+        backend.update(index, objs)
+    # Don't let DEBUG query logging grow without bound over a long reindex
+    reset_queries()
+    return len(objs), (objs[-1].pk if objs else last_pk)
+
+
+#: ID of the process whose search backend sessions were last reset by :func:`_index_batch_in_worker`
+_worker_pid = None
+
+
+def _index_batch_in_worker(using, label, after_pk, last_pk, batch_size):
+    """
+    Same as :func:`index_batch`, but first (once per worker process) stops the search backend from sharing the
+    parent process's sessions (e.g. HTTP connection pools). ``ProcessPoolExecutor`` only takes an ``initializer`` as
+    of Python 3.7, so this is done at the start of the first task each worker runs instead.
+    """
+    global _worker_pid
+    if _worker_pid != os.getpid():
+        haystack_connections[using].reset_sessions()
+        _worker_pid = os.getpid()
+    return index_batch(using, label, after_pk, last_pk, batch_size)
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the search index documents of WFRS models. Each model's rows are split into --shards ranges of "
+        "primary keys, which are indexed --batch-size rows at a time by a pool of --workers processes. Progress "
+        "through each shard is recorded in the --checkpoint file, so an interrupted reindex resumes where it left off. "
+        "The file is deleted once every model is fully indexed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models', default=[],
+            help='Model to reindex, as app_label.ModelName. May be given more than once. Defaults to every WFRS model with a search index.')
+        parser.add_argument('--using', default='default',
+            help='Haystack connection to update.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of rows to prepare and post to the search backend at a time.')
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes to index shards with.')
+        parser.add_argument('--shards', type=int, default=None,
+            help='Number of primary key ranges to split each model into. Defaults to --workers.')
+        parser.add_argument('--checkpoint', default=None,
+            help='Path of a file in which to record progress. If the file exists, the job resumes from where it left off. It is deleted once the job finishes.')
+
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        self.using = options['using']
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.num_shards = options['shards'] or self.workers
+        if self.num_shards < 1:
+            raise CommandError('--shards must be at least 1')
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = self._load_checkpoint()
+        if self.checkpoint and all(shard[2] for shards in self.checkpoint.values() for shard in shards):
+            # The checkpoint is deleted once the job finishes, unless it stopped just before that
+            self.stderr.write('Every shard in {} is already done, so starting over'.format(self.checkpoint_path))
+            self._clear_checkpoint()
+
+        labels = [self._get_label(label) for label in (options['models'] or WFRS_INDEXED_MODELS)]
+        plans = [(label, self._plan_shards(label)) for label in labels]
+
+        started = time.monotonic()
+        total = 0
+        executor = None
+        if self.workers > 1:
+            # Forked workers mustn't share the parent's database connections. The parent doesn't need them again
+            # until the pool is done.
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            for label, shards in plans:
+                total += self._index_model(executor, label, shards)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        # Every model is fully indexed, so running the command again should start over rather than resume
+        self._clear_checkpoint()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('Indexed {} rows in {:.1f}s ({:.0f} rows/s)'.format(total, elapsed, total / max(elapsed, 0.001)))
+
+
+    def _get_label(self, label):
+        try:
+            Model = apps.get_model(label)
+        except (LookupError, ValueError):
+            raise CommandError('Unknown model: {}'.format(label))
+        try:
+            haystack_connections[self.using].get_unified_index().get_index(Model)
+        except NotHandled:
+            raise CommandError('{} does not have a search index'.format(label))
+        return Model._meta.label_lower
+
+
+    def _plan_shards(self, label):
+        """
+        Split the primary keys of the model's index queryset into ``[after_pk, last_pk, done]`` shards, or pick up the
+        shards from the checkpoint (plus a new one for rows created since).
+        """
+        Model = apps.get_model(label)
+        index = haystack_connections[self.using].get_unified_index().get_index(Model)
+        bounds = index.index_queryset(using=self.using).order_by().aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+        min_pk, max_pk = bounds['min_pk'], bounds['max_pk']
+        if min_pk is not None and not isinstance(min_pk, int):
+            raise CommandError('{} does not have an integer primary key, so it cannot be sharded'.format(label))
+
+        shards = self.checkpoint.get(label)
+        if shards:
+            last_pk = max(shard[1] for shard in shards)
+            if max_pk is not None and max_pk > last_pk:
+                shards.append([last_pk, max_pk, False])
+            remaining = [shard for shard in shards if not shard[2]]
+            self.stdout.write('Resuming {}: {} of {} shards remaining'.format(label, len(remaining), len(shards)))
+            return shards
+
+        shards = []
+        if min_pk is not None:
+            size = -(-(max_pk - min_pk + 1) // self.num_shards)
+            after_pk = min_pk - 1
+            while after_pk < max_pk:
+                last_pk = min(after_pk + size, max_pk)
+                shards.append([after_pk, last_pk, False])
+                after_pk = last_pk
+        self._save_checkpoint(label, shards)
+        return shards
+
+
+    def _index_model(self, executor, label, shards):
+        started = time.monotonic()
+        total = 0
+        pending = [shard for shard in shards if not shard[2]]
+
+        def batch_done(shard, count, last_pk):
+            shard[0] = last_pk
+            shard[2] = count < self.batch_size or last_pk >= shard[1]
+            self._save_checkpoint(label, shards)
+            return count
+
+        if executor is None:
+            for shard in pending:
+                while not shard[2]:
+                    total += batch_done(shard, *index_batch(self.using, label, shard[0], shard[1], self.batch_size))
+        else:
+            # Each shard has at most one batch in flight, since the next one starts after the last row of this one
+            def submit(shard):
+                future = executor.submit(_index_batch_in_worker, self.using, label, shard[0], shard[1], self.batch_size)
+                futures[future] = shard
+
+            futures = {}
+            for shard in pending:
+                submit(shard)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard = futures.pop(future)
+                    total += batch_done(shard, *future.result())
+                    if not shard[2]:
+                        submit(shard)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('{}: indexed {} rows in {} shards, in {:.1f}s ({:.0f} rows/s)'.format(
+            label, total, len(shards), elapsed, total / max(elapsed, 0.001)))
+        return total
+
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path, 'r') as f:
+            return json.load(f)
+
+
+    def _save_checkpoint(self, label, shards):
+        self.checkpoint[label] = shards
+        self._write_checkpoint()
+
+
+    def _clear_checkpoint(self):
+        self.checkpoint = {}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+    def _write_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = '{}.tmp'.format(self.checkpoint_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
@@ -4,19 +4,41 @@ from oscar.core.loading import get_model
 from oscarapi.basket import operations
 from oscarapicheckout.methods import PaymentMethod, PaymentMethodSerializer
 from oscarapicheckout.states import Complete, Declined
-from requests.exceptions import Timeout, ConnectionError
-from .connector import actions
-from .core.constants import TRANS_DECLINED, TRANS_TYPE_AUTH, TRANS_TYPE_CANCEL_AUTH
+from requests.exceptions import Timeout, ConnectTimeout, ConnectionError
+from .connector import actions, retry
+from .core.constants import (
+    TRANS_DECLINED,
+    TRANS_VOID_NO_MATCH_FOUND,
+    TRANS_TYPE_AUTH,
+    TRANS_TYPE_CANCEL_AUTH,
+    TRANS_JOURNAL_APPROVED,
+    TRANS_JOURNAL_DECLINED,
+    TRANS_JOURNAL_UNKNOWN,
+    TRANS_JOURNAL_NOT_SENT,
+    TRANS_JOURNAL_CANCELED,
+)
 from .core.structures import TransactionRequest
 from .core import exceptions
 from .utils import list_plans_for_basket
-from .models import FraudScreenResult, FinancingPlan, TransferMetadata
+from .models import FraudScreenResult, FinancingPlan, TransferMetadata, TransactionJournalEntry
 from .fraud import screen_transaction
-from .settings import WFRS_MAX_TRANSACTION_ATTEMPTS
+from .settings import (
+    WFRS_MAX_TRANSACTION_ATTEMPTS,
+    WFRS_CHECKOUT_PREPARE_CONCURRENTLY,
+    WFRS_CHECKOUT_MAX_WORKERS,
+    WFRS_CHECKOUT_DEADLINE,
+)
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
+import threading
 import logging
+import uuid
 
 logger = logging.getLogger(__name__)
 
+_executor = None
+_executor_lock = threading.Lock()
+
 Transaction = get_model('payment', 'Transaction')
 Source = get_model('payment', 'Source')
 
@@ -72,6 +94,7 @@ class WellsFargo(PaymentMethod):
             logger.warning('Failed to void WFRS transaction for Order[{}]. Reason: {}'.format(order.number, str(e)))
 
 
+    @retry.deadline(WFRS_CHECKOUT_DEADLINE)
     def _record_payment(self, request, order, method_key, amount, reference, account_number, financing_plan, **kwargs):
         # Build a transaction request
         trans_request = self._build_trans_request(
@@ -89,6 +112,16 @@ class WellsFargo(PaymentMethod):
             amount=amount,
             type_code=TRANS_TYPE_CANCEL_AUTH)
 
+        # Figure out which WFRS credentials to use based on the user
+        request_user = None
+        if request.user and request.user.is_authenticated:
+            request_user = request.user
+
+        # Optionally, prepare the WFRS transaction in the background while the fraud screen runs
+        prepared_future = None
+        if WFRS_CHECKOUT_PREPARE_CONCURRENTLY:
+            prepared_future = _get_executor().submit(_prepare_transaction, trans_request, request_user)
+
         # If Fraud Screening is enabled, run it and see if the transaction passes muster.
         fraud_response = screen_transaction(request, order)
 
@@ -100,10 +133,13 @@ class WellsFargo(PaymentMethod):
             logger.info('WFRS transaction for Order[{}] failed fraud screen. Reason: {}'.format(order.number, fraud_response.message))
             return Declined(amount, source_id=source.pk)
 
-        # Figure out which WFRS credentials to use based on the user
-        request_user = None
-        if request.user and request.user.is_authenticated:
-            request_user = request.user
+        # Collect the prepared transaction. If preparing it failed, submit_transaction will just do the work itself.
+        prepared = None
+        if prepared_future is not None:
+            try:
+                prepared = prepared_future.result()
+            except Exception:
+                logger.exception('Failed to prepare WFRS transaction for Order[{}] ahead of time.'.format(order.number))
 
         # Perform an authorization with WFRS
         try:
@@ -111,7 +147,8 @@ class WellsFargo(PaymentMethod):
                 trans_request=trans_request,
                 cancel_trans_request=cancel_trans_request,
                 current_user=request_user,
-                transaction_uuid=fraud_response.reference)
+                transaction_uuid=fraud_response.reference,
+                prepared=prepared)
         except (exceptions.TransactionDenied, ValidationError) as e:
             logger.info('WFRS transaction failed for Order[{}]. Reason: {}'.format(order.number, str(e)))
             source._create_transaction(
@@ -134,25 +171,81 @@ class WellsFargo(PaymentMethod):
         return Complete(source.amount_allocated, source_id=source.pk)
 
 
-    def _perform_auth_transaction(self, trans_request, cancel_trans_request, current_user, transaction_uuid, max_attempts=WFRS_MAX_TRANSACTION_ATTEMPTS):
+    def _perform_auth_transaction(self, trans_request, cancel_trans_request, current_user, transaction_uuid,
+                                  max_attempts=WFRS_MAX_TRANSACTION_ATTEMPTS, prepared=None):
+        # Every attempt uses the same UUID, so that they can all be traced back to the same journal entry
+        transaction_uuid = transaction_uuid or uuid.uuid1()
+        journal = TransactionJournalEntry.open(transaction_uuid, trans_request)
+
+        # If this transaction was already approved (e.g. by an earlier request), don't send it again
+        transfer = journal.find_approved_transfer()
+        if transfer is not None:
+            logger.info('WFRS transaction for Order[{}] was already approved.'.format(trans_request.ticket_number))
+            journal.record(TRANS_JOURNAL_APPROVED, transfer)
+            return transfer
+
+        policy = retry.get_policy('transaction')
         exc = None
         for i in range(max_attempts):
+            # Back off before trying again, unless that would run past the checkout deadline
+            if i > 0 and not policy.sleep(i):
+                break
+
             # Try to submit the transaction
+            journal.record_attempt()
             try:
-                transfer = actions.submit_transaction(trans_request, current_user=current_user, transaction_uuid=transaction_uuid)
-                return transfer
+                transfer = actions.submit_transaction(trans_request, current_user=current_user, transaction_uuid=transaction_uuid, prepared=prepared)
+            except (exceptions.TransactionDenied, ValidationError):
+                journal.record(TRANS_JOURNAL_DECLINED)
+                raise
 
             # If the transaction times out for some reason, cancel it and then try again.
             except (Timeout, ConnectionError) as e:
                 exc = e
                 logger.warning('WFRS transaction failed for Order[{}]: {}'.format(trans_request.ticket_number, e))
-                actions.submit_transaction(cancel_trans_request, current_user=current_user, transaction_uuid=transaction_uuid, persist=False)
-                logger.warning('Canceled transaction for Order[{}] due to previous error.'.format(trans_request.ticket_number))
+                # If the request never reached WFRS, there's nothing to cancel
+                if isinstance(e, ConnectTimeout):
+                    journal.record(TRANS_JOURNAL_NOT_SENT)
+                    continue
+                # If a concurrent attempt at the same transaction was approved, use that rather than canceling it
+                transfer = journal.find_approved_transfer()
+                if transfer is not None:
+                    journal.record(TRANS_JOURNAL_APPROVED, transfer)
+                    return transfer
+                journal.record(TRANS_JOURNAL_UNKNOWN)
+                if not self._cancel_auth_transaction(cancel_trans_request, current_user, transaction_uuid, prepared):
+                    # We don't know whether the authorization is still outstanding, so resubmitting could authorize twice.
+                    break
+                journal.record(TRANS_JOURNAL_CANCELED)
+                continue
+
+            journal.record(TRANS_JOURNAL_APPROVED, transfer)
+            return transfer
 
         # We couldn't perform the transaction successfully in the allotted time, so bubble up the last exception thrown.
         raise exc
 
 
+    def _cancel_auth_transaction(self, cancel_trans_request, current_user, transaction_uuid, prepared=None):
+        """Cancel an authorization which may or may not have gone through. Returns ``False`` if the outcome is unknown."""
+        try:
+            # Leaving an authorization outstanding is worse than overrunning the checkout deadline
+            with retry.deadline(None):
+                actions.submit_transaction(cancel_trans_request, current_user=current_user, transaction_uuid=transaction_uuid, persist=False, prepared=prepared)
+        except exceptions.TransactionDenied as e:
+            # If WFRS didn't find a matching authorization, it never went through
+            if getattr(e, 'status', None) != TRANS_VOID_NO_MATCH_FOUND:
+                logger.warning('Failed to cancel WFRS transaction for Order[{}]: {}'.format(cancel_trans_request.ticket_number, e))
+                return False
+            logger.warning('WFRS had nothing to cancel for Order[{}].'.format(cancel_trans_request.ticket_number))
+        except (Timeout, ConnectionError, ValidationError) as e:
+            logger.warning('Failed to cancel WFRS transaction for Order[{}]: {}'.format(cancel_trans_request.ticket_number, e))
+            return False
+        else:
+            logger.warning('Canceled transaction for Order[{}] due to previous error.'.format(cancel_trans_request.ticket_number))
+        return True
+
+
     def _build_trans_request(self, order, account_number, plan_number, amount, type_code=TRANS_TYPE_AUTH):
         trans_request = TransactionRequest()
         trans_request.type_code = type_code
@@ -162,3 +255,22 @@ class WellsFargo(PaymentMethod):
         trans_request.amount = amount
         trans_request.ticket_number = order.number
         return trans_request
+
+
+
+def _get_executor():
+    """Get the (lazily built, process-wide) thread pool used to prepare WFRS transactions during checkout"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=WFRS_CHECKOUT_MAX_WORKERS)
+    return _executor
+
+
+def _prepare_transaction(trans_request, current_user):
+    try:
+        return actions.prepare_transaction(trans_request, current_user=current_user)
+    finally:
+        # This runs outside of the request / response cycle, so clean up this thread's DB connection ourselves
+        close_old_connections()
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.1 on 2026-10-18 17:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wellsfargo', '0029_auto_20190401_1233'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinancingPlanPaymentQuote',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('apr', models.DecimalField(decimal_places=2, max_digits=5, verbose_name='Annual percentage rate')),
+                ('term_months', models.PositiveSmallIntegerField(verbose_name='Term Length (months)')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Price')),
+                ('monthly_payment', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Monthly Payment')),
+                ('loan_cost', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Loan Cost')),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_quotes', to='wellsfargo.FinancingPlan')),
+            ],
+            options={
+                'ordering': ('plan', 'price'),
+                'unique_together': {('plan', 'price')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.1 on 2026-10-18 18:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wellsfargo', '0030_financingplanpaymentquote'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionJournalEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_uuid', models.CharField(max_length=128, verbose_name='Transaction UUID')),
+                ('type_code', models.CharField(choices=[('5', 'Authorization for Future Charge'), ('7', 'Cancel Existing Authorization'), ('4', 'Return or Credit'), ('9', 'Time-out Reversal for Return or Credit'), ('VS', 'Void Sale'), ('VR', 'Void Return')], max_length=2, verbose_name='Transaction Type')),
+                ('ticket_number', models.CharField(blank=True, max_length=12, null=True, verbose_name='Ticket Number')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('APPROVED', 'Approved'), ('DECLINED', 'Declined'), ('UNKNOWN', 'Unknown'), ('NOT_SENT', 'Not Sent'), ('CANCELED', 'Canceled')], default='PENDING', max_length=8, verbose_name='State')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('created_datetime', models.DateTimeField(auto_now_add=True)),
+                ('modified_datetime', models.DateTimeField(auto_now=True)),
+                ('transfer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='journal_entries', to='wellsfargo.TransferMetadata', verbose_name='Transfer')),
+            ],
+            options={
+                'verbose_name_plural': 'Transaction journal entries',
+                'unique_together': {('transaction_uuid', 'type_code')},
+            },
+        ),
+    ]
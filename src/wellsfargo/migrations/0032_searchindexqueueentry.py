@@ -0,0 +1,28 @@
+# Generated by Django 2.2.1 on 2026-10-18 18:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('wellsfargo', '0031_transactionjournalentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchIndexQueueEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('created_datetime', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'Search index queue entries',
+                'unique_together': {('content_type', 'object_id')},
+            },
+        ),
+    ]
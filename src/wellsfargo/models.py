@@ -4,7 +4,7 @@ from django.contrib.auth.models import Group
 from django.core import signing, exceptions
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, prefetch_related_objects
 from django.urls import reverse
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
@@ -17,6 +17,10 @@ from .core.constants import (
     TRANS_TYPE_AUTH,
     TRANS_TYPES,
     TRANS_STATUSES,
+    TRANS_APPROVED,
+    TRANS_JOURNAL_PENDING,
+    TRANS_JOURNAL_APPROVED,
+    TRANS_JOURNAL_STATES,
     INQUIRY_STATUSES,
     EN_US,
     PREQUAL_LOCALE_CHOICES,
@@ -37,8 +41,10 @@ from .core.applications import (
     CACreditAppMixin,
     CAJointCreditAppMixin,
 )
+from .core.credentials import resolver as credentials_resolver
+from .core.plans import catalog as plan_catalog
 from .core.fields import USStateField, USZipCodeField
-from .security import encrypt_account_number, decrypt_account_number
+from .security import encrypt_account_number, decrypt_account_number, decrypt_account_numbers
 import logging
 import uuid
 import urllib.parse
@@ -72,15 +78,11 @@ class APICredentials(models.Model):
 
     @classmethod
     def get_credentials(cls, user=None):
-        if user and user.is_authenticated:
-            creds = cls.objects.filter(user_group__in=user.groups.all()).first()
-            if creds:
-                return creds
-        creds = cls.objects.filter(user_group=None).first()
-        if creds:
-            return creds
-        logger.error('Application requested WFRS API Credentials for use by user {}, but none exist in the database for them.'.format(user))
-        return cls()
+        """
+        Get the highest priority credentials belonging to one of the user's groups, falling back to the highest
+        priority credentials with no group. Resolved from a cached copy of the credentials table.
+        """
+        return credentials_resolver.get_credentials(user)
 
 
     def __str__(self):
@@ -118,14 +120,12 @@ class FinancingPlan(models.Model):
 
     @classmethod
     def get_advertisable_plan_by_price(cls, price):
-        plan = cls.objects\
-            .exclude(term_months=0)\
-            .filter(advertising_enabled=True)\
-            .filter(product_price_threshold__gte='0.00')\
-            .filter(product_price_threshold__lte=price)\
-            .order_by('-product_price_threshold', '-apr')\
-            .first()
-        return plan
+        return plan_catalog.get_advertisable_plan_by_price(price)
+
+
+    @classmethod
+    def get_advertisable_plans_by_price(cls, price):
+        return plan_catalog.get_advertisable_plans_by_price(price)
 
 
     def __str__(self):
@@ -138,6 +138,49 @@ class FinancingPlan(models.Model):
 
 
 
+class FinancingPlanPaymentQuote(models.Model):
+    """
+    A precomputed monthly payment and total loan cost for a financing plan at a particular price, built by the
+    ``wfrs_precompute_payment_quotes`` management command. The plan's APR and term at the time are recorded too, so
+    that quotes for a plan which has since been changed are ignored rather than served.
+    """
+    plan = models.ForeignKey(FinancingPlan,
+        related_name='payment_quotes',
+        on_delete=models.CASCADE)
+    apr = models.DecimalField(_("Annual percentage rate"), max_digits=5, decimal_places=2)
+    term_months = models.PositiveSmallIntegerField(_("Term Length (months)"))
+    price = models.DecimalField(_("Price"), decimal_places=2, max_digits=12)
+    monthly_payment = models.DecimalField(_("Monthly Payment"), decimal_places=2, max_digits=12)
+    loan_cost = models.DecimalField(_("Loan Cost"), decimal_places=2, max_digits=12)
+
+    class Meta:
+        ordering = ('plan', 'price')
+        unique_together = ('plan', 'price')
+
+
+    def __str__(self):
+        return "%s at %s" % (self.plan, self.price)
+
+
+
+def prefetch_financing_plans(benefits):
+    """
+    Fetch the plans for every one of the given :class:`FinancingPlanBenefit` instances in one query, rather than one
+    query per benefit
+    """
+    benefits = list(benefits)
+    prefetch_related_objects(benefits, 'plans')
+    return benefits
+
+
+
+class FinancingPlanBenefitQuerySet(models.QuerySet):
+    def with_plans(self):
+        """Fetch the plans for every benefit in one extra query when the queryset is evaluated"""
+        return self.prefetch_related('plans')
+
+
+
 class FinancingPlanBenefit(Benefit):
     """
     A group of WFRS plan numbers made available to a customer as the applied benefit of an offer or voucher. This
@@ -146,6 +189,8 @@ class FinancingPlanBenefit(Benefit):
     group_name = models.CharField(_('Name'), max_length=200)
     plans = models.ManyToManyField(FinancingPlan)
 
+    objects = FinancingPlanBenefitQuerySet.as_manager()
+
     class Meta(Benefit.Meta):
         app_label = 'wellsfargo'
 
@@ -210,10 +255,48 @@ class FraudScreenResult(models.Model):
 
 
 
+def prefetch_account_numbers(objs):
+    """
+    Decrypt the account numbers of the given :class:`AccountNumberMixin` instances in a single bulk operation, so
+    that reading ``obj.account_number`` afterwards doesn't decrypt them one at a time.
+    """
+    objs = [obj for obj in objs if isinstance(obj, AccountNumberMixin)]
+    values = decrypt_account_numbers(obj.encrypted_account_number for obj in objs)
+    for obj, value in zip(objs, values):
+        obj._decrypted_account_number = value
+    return objs
+
+
+
+class AccountNumberQuerySet(models.QuerySet):
+    _with_account_numbers = False
+
+    def with_account_numbers(self):
+        """Decrypt account numbers for every row in bulk when the queryset is evaluated"""
+        clone = self._clone()
+        clone._with_account_numbers = True
+        return clone
+
+    def _clone(self, **kwargs):
+        # Django < 2.0 passes attributes to set on the clone as keyword arguments
+        clone = super()._clone(**kwargs)
+        clone._with_account_numbers = self._with_account_numbers
+        return clone
+
+    def _fetch_all(self):
+        needs_decrypt = self._result_cache is None
+        super()._fetch_all()
+        if needs_decrypt and self._with_account_numbers:
+            prefetch_account_numbers(self._result_cache)
+
+
+
 class AccountNumberMixin(models.Model):
     last4_account_number = models.CharField(_("Last 4 digits of account number"), max_length=4)
     encrypted_account_number = models.BinaryField(null=True)
 
+    objects = AccountNumberQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
@@ -224,7 +307,9 @@ class AccountNumberMixin(models.Model):
     @property
     def account_number(self):
         acct_num = None
-        if self.encrypted_account_number:
+        if hasattr(self, '_decrypted_account_number'):
+            acct_num = self._decrypted_account_number
+        elif self.encrypted_account_number:
             acct_num = decrypt_account_number(self.encrypted_account_number)
         if not acct_num:
             acct_num = self.masked_account_number
@@ -232,13 +317,19 @@ class AccountNumberMixin(models.Model):
 
     @account_number.setter
     def account_number(self, value):
+        self.set_account_number(value)
+
+    def set_account_number(self, value, encrypted_account_number=None):
+        """Set the account number. Pass ``encrypted_account_number`` if it has already been encrypted, to avoid encrypting it again."""
         if len(value) != 16:
             raise ValueError('Account number must be 16 digits long')
         self.last4_account_number = value[-4:]
-        self.encrypted_account_number = encrypt_account_number(value)
+        self.encrypted_account_number = encrypted_account_number or encrypt_account_number(value)
+        self._decrypted_account_number = value
 
     def purge_encrypted_account_number(self):
         self.encrypted_account_number = None
+        self._decrypted_account_number = None
         self.save()
 
 
@@ -343,6 +434,111 @@ class TransferMetadata(AccountNumberMixin, models.Model):
 
 
 
+def get_order_merchant_names(orders):
+    """
+    Get the name of the merchant whose API credentials authorized the WFRS payment of each of the given orders, as a
+    dict keyed by order ID. Orders without a WFRS authorization are left out; ones authorized without credentials map
+    to ``None``. This takes two queries, no matter how many orders there are.
+    """
+    from .methods import WellsFargo
+    Transaction = get_model('payment', 'Transaction')
+    order_ids = {order.pk for order in orders}
+    if not order_ids:
+        return {}
+    # Same precedence as looking up each source's auth transactions (newest first), in turn, with get_by_oscar_transaction
+    transactions = Transaction.objects.filter(source__order_id__in=order_ids)\
+                                      .filter(source__source_type__name=WellsFargo.name)\
+                                      .filter(txn_type=Transaction.AUTHORISE)\
+                                      .order_by('source_id', '-date_created')\
+                                      .values_list('source__order_id', 'reference')
+    transactions = list(transactions)
+    if not transactions:
+        return {}
+    transfers = TransferMetadata.objects.filter(merchant_reference__in={reference for order_id, reference in transactions})\
+                                        .filter(type_code=TRANS_TYPE_AUTH)\
+                                        .order_by('-created_datetime')\
+                                        .values_list('merchant_reference', 'credentials__name')
+    latest = {}
+    for reference, merchant_name in transfers:
+        latest.setdefault(reference, merchant_name)
+    merchant_names = {}
+    for order_id, reference in transactions:
+        if order_id not in merchant_names and reference in latest:
+            merchant_names[order_id] = latest[reference]
+    return merchant_names
+
+
+
+class TransactionJournalEntry(models.Model):
+    """
+    Tracks the state of a WFRS transaction, keyed by the UUID sent to WFRS with it (the fraud screen reference, during
+    checkout) and its type. Each attempt is recorded before the request is sent, so that a retry can tell whether an
+    earlier attempt already went through, rather than blindly canceling and resubmitting it.
+    """
+    transaction_uuid = models.CharField(_("Transaction UUID"), max_length=128)
+    type_code = models.CharField(_("Transaction Type"), choices=TRANS_TYPES, max_length=2)
+    ticket_number = models.CharField(_("Ticket Number"), null=True, blank=True, max_length=12)
+    amount = models.DecimalField(decimal_places=2, max_digits=12)
+    state = models.CharField(_("State"),
+        choices=TRANS_JOURNAL_STATES,
+        max_length=_max_len(TRANS_JOURNAL_STATES),
+        default=TRANS_JOURNAL_PENDING)
+    attempts = models.PositiveSmallIntegerField(_("Attempts"), default=0)
+    transfer = models.ForeignKey(TransferMetadata,
+        verbose_name=_("Transfer"),
+        related_name='journal_entries',
+        null=True, blank=True,
+        on_delete=models.SET_NULL)
+    created_datetime = models.DateTimeField(auto_now_add=True)
+    modified_datetime = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('transaction_uuid', 'type_code')
+        verbose_name_plural = _('Transaction journal entries')
+
+
+    @classmethod
+    def open(cls, transaction_uuid, trans_request):
+        """Get the journal entry for the given transaction, creating it if this is the first time it's been seen"""
+        entry, created = cls.objects.get_or_create(
+            transaction_uuid=str(transaction_uuid),
+            type_code=trans_request.type_code,
+            defaults={
+                'ticket_number': trans_request.ticket_number,
+                'amount': trans_request.amount,
+            })
+        return entry
+
+
+    @property
+    def state_name(self):
+        return dict(TRANS_JOURNAL_STATES).get(self.state)
+
+
+    def find_approved_transfer(self):
+        """Find an approved transfer for this transaction, recorded by this or any earlier attempt"""
+        if self.state == TRANS_JOURNAL_APPROVED and self.transfer_id:
+            return self.transfer
+        return TransferMetadata.objects.filter(merchant_reference=self.transaction_uuid)\
+                                       .filter(type_code=self.type_code, status=TRANS_APPROVED)\
+                                       .order_by('-created_datetime')\
+                                       .first()
+
+
+    def record_attempt(self):
+        """Record that the transaction is about to be sent to WFRS"""
+        self.attempts += 1
+        self.record(TRANS_JOURNAL_PENDING)
+
+
+    def record(self, state, transfer=None):
+        self.state = state
+        if transfer is not None:
+            self.transfer = transfer
+        self.save(update_fields=['state', 'attempts', 'transfer', 'modified_datetime'])
+
+
+
 class CreditAppCommonMixin(models.Model):
     status = models.CharField(_('Application Status'),
         max_length=_max_len(CREDIT_APP_STATUSES),
@@ -381,8 +577,14 @@ class CreditAppCommonMixin(models.Model):
         return self.inquiries.order_by('-created_datetime').all()
 
 
+    def get_latest_inquiry(self):
+        if not hasattr(self, '_latest_inquiry_cache'):
+            self._latest_inquiry_cache = self.get_inquiries().first()
+        return self._latest_inquiry_cache
+
+
     def get_credit_limit(self):
-        inquiry = self.get_inquiries().first()
+        inquiry = self.get_latest_inquiry()
         if not inquiry:
             return None
         return inquiry.credit_limit
@@ -580,6 +782,13 @@ class PreQualificationResponse(models.Model):
             merchant_num=merchant_num)
 
 
+    @cached_property
+    def order_merchant_name(self):
+        if not self.customer_order_id:
+            return None
+        return get_order_merchant_names([self.customer_order]).get(self.customer_order_id)
+
+
     def check_account_status(self):
         from .connector import actions
         return actions.check_pre_qualification_account_status(self)
@@ -597,3 +806,21 @@ class PreQualificationSDKApplicationResult(models.Model):
     application_status = models.CharField(_("Application Status"), max_length=20)
     created_datetime = models.DateTimeField(auto_now_add=True)
     modified_datetime = models.DateTimeField(auto_now=True)
+
+
+
+class SearchIndexQueueEntry(models.Model):
+    """
+    A search index document waiting to be updated, queued by :class:`wellsfargo.signals.QueuedSignalProcessor` when
+    its object is saved or deleted. There's at most one entry per object, so saving it many times before the queue is
+    processed only updates its document once.
+    """
+    content_type = models.ForeignKey(ContentType,
+        related_name='+',
+        on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    created_datetime = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+        verbose_name_plural = _('Search index queue entries')
@@ -1,18 +1,183 @@
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.db.models.query import QuerySet, ModelIterable
 from haystack import indexes
 from oscar.core.loading import get_model
-from .methods import WellsFargo
 from .models import (
+    AccountInquiryResult,
     TransferMetadata,
     USCreditApp,
     USJointCreditApp,
     CACreditApp,
     CAJointCreditApp,
     PreQualificationRequest,
+    PreQualificationResponse,
+    PreQualificationSDKApplicationResult,
+    get_order_merchant_names,
 )
 
 
+Order = get_model('order', 'Order')
+Source = get_model('payment', 'Source')
 Transaction = get_model('payment', 'Transaction')
 
+ORDER_MERCHANT_NAME_ATTR = '_wfrs_merchant_name'
+
+
+class BatchPreparedQuerySet(QuerySet):
+    """
+    QuerySet returned by ``index_queryset``. Haystack evaluates it one chunk (``HAYSTACK_BATCH_SIZE`` rows) at a time
+    when updating an index, and each time it does, the whole chunk is passed to :meth:`prefetch_index_data`. That
+    fetches the related data which the index's ``prepare_*`` methods would otherwise query for one row at a time.
+    """
+    def prefetch_index_data(self, objs):
+        pass
+
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if not fetched and self._iterable_class is ModelIterable:
+            self.prefetch_index_data(self._result_cache)
+
+
+
+class CreditAppIndexQuerySet(BatchPreparedQuerySet):
+    def prefetch_index_data(self, apps):
+        prefetch_credit_app_index_data(apps)
+
+
+
+class PreQualificationIndexQuerySet(BatchPreparedQuerySet):
+    def prefetch_index_data(self, prequals):
+        prefetch_prequal_index_data(prequals)
+
+
+
+def prefetch_credit_app_index_data(apps):
+    """
+    Fetch the latest inquiry and first order of each of the given credit applications, and the merchant name of each
+    of those orders, with a fixed number of queries (rather than several per application). They're cached on the
+    applications, where :meth:`get_latest_inquiry`, :meth:`get_first_order` and :class:`BaseCreditAppIndex` find them.
+    """
+    apps = list(apps)
+    if apps:
+        _prefetch_latest_inquiries(apps)
+        _prefetch_first_orders(apps)
+        prefetch_order_merchant_names([app._first_order_cache for app in apps if app._first_order_cache is not None])
+    return apps
+
+
+def prefetch_prequal_index_data(prequals):
+    """
+    Find the resulting order of each of the given pre-qualification requests, and the merchant name of each of those
+    orders, with a fixed number of queries. Requests must have their ``response`` and its ``customer_order`` selected.
+    """
+    prequals = list(prequals)
+    if prequals:
+        _prefetch_resulting_orders(prequals)
+        prefetch_order_merchant_names([p.resulting_order for p in prequals if p.resulting_order is not None])
+    return prequals
+
+
+def prefetch_order_merchant_names(orders):
+    """Resolve the merchant name of each of the given orders at once, and cache it on the order"""
+    merchant_names = get_order_merchant_names(orders)
+    for order in orders:
+        setattr(order, ORDER_MERCHANT_NAME_ATTR, merchant_names.get(order.pk))
+
+
+def get_order_merchant_name(order):
+    if not order:
+        return None
+    if not hasattr(order, ORDER_MERCHANT_NAME_ATTR):
+        prefetch_order_merchant_names([order])
+    return getattr(order, ORDER_MERCHANT_NAME_ATTR)
+
+
+def _prefetch_latest_inquiries(apps):
+    apps_by_type = defaultdict(list)
+    for app in apps:
+        apps_by_type[ContentType.objects.get_for_model(app)].append(app)
+    for content_type, group in apps_by_type.items():
+        latest = {}
+        inquiries = AccountInquiryResult.objects.filter(credit_app_type=content_type)\
+                                                .filter(credit_app_id__in=[app.pk for app in group])\
+                                                .order_by('-created_datetime')
+        for inquiry in inquiries:
+            latest.setdefault(inquiry.credit_app_id, inquiry)
+        for app in group:
+            app._latest_inquiry_cache = latest.get(app.pk)
+
+
+def _prefetch_first_orders(apps):
+    # Same matching rules as CreditAppCommonMixin.get_orders, applied to every application at once: orders placed
+    # (after the application) by the application's email address, paid for by a transfer using its account's last 4.
+    last4s = {app.last4_account_number for app in apps if app.last4_account_number}
+    emails = {app.email for app in apps}
+    first_order_ids = {}
+    if last4s:
+        transfers = TransferMetadata.objects.filter(last4_account_number__in=last4s)
+        candidates = Order.objects.filter(Q(guest_email__in=emails) | Q(user__email__in=emails))\
+                                  .filter(sources__transactions__reference__in=transfers.values('merchant_reference'))\
+                                  .filter(date_placed__gte=min(app.created_datetime for app in apps))\
+                                  .values_list('pk', 'date_placed', 'guest_email', 'user__email', 'sources__transactions__reference')\
+                                  .distinct()
+        candidates_by_email = defaultdict(list)
+        for candidate in candidates:
+            candidates_by_email[candidate[2]].append(candidate)
+            if candidate[3] != candidate[2]:
+                candidates_by_email[candidate[3]].append(candidate)
+        last4s_by_reference = defaultdict(set)
+        references = {candidate[4] for candidate in candidates}
+        if references:
+            rows = transfers.filter(merchant_reference__in=references)\
+                            .values_list('merchant_reference', 'last4_account_number')\
+                            .distinct()
+            for reference, last4 in rows:
+                last4s_by_reference[reference].add(last4)
+        for app in apps:
+            matches = [(date_placed, pk) for pk, date_placed, guest_email, user_email, reference in candidates_by_email[app.email]
+                       if date_placed >= app.created_datetime and app.last4_account_number in last4s_by_reference[reference]]
+            if matches:
+                first_order_ids[app.pk] = min(matches)[1]
+    orders = Order.objects.in_bulk(set(first_order_ids.values())) if first_order_ids else {}
+    for app in apps:
+        app._first_order_cache = orders.get(first_order_ids.get(app.pk))
+
+
+def _prefetch_resulting_orders(prequals):
+    # Same matching rules as PreQualificationRequest.resulting_order, applied to every request at once. Requests
+    # without an email address are left for the property to resolve.
+    pending = []
+    for prequal in prequals:
+        response = getattr(prequal, 'response', None)
+        if response and response.customer_order:
+            prequal.resulting_order = response.customer_order
+        elif prequal.email:
+            pending.append(prequal)
+    if not pending:
+        return
+    candidates = Order.objects.filter(Q(guest_email__in={p.email for p in pending}) | Q(user__email__in={p.email for p in pending}))\
+                              .filter(date_placed__gt=min(p.created_datetime for p in pending))\
+                              .order_by('date_placed', 'pk')\
+                              .values_list('pk', 'date_placed', 'guest_email', 'user__email')
+    candidates_by_email = defaultdict(list)
+    for pk, date_placed, guest_email, user_email in candidates:
+        candidates_by_email[guest_email].append((date_placed, pk))
+        if user_email != guest_email:
+            candidates_by_email[user_email].append((date_placed, pk))
+    order_ids = {}
+    for prequal in pending:
+        matches = [pk for date_placed, pk in candidates_by_email[prequal.email] if date_placed > prequal.created_datetime]
+        if matches:
+            order_ids[prequal.pk] = matches[0]
+    orders = Order.objects.in_bulk(set(order_ids.values())) if order_ids else {}
+    for prequal in pending:
+        prequal.resulting_order = orders.get(order_ids.get(prequal.pk))
+
+
 
 class BaseCreditAppIndex(indexes.SearchIndex):
     APP_TYPE_CODE = indexes.CharField(model_attr='APP_TYPE_CODE')
@@ -52,9 +217,9 @@ class BaseCreditAppIndex(indexes.SearchIndex):
         return 'modified_datetime'
 
     def index_queryset(self, using=None):
-        qs = self.get_model().objects\
-                             .select_related('credentials', 'user', 'submitting_user')\
-                             .all()
+        qs = CreditAppIndexQuerySet(self.get_model())\
+            .select_related('credentials', 'user', 'submitting_user')\
+            .all()
         return qs
 
     def prepare_merchant_name(self, obj):
@@ -73,19 +238,7 @@ class BaseCreditAppIndex(indexes.SearchIndex):
         return order.total_incl_tax
 
     def prepare_order_merchant_name(self, obj):
-        order = obj.get_first_order()
-        if not order:
-            return None
-        transfers = []
-        for source in order.sources.filter(source_type__name=WellsFargo.name).all():
-            for transaction in source.transactions.filter(txn_type=Transaction.AUTHORISE).all():
-                transfer = TransferMetadata.get_by_oscar_transaction(transaction)
-                if transfer:
-                    transfers.append(transfer)
-        if len(transfers) <= 0:
-            return None
-        credentials = transfers[0].credentials
-        return credentials.name if credentials else None
+        return get_order_merchant_name(obj.get_first_order())
 
     def prepare_order_placed(self, obj):
         order = obj.get_first_order()
@@ -233,9 +386,9 @@ class PreQualificationIndex(indexes.SearchIndex, indexes.Indexable):
             'response__customer_order',
             'response__sdk_application_result'
         ]
-        qs = self.get_model().objects\
-                             .select_related(*_related)\
-                             .all()
+        qs = PreQualificationIndexQuerySet(self.get_model())\
+            .select_related(*_related)\
+            .all()
         return qs
 
     def prepare_merchant_name(self, obj):
@@ -278,16 +431,118 @@ class PreQualificationIndex(indexes.SearchIndex, indexes.Indexable):
         return obj.resulting_order.date_placed if obj.resulting_order else None
 
     def prepare_order_merchant_name(self, obj):
-        order = obj.resulting_order
-        if not order:
-            return None
-        transfers = []
-        for source in order.sources.filter(source_type__name=WellsFargo.name).all():
-            for transaction in source.transactions.filter(txn_type=Transaction.AUTHORISE).all():
-                transfer = TransferMetadata.get_by_oscar_transaction(transaction)
-                if transfer:
-                    transfers.append(transfer)
-        if len(transfers) <= 0:
-            return None
-        credentials = transfers[0].credentials
-        return credentials.name if credentials else None
+        return get_order_merchant_name(obj.resulting_order)
+
+
+
+def get_order_dependents(orders):
+    """
+    Find the search documents which show data from the given orders: the credit applications whose first order each
+    might be, the pre-qualification requests each might have resulted from and the transfers which paid for them.
+    Returns a dict mapping each indexed model to a set of primary keys.
+    """
+    return _get_order_dependents({order.pk for order in orders})
+
+
+def get_transaction_dependents(transactions):
+    # A payment transaction ties an order to the transfer which paid for it. Most aren't WFRS transactions.
+    references = {transaction.reference for transaction in transactions if transaction.reference}
+    if not references or not TransferMetadata.objects.filter(merchant_reference__in=references).exists():
+        return {}
+    sources = Source.objects.filter(pk__in={transaction.source_id for transaction in transactions})
+    return _get_order_dependents(set(sources.values_list('order_id', flat=True)))
+
+
+def get_transfer_dependents(transfers):
+    sources = Source.objects.filter(transactions__reference__in={transfer.merchant_reference for transfer in transfers})
+    return _get_order_dependents(set(sources.values_list('order_id', flat=True)))
+
+
+def get_inquiry_dependents(inquiries):
+    dependents = defaultdict(set)
+    for inquiry in inquiries:
+        if not inquiry.credit_app_type_id or not inquiry.credit_app_id:
+            continue
+        AppModel = ContentType.objects.get_for_id(inquiry.credit_app_type_id).model_class()
+        if AppModel is not None:
+            dependents[AppModel].add(inquiry.credit_app_id)
+    return dependents
+
+
+def get_prequal_response_dependents(responses):
+    return {
+        PreQualificationRequest: {response.request_id for response in responses},
+    }
+
+
+def get_sdk_application_result_dependents(results):
+    responses = PreQualificationResponse.objects.filter(pk__in={result.prequal_response_id for result in results})
+    return {
+        PreQualificationRequest: set(responses.values_list('request_id', flat=True)),
+    }
+
+
+def get_deleted_sdk_application_result_dependents(results):
+    # The response's request is only found when the queue is processed, since the result is gone by then
+    return {
+        PreQualificationResponse: {result.prequal_response_id for result in results},
+    }
+
+
+def _get_order_dependents(order_ids):
+    # The inverse of the matching rules in CreditAppCommonMixin.get_orders and PreQualificationRequest.resulting_order
+    dependents = defaultdict(set)
+    order_ids.discard(None)
+    if not order_ids:
+        return dependents
+    references = Transaction.objects.filter(source__order_id__in=order_ids).values('reference')
+    transfers = TransferMetadata.objects.filter(merchant_reference__in=references)\
+                                        .values_list('pk', 'last4_account_number')
+    last4s = set()
+    for pk, last4 in transfers:
+        dependents[TransferMetadata].add(pk)
+        if last4:
+            last4s.add(last4)
+    emails = set()
+    last_placed = None
+    orders = Order.objects.filter(pk__in=order_ids).values_list('guest_email', 'user__email', 'date_placed')
+    for guest_email, user_email, date_placed in orders:
+        emails.update(email for email in (guest_email, user_email) if email)
+        if date_placed and (last_placed is None or date_placed > last_placed):
+            last_placed = date_placed
+    if emails and last4s and last_placed:
+        for AppModel in (USCreditApp, USJointCreditApp, CACreditApp, CAJointCreditApp):
+            apps = AppModel.objects.filter(email__in=emails)\
+                                   .filter(last4_account_number__in=last4s)\
+                                   .filter(created_datetime__lte=last_placed)
+            dependents[AppModel].update(apps.values_list('pk', flat=True))
+    # Requests linked to an order result in that one, others in the first order placed with their email address after them
+    linked = Q(response__customer_order_id__in=order_ids)
+    if emails and last_placed:
+        linked |= Q(email__in=emails, created_datetime__lt=last_placed, response__customer_order=None)
+    dependents[PreQualificationRequest].update(PreQualificationRequest.objects.filter(linked).values_list('pk', flat=True))
+    return dependents
+
+
+# Models which aren't indexed themselves (or not only), but whose changes affect other models' search documents,
+# mapped to a function which finds the affected documents for a list of instances. QueuedSignalProcessor only queues
+# the changed objects, and wfrs_process_index_queue uses these to find the affected documents, a batch at a time.
+INDEX_DEPENDENCIES = {
+    Order: get_order_dependents,
+    Transaction: get_transaction_dependents,
+    TransferMetadata: get_transfer_dependents,
+    AccountInquiryResult: get_inquiry_dependents,
+    PreQualificationResponse: get_prequal_response_dependents,
+    PreQualificationSDKApplicationResult: get_sdk_application_result_dependents,
+}
+
+
+# The deleted instances of the models above can't be looked up when the queue is processed, so
+# QueuedSignalProcessor instead queues what these functions find from their own field values, without querying.
+# Deleting other dependencies (e.g. orders) doesn't update the documents which showed data from them until they're
+# next updated for another reason, or rebuilt with wfrs_update_index.
+INDEX_DELETE_DEPENDENCIES = {
+    AccountInquiryResult: get_inquiry_dependents,
+    PreQualificationResponse: get_prequal_response_dependents,
+    PreQualificationSDKApplicationResult: get_deleted_sdk_application_result_dependents,
+}
@@ -1,6 +1,12 @@
 from django.core.exceptions import ImproperlyConfigured
+from ..core.utils import freeze
 from ..settings import WFRS_SECURITY
 import importlib
+import threading
+
+#: Cache of encryptor instances, keyed by their (frozen) configuration
+_encryptors = {}
+_encryptors_lock = threading.RLock()
 
 
 def encrypt_account_number(account_number):
@@ -15,12 +21,91 @@ def decrypt_account_number(encrypted):
     return _get_encryptor(klass, kwargs).decrypt(encrypted)
 
 
+def decrypt_account_numbers(blobs):
+    """
+    Decrypt many account numbers at once. Returns a list of account numbers, in the same order as the given blobs.
+    Blobs which are empty or can't be decrypted result in ``None``. Encryptors which implement ``decrypt_many``
+    (e.g. to parallelize network calls) are given all of the non-empty blobs in a single call.
+    """
+    klass = WFRS_SECURITY['encryptor']
+    kwargs = WFRS_SECURITY.get('encryptor_kwargs', {})
+    return _decrypt_many(_get_encryptor(klass, kwargs), blobs)
+
+
+def encrypt_account_numbers(account_numbers):
+    """
+    Encrypt many account numbers at once using the primary encryptor. Returns a list of blobs, in the same order as
+    the given account numbers.
+    """
+    klass = WFRS_SECURITY['encryptor']
+    kwargs = WFRS_SECURITY.get('encryptor_kwargs', {})
+    return _encrypt_many(_get_encryptor(klass, kwargs), account_numbers)
+
+
+def account_number_needs_reencryption(blob):
+    """
+    Return ``True`` if the given blob wasn't written by the primary encryptor, and so should be re-encrypted after a
+    key rotation. Encryptors which can't tell (i.e. don't implement ``is_current``) always report ``True``.
+    """
+    if not blob:
+        return False
+    klass = WFRS_SECURITY['encryptor']
+    kwargs = WFRS_SECURITY.get('encryptor_kwargs', {})
+    encryptor = _get_encryptor(klass, kwargs)
+    if hasattr(encryptor, 'is_current'):
+        return not encryptor.is_current(blob)
+    return True
+
+
+def reset_encryptors():
+    """
+    Discard all cached encryptor instances, so that they're rebuilt from configuration on next use. Call this after
+    rotating keys or changing ``WFRS_SECURITY`` at runtime (e.g. in tests).
+    """
+    with _encryptors_lock:
+        _encryptors.clear()
+
+
 def _get_encryptor(klass, kwargs):
-    Encryptor = _load_cls_from_abs_path(klass)
-    encryptor = Encryptor(**kwargs)
+    """
+    Get the encryptor instance for the given class path and keyword arguments. Encryptors (and whatever they set up
+    in their constructors, like boto3 clients or Fernet key schedules) are built once per process and then reused.
+    """
+    key = freeze((klass, kwargs))
+    encryptor = _encryptors.get(key)
+    if encryptor is None:
+        with _encryptors_lock:
+            encryptor = _encryptors.get(key)
+            if encryptor is None:
+                Encryptor = _load_cls_from_abs_path(klass)
+                encryptor = Encryptor(**kwargs)
+                _encryptors[key] = encryptor
     return encryptor
 
 
+def _encrypt_many(encryptor, values):
+    values = list(values)
+    if hasattr(encryptor, 'encrypt_many'):
+        return encryptor.encrypt_many(values)
+    return [encryptor.encrypt(value) for value in values]
+
+
+def _decrypt_many(encryptor, blobs):
+    blobs = list(blobs)
+    results = [None] * len(blobs)
+    indexes = [i for i, blob in enumerate(blobs) if blob]
+    if not indexes:
+        return results
+    to_decrypt = [blobs[i] for i in indexes]
+    if hasattr(encryptor, 'decrypt_many'):
+        values = encryptor.decrypt_many(to_decrypt)
+    else:
+        values = [encryptor.decrypt(blob) for blob in to_decrypt]
+    for i, value in zip(indexes, values):
+        results[i] = value
+    return results
+
+
 def _load_cls_from_abs_path(path):
     pkgname, fnname = path.rsplit('.', 1)
     try:
@@ -1,5 +1,8 @@
 from cryptography.fernet import Fernet, InvalidToken
 from django.utils.encoding import force_bytes, force_text
+import base64
+import hashlib
+import hmac
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,8 +24,19 @@ class FernetEncryption(object):
     The given key should be a URL-safe base64-encoded 32-byte encryption key and should obviously
     not be hard-coded in the application.
     """
+    KEY_ID_LABEL = b'wellsfargo.security.fernet.key_id'
+
     def __init__(self, key):
         self.fernet = Fernet(key=key)
+        # A Fernet key is a 128-bit signing key followed by a 128-bit encryption key
+        self._signing_key = base64.urlsafe_b64decode(force_bytes(key))[:16]
+
+    def get_key_id(self):
+        """
+        Return a public identifier of the key, used e.g. to tag blobs in MultiEncryption. It's an HMAC of a fixed
+        label under the key's signing key, so it reveals no more about the key than the HMAC in every Fernet token.
+        """
+        return hmac.new(self._signing_key, self.KEY_ID_LABEL, hashlib.sha256).hexdigest()
 
     def encrypt(self, value):
         """Accept a string and return binary data"""
@@ -38,3 +52,18 @@ class FernetEncryption(object):
             logger.warning('Unable to decrypt account number blob.')
             return None
         return force_text(value)
+
+    def decrypt_many(self, blobs):
+        """Accept a list of binary data and return a list of strings (or ``None`` for blobs which can't be decrypted)"""
+        decrypt = self.fernet.decrypt
+        values = []
+        failures = 0
+        for blob in blobs:
+            try:
+                values.append(force_text(decrypt(force_bytes(blob))))
+            except InvalidToken:
+                values.append(None)
+                failures += 1
+        if failures:
+            logger.warning('Unable to decrypt %s of %s account number blobs.', failures, len(values))
+        return values
@@ -1,8 +1,16 @@
+from collections import OrderedDict
 from django.utils.encoding import force_bytes, force_text, DjangoUnicodeDecodeError
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import boto3
 import base64
 import binascii
+import os
+import struct
+import threading
+import time
 
 
 class KMSEncryption(object):
@@ -30,18 +38,60 @@ class KMSEncryption(object):
     - Key alias Name: alias/MyAliasName
     - Globally Unique Key ID: 12345678-1234-1234-1234-123456789012
 
+    When decrypting many blobs at once, up to ``max_workers`` KMS requests are made concurrently.
+
+    Envelope encryption:
+
+    By default every call to ``encrypt`` and ``decrypt`` is a round trip to KMS. Setting ``envelope=True``
+    instead encrypts values locally (AES-256-GCM) using a data key generated by KMS. The KMS-wrapped copy of the data
+    key is stored alongside each ciphertext. The plaintext data key is cached in memory and reused for up to
+    ``data_key_max_age`` seconds or ``data_key_max_uses`` encryptions, whichever comes first. Unwrapped data keys
+    are likewise cached (up to ``data_key_cache_size`` of them, for ``data_key_max_age`` seconds) when decrypting, so
+    steady-state encryption and decryption don't call KMS at all. Blobs written without envelope encryption can
+    still be decrypted in envelope mode (and vice versa), so the mode can be switched without re-encrypting data.
+
+    WFRS_SECURITY = {
+        'encryptor': 'wellsfargo.security.kms.KMSEncryption',
+        'encryptor_kwargs': {
+            'key_id': 'alias/MyAliasName',
+            'envelope': True,
+            'data_key_max_age': 300,
+            'data_key_max_uses': 10000,
+        },
+    }
+
     For details, see `the boto3 docs <https://boto3.readthedocs.io/en/latest/reference/services/kms.html#KMS.Client.encrypt>`_.
     """
-    def __init__(self, key_id, **kwargs):
+    ENVELOPE_PREFIX = b'env1:'
+
+    def __init__(self, key_id, max_workers=8, envelope=False, data_key_max_age=300, data_key_max_uses=10000, data_key_cache_size=100, **kwargs):
         self.key_id = key_id
+        self.max_workers = max_workers
+        self.envelope = envelope
+        self.data_key_max_age = data_key_max_age
+        self.data_key_max_uses = data_key_max_uses
+        self.data_key_cache_size = data_key_cache_size
         self.encryption_context = kwargs.pop('encryption_context', {})
         self.client = boto3.client('kms', **kwargs)
+        # Data key used for encryption: (plaintext key, wrapped key, created time, use count)
+        self._data_key = None
+        # Wrapped key => (plaintext key, created time), for decryption
+        self._unwrapped_keys = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get_key_id(self):
+        """Return a public identifier of the key (its ID, ARN or alias), used e.g. to tag blobs in MultiEncryption"""
+        return self.key_id
 
 
     def encrypt(self, value):
         """Accept a string and return binary data"""
         value = force_bytes(value)
 
+        if self.envelope:
+            return self._envelope_encrypt(value)
+
         response = self.client.encrypt(
             KeyId=self.key_id,
             Plaintext=value,
@@ -55,6 +105,9 @@ class KMSEncryption(object):
     def decrypt(self, blob):
         """Accept binary data and return a string"""
         blob = force_bytes(blob)
+        if blob.startswith(self.ENVELOPE_PREFIX):
+            return self._envelope_decrypt(blob)
+
         try:
             blob = base64.b64decode(blob)
         except binascii.Error:
@@ -76,3 +129,103 @@ class KMSEncryption(object):
             except DjangoUnicodeDecodeError:
                 pass
         return plain_text
+
+
+    def decrypt_many(self, blobs):
+        """Accept a list of binary data and return a list of strings, decrypting concurrently"""
+        blobs = list(blobs)
+        if len(blobs) <= 1:
+            return [self.decrypt(blob) for blob in blobs]
+        # boto3 clients are thread-safe, so the worker threads can share ours
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(blobs))) as executor:
+            return list(executor.map(self.decrypt, blobs))
+
+
+    def encrypt_many(self, values):
+        """Accept a list of strings and return a list of binary data, encrypting concurrently (unless using envelope encryption)"""
+        values = list(values)
+        if self.envelope or len(values) <= 1:
+            return [self.encrypt(value) for value in values]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(values))) as executor:
+            return list(executor.map(self.encrypt, values))
+
+
+    def _envelope_encrypt(self, value):
+        plain_key, wrapped_key = self._get_data_key()
+        nonce = os.urandom(12)
+        ciphertext = AESGCM(plain_key).encrypt(nonce, value, None)
+        payload = struct.pack('>H', len(wrapped_key)) + wrapped_key + nonce + ciphertext
+        return self.ENVELOPE_PREFIX + base64.b64encode(payload)
+
+
+    def _envelope_decrypt(self, blob):
+        try:
+            payload = base64.b64decode(blob[len(self.ENVELOPE_PREFIX):])
+            key_len, = struct.unpack('>H', payload[:2])
+            wrapped_key = payload[2:2 + key_len]
+            nonce = payload[2 + key_len:14 + key_len]
+            ciphertext = payload[14 + key_len:]
+        except (binascii.Error, struct.error):
+            return None
+
+        plain_key = self._unwrap_data_key(wrapped_key)
+        if plain_key is None:
+            return None
+
+        try:
+            value = AESGCM(plain_key).decrypt(nonce, ciphertext, None)
+        except (InvalidTag, ValueError):
+            return None
+        try:
+            return force_text(value)
+        except DjangoUnicodeDecodeError:
+            return None
+
+
+    def _get_data_key(self):
+        """Return the current (plaintext, wrapped) data key, generating a new one from KMS if it's expired or used up"""
+        with self._lock:
+            now = time.monotonic()
+            if self._data_key is not None:
+                plain_key, wrapped_key, created, uses = self._data_key
+                if (now - created) < self.data_key_max_age and uses < self.data_key_max_uses:
+                    self._data_key = (plain_key, wrapped_key, created, uses + 1)
+                    return plain_key, wrapped_key
+            response = self.client.generate_data_key(
+                KeyId=self.key_id,
+                KeySpec='AES_256',
+                EncryptionContext=self.encryption_context)
+            plain_key, wrapped_key = response['Plaintext'], response['CiphertextBlob']
+            self._data_key = (plain_key, wrapped_key, now, 1)
+            self._cache_unwrapped_key(wrapped_key, plain_key, now)
+            return plain_key, wrapped_key
+
+
+    def _unwrap_data_key(self, wrapped_key):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._unwrapped_keys.get(wrapped_key)
+            if cached is not None and (now - cached[1]) < self.data_key_max_age:
+                self._unwrapped_keys.move_to_end(wrapped_key)
+                return cached[0]
+        try:
+            response = self.client.decrypt(
+                CiphertextBlob=wrapped_key,
+                EncryptionContext=self.encryption_context)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidCiphertextException':
+                return None
+            raise e
+        plain_key = response.get('Plaintext')
+        if not plain_key:
+            return None
+        with self._lock:
+            self._cache_unwrapped_key(wrapped_key, plain_key, now)
+        return plain_key
+
+
+    def _cache_unwrapped_key(self, wrapped_key, plain_key, now):
+        self._unwrapped_keys[wrapped_key] = (plain_key, now)
+        self._unwrapped_keys.move_to_end(wrapped_key)
+        while len(self._unwrapped_keys) > self.data_key_cache_size:
+            self._unwrapped_keys.popitem(last=False)
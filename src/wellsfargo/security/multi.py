@@ -1,4 +1,8 @@
-from . import _get_encryptor
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_bytes
+from . import _get_encryptor, _encrypt_many, _decrypt_many
+import hashlib
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
@@ -33,25 +37,118 @@ class MultiEncryption(object):
     }
 
     All new data will be encrypted using the first encryption method supplied in the
-    ``encryptors`` keyword-argument. When decrypting data, each method in the ``encryptors``
-    will be attempted (in-order) until one successfully decrypts the data or until the
-    list is exhausted.
+    ``encryptors`` keyword-argument, and is prefixed with a short tag identifying that
+    method (e.g. ``$3f9c0a1d$``). When decrypting tagged data, the matching method is used
+    directly. Untagged (legacy) data, or data whose tag doesn't match any configured method,
+    is decrypted by attempting each method in the ``encryptors`` (in-order) until one
+    successfully decrypts the data or until the list is exhausted. The number of blobs which
+    needed this fallback is counted in ``fallback_count``, which should drop to zero once old
+    data has been re-encrypted.
+
+    By default, each method's tag is derived from the public identifier of its key, as returned
+    by the encryptor's ``get_key_id()`` method (the KMS key ID, or a fingerprint of the Fernet
+    key), so changing other options (e.g. ``max_workers``) doesn't change it. A tag can also be
+    given explicitly with a ``key_id`` entry alongside ``encryptor`` and ``encryptor_kwargs``,
+    which is required for encryptors without a ``get_key_id()`` method. Set ``tag_blobs`` to ``False`` to write untagged data (e.g. while
+    older application versions, which can't read tags, are still running).
     """
-    def __init__(self, encryptors):
+    TAG_DELIMITER = b'$'
+
+    def __init__(self, encryptors, tag_blobs=True):
         self.encryptors = encryptors
+        self.tag_blobs = tag_blobs
+        self.children = [_get_encryptor(e['encryptor'], e.get('encryptor_kwargs', {})) for e in encryptors]
+        self.tags = [self._get_tag(e, child) for e, child in zip(encryptors, self.children)]
+        self.children_by_tag = {}
+        for tag, encryptor in zip(self.tags, self.children):
+            self.children_by_tag.setdefault(tag, encryptor)
+        self.fallback_count = 0
+        self._fallback_lock = threading.Lock()
 
     def encrypt(self, value):
         """Accept a string and return binary data"""
-        klass = self.encryptors[0]['encryptor']
-        kwargs = self.encryptors[0].get('encryptor_kwargs', {})
-        return _get_encryptor(klass, kwargs).encrypt(value)
+        blob = self.children[0].encrypt(value)
+        if not self.tag_blobs:
+            return blob
+        return self.TAG_DELIMITER + self.tags[0] + self.TAG_DELIMITER + force_bytes(blob)
+
+    def encrypt_many(self, values):
+        """Accept a list of strings and return a list of binary data"""
+        blobs = _encrypt_many(self.children[0], values)
+        if not self.tag_blobs:
+            return blobs
+        prefix = self.TAG_DELIMITER + self.tags[0] + self.TAG_DELIMITER
+        return [prefix + force_bytes(blob) for blob in blobs]
+
+    def is_current(self, blob):
+        """Return ``True`` if the given blob was written by the primary encryptor (and so doesn't need re-encrypting)"""
+        tag, _ = self._split_tag(blob)
+        return tag is not None and tag == self.tags[0]
 
     def decrypt(self, blob):
         """Accept binary data and return a string"""
-        for encryptor in self.encryptors:
-            klass = encryptor['encryptor']
-            kwargs = encryptor.get('encryptor_kwargs', {})
-            value = _get_encryptor(klass, kwargs).decrypt(blob)
+        tag, blob = self._split_tag(blob)
+        encryptor = self.children_by_tag.get(tag)
+        if encryptor is not None:
+            return encryptor.decrypt(blob)
+        self._count_fallbacks(1)
+        for encryptor in self.children:
+            value = encryptor.decrypt(blob)
             if value is not None:
                 return value
         return None
+
+    def decrypt_many(self, blobs):
+        """Accept a list of binary data and return a list of strings"""
+        blobs = [self._split_tag(blob) for blob in blobs]
+        values = [None] * len(blobs)
+
+        # Decrypt tagged blobs using the encryptor which made them
+        by_tag = {}
+        remaining = []
+        for i, (tag, blob) in enumerate(blobs):
+            if tag in self.children_by_tag:
+                by_tag.setdefault(tag, []).append(i)
+            else:
+                remaining.append(i)
+        for tag, indexes in by_tag.items():
+            results = _decrypt_many(self.children_by_tag[tag], [blobs[i][1] for i in indexes])
+            for i, value in zip(indexes, results):
+                values[i] = value
+
+        # Fall back to trying each encryptor in turn on legacy blobs
+        if remaining:
+            self._count_fallbacks(len(remaining))
+        for encryptor in self.children:
+            if not remaining:
+                break
+            results = _decrypt_many(encryptor, [blobs[i][1] for i in remaining])
+            for i, value in zip(remaining, results):
+                values[i] = value
+            remaining = [i for i, value in zip(remaining, results) if value is None]
+        return values
+
+    def _split_tag(self, blob):
+        """Split a blob into its tag (or ``None``, for legacy blobs) and the encrypted data"""
+        blob = force_bytes(blob)
+        if blob.startswith(self.TAG_DELIMITER):
+            end = blob.find(self.TAG_DELIMITER, 1)
+            if end > 0:
+                return blob[1:end], blob[end + 1:]
+        return None, blob
+
+    def _get_tag(self, config, encryptor):
+        if config.get('key_id'):
+            tag = force_bytes(config['key_id'])
+            if self.TAG_DELIMITER in tag:
+                raise ImproperlyConfigured('Encryptor key_id {} must not contain {}'.format(config['key_id'], self.TAG_DELIMITER))
+            return tag
+        if not hasattr(encryptor, 'get_key_id'):
+            raise ImproperlyConfigured('Encryptor {} does not identify its key, so it needs a key_id'.format(config['encryptor']))
+        # Only the key's identity, which is public, so that other options can change without changing the tag
+        return force_bytes(hashlib.sha256(force_bytes(encryptor.get_key_id())).hexdigest()[:8])
+
+    def _count_fallbacks(self, count):
+        with self._fallback_lock:
+            self.fallback_count += count
+        logger.debug('Decrypting %s untagged account number blob(s) by trial decryption.', count)
@@ -27,6 +27,18 @@ WFRS_PRE_QUAL_WSDL = overridable('WFRS_PRE_QUAL_WSDL', 'https://retailservices-u
 # SOAP service for checking account pre-qualification application status (the status of an account after the user was pre-qualified)
 WFRS_OTB_WSDL = overridable('WFRS_OTB_WSDL', 'https://retailservices-uat.wellsfargo.com/services/WFRS_SubmitOTBService?WSDL')
 
+# Maximum age (in seconds) of a pooled SOAP client before it's rebuilt from its WSDL. ``None`` means clients never expire.
+WFRS_SOAP_CLIENT_MAX_AGE = overridable('WFRS_SOAP_CLIENT_MAX_AGE', None)
+
+# Build the SOAP clients for every WFRS service when the app loads, rather than during the first request that needs each one.
+WFRS_SOAP_CLIENT_WARM_UP = overridable('WFRS_SOAP_CLIENT_WARM_UP', False)
+
+# Maximum age (in seconds) of the in-process copies of the API credentials, financing plan and payment quote tables.
+# Changes are normally picked up by every process as soon as they're made, via a version key in the Django cache, but
+# only if that cache is shared between processes. This bounds how long a process can serve stale data when it isn't.
+# ``None`` means no limit.
+WFRS_IN_PROCESS_CACHE_MAX_AGE = overridable('WFRS_IN_PROCESS_CACHE_MAX_AGE', 60)
+
 
 # Encryption settings (used to protect account numbers stored in the database)
 WFRS_SECURITY = {
@@ -52,3 +64,37 @@ WFRS_FRAUD_PROTECTION = {
 WFRS_FRAUD_PROTECTION.update( overridable('WFRS_FRAUD_PROTECTION', {}) )
 
 WFRS_MAX_TRANSACTION_ATTEMPTS = overridable('WFRS_MAX_TRANSACTION_ATTEMPTS', 2)
+
+# During checkout, prepare the WFRS transaction (credentials, SOAP client, financing plan and account number encryption)
+# on a background thread while the fraud screen runs, rather than after it.
+WFRS_CHECKOUT_PREPARE_CONCURRENTLY = overridable('WFRS_CHECKOUT_PREPARE_CONCURRENTLY', False)
+
+# Maximum number of threads (per process) used to prepare WFRS transactions concurrently with fraud screening.
+WFRS_CHECKOUT_MAX_WORKERS = overridable('WFRS_CHECKOUT_MAX_WORKERS', 4)
+
+# How long (in seconds) browsers and shared caches (e.g. a CDN) may cache responses from the estimated payment API.
+WFRS_ESTIMATED_PAYMENT_MAX_AGE = overridable('WFRS_ESTIMATED_PAYMENT_MAX_AGE', 300)
+
+# How long (in seconds) to keep computed estimated payment responses in the Django cache. Entries are keyed by the
+# financing plan catalog version, so changing a plan takes effect immediately. Set to ``0`` to disable.
+WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT = overridable('WFRS_ESTIMATED_PAYMENT_CACHE_TIMEOUT', 60 * 60)
+
+# Timeouts and retries for each kind of WFRS API call. ``timeout`` is a ``(connect, read)`` tuple in seconds (``None``
+# uses SOAP_SEND_TIMEOUT). Calls which time out while connecting are retried up to ``max_attempts`` times, backing off
+# exponentially (with jitter) from ``backoff`` to ``max_backoff`` seconds. Other failures are only retried for
+# ``idempotent`` operations. Authorizations are retried (and canceled) by the payment method itself, up to
+# WFRS_MAX_TRANSACTION_ATTEMPTS times, so the transaction policy makes a single attempt per call by default.
+WFRS_RETRY_POLICIES = {
+    'transaction': {'max_attempts': 1},
+    'inquiry': {'max_attempts': 3, 'idempotent': True},
+    'credit_app': {'max_attempts': 2},
+    'pre_qual': {'max_attempts': 2},
+    'otb': {'max_attempts': 3, 'idempotent': True},
+}
+for _operation, _overrides in overridable('WFRS_RETRY_POLICIES', {}).items():
+    WFRS_RETRY_POLICIES.setdefault(_operation, {}).update(_overrides)
+
+# Maximum time (in seconds) checkout may spend screening and authorizing a WFRS payment. WFRS calls made after it has
+# passed fail fast instead of tying up the worker. Canceling an authorization which may have gone through isn't bound
+# by it. Set to ``None`` to disable.
+WFRS_CHECKOUT_DEADLINE = overridable('WFRS_CHECKOUT_DEADLINE', 45)
@@ -0,0 +1,158 @@
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, models, transaction
+from haystack import connections as haystack_connections
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor
+from .models import SearchIndexQueueEntry
+from .search_indexes import INDEX_DEPENDENCIES, INDEX_DELETE_DEPENDENCIES
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Haystack signal processor which, instead of updating an object's search index document while the request that
+    saved (or deleted) it waits, adds the object to a queue of :class:`wellsfargo.models.SearchIndexQueueEntry` rows
+    once the transaction commits. The ``wfrs_process_index_queue`` management command then updates the queued
+    documents in batches. Use it by setting ``HAYSTACK_SIGNAL_PROCESSOR = 'wellsfargo.signals.QueuedSignalProcessor'``.
+
+    Changes to the models in :data:`wellsfargo.search_indexes.INDEX_DEPENDENCIES` (e.g. orders and pre-qualification
+    responses) affect the documents which show data from them. Saving one only queues the object itself, so the
+    request doesn't pay for finding those documents: :func:`process_index_queue` does that for a batch at a time.
+    Deleted objects can't be looked up later, so deleting one queues the documents which
+    :data:`wellsfargo.search_indexes.INDEX_DELETE_DEPENDENCIES` finds from its own field values, without querying.
+    """
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+
+
+    def handle_save(self, sender, instance, **kwargs):
+        if sender in INDEX_DEPENDENCIES or self.is_indexed(sender, instance):
+            enqueue_index_updates(sender, [instance.pk])
+
+
+    def handle_delete(self, sender, instance, **kwargs):
+        # Processing the queue removes the documents of objects which no longer exist
+        if self.is_indexed(sender, instance):
+            enqueue_index_updates(sender, [instance.pk])
+        get_dependents = INDEX_DELETE_DEPENDENCIES.get(sender)
+        if get_dependents is not None:
+            for Model, pks in get_dependents([instance]).items():
+                enqueue_index_updates(Model, pks)
+
+
+    def is_indexed(self, sender, instance):
+        for using in self.connection_router.for_write(instance=instance):
+            try:
+                self.connections[using].get_unified_index().get_index(sender)
+                return True
+            except NotHandled:
+                pass
+        return False
+
+
+
+def enqueue_index_updates(Model, pks):
+    """
+    Queue the search index documents of the given objects to be updated, once the current transaction (if any)
+    commits. Objects which are already queued aren't queued again.
+    """
+    content_type = ContentType.objects.get_for_model(Model)
+    keys = {(content_type.pk, pk) for pk in pks if pk is not None}
+    if not keys:
+        return
+    # Wait for the commit, so that the queue is never processed before the changes are visible to it
+    transaction.on_commit(lambda: _insert_queue_entries(keys))
+
+
+def _insert_queue_entries(keys):
+    """
+    Add a queue entry for each of the given ``(content_type_id, object_id)`` pairs which isn't already queued. (This
+    is what ``bulk_create(..., ignore_conflicts=True)`` does, but that needs Django 2.2.)
+    """
+    existing = SearchIndexQueueEntry.objects.filter(
+        content_type_id__in={content_type_id for content_type_id, object_id in keys},
+        object_id__in={object_id for content_type_id, object_id in keys})
+    keys = sorted(set(keys) - set(existing.values_list('content_type_id', 'object_id')))
+    if not keys:
+        return
+    entries = [SearchIndexQueueEntry(content_type_id=content_type_id, object_id=object_id) for content_type_id, object_id in keys]
+    try:
+        with transaction.atomic():
+            SearchIndexQueueEntry.objects.bulk_create(entries)
+        return
+    except IntegrityError:
+        pass
+    # Some were queued in the meantime (e.g. by another process), so skip those one by one
+    for content_type_id, object_id in keys:
+        try:
+            with transaction.atomic():
+                SearchIndexQueueEntry.objects.create(content_type_id=content_type_id, object_id=object_id)
+        except IntegrityError:
+            pass
+
+
+def process_index_queue(using='default', batch_size=500):
+    """
+    Update the search index documents of (up to) ``batch_size`` queued objects, posting each model's documents to the
+    search backend in one request, and remove the documents of objects which no longer exist (or are no longer in
+    their index's ``index_queryset``). Queued objects of the models in
+    :data:`wellsfargo.search_indexes.INDEX_DEPENDENCIES` are replaced by the documents which depend on them, found
+    with one lookup per model for the whole batch. Returns the number of entries processed and the number of
+    documents updated and removed.
+
+    Entries are claimed by deleting them before their objects are fetched, so a change committed after that is queued
+    again rather than lost. If the search backend fails, the claimed entries are put back before re-raising.
+    """
+    with transaction.atomic():
+        # Several workers may process the queue at once (on backends which support SKIP LOCKED)
+        entries = SearchIndexQueueEntry.objects.select_for_update(skip_locked=True).order_by('pk')[:batch_size]
+        entries = list(entries.values_list('pk', 'content_type_id', 'object_id'))
+        SearchIndexQueueEntry.objects.filter(pk__in=[pk for pk, content_type_id, object_id in entries]).delete()
+
+    queued = defaultdict(set)
+    for pk, content_type_id, object_id in entries:
+        queued[ContentType.objects.get_for_id(content_type_id).model_class()].add(object_id)
+
+    counts = {
+        'entries': len(entries),
+        'updated': 0,
+        'removed': 0,
+    }
+    unified_index = haystack_connections[using].get_unified_index()
+    backend = haystack_connections[using].get_backend()
+    try:
+        # Only the queued objects' own dependents, not those of the documents this adds
+        changed = [(Model, set(object_ids)) for Model, object_ids in queued.items() if Model in INDEX_DEPENDENCIES]
+        for Model, object_ids in changed:
+            instances = list(Model._default_manager.filter(pk__in=object_ids))
+            for DependentModel, pks in INDEX_DEPENDENCIES[Model](instances).items():
+                queued[DependentModel].update(pks)
+
+        for Model, object_ids in queued.items():
+            try:
+                index = unified_index.get_index(Model)
+            except NotHandled:
+                if Model not in INDEX_DEPENDENCIES:
+                    logger.warning('Discarding queued search index updates for {}, which is not indexed'.format(Model))
+                continue
+            objs = list(index.index_queryset(using=using).filter(pk__in=object_ids))
+            if objs:
+                backend.update(index, objs)
+            removed = object_ids - {obj.pk for obj in objs}
+            for object_id in removed:
+                backend.remove('{}.{}'.format(Model._meta.label_lower, object_id))
+            counts['updated'] += len(objs)
+            counts['removed'] += len(removed)
+    except Exception:
+        _insert_queue_entries([(content_type_id, object_id) for pk, content_type_id, object_id in entries])
+        raise
+    return counts
@@ -1,30 +1,38 @@
 from django import template
-from ..models import FinancingPlan
+from ..core.plans import catalog as plan_catalog
+from .. import utils
 
 register = template.Library()
 
 
 @register.simple_tag
 def get_default_plan():
-    return FinancingPlan.objects.filter(advertising_enabled=True, is_default_plan=True).first()
+    return plan_catalog.get_default_plan()
 
 
 @register.simple_tag
 def get_plan_for_product(request, product):
-    if product.is_parent:
-        purchase_info = request.strategy.fetch_for_parent(product)
-    else:
-        purchase_info = request.strategy.fetch_for_product(product)
-    if purchase_info.price.is_tax_known:
-        price = purchase_info.price.incl_tax
-    else:
-        price = purchase_info.price.excl_tax
-    return FinancingPlan.objects\
-        .filter(advertising_enabled=True)\
-        .filter(product_price_threshold__gte='0.00')\
-        .filter(product_price_threshold__lte=price)\
-        .order_by('-product_price_threshold')\
-        .first()
+    return utils.get_plan_for_product(request, product)
+
+
+@register.simple_tag
+def get_plans_for_products(request, products):
+    """
+    Get the plan to advertise for each of a list of products (e.g. on a category page) in one pass. Returns a list of
+    ``(product, plan)`` pairs. Later ``get_plan_for_product`` calls for the same products, in the same request, reuse
+    these results.
+    """
+    products = list(products)
+    return list(zip(products, utils.get_plans_for_products(request, products)))
+
+
+@register.simple_tag
+def get_payment_quote(plan, price):
+    """
+    Get the monthly payment and total loan cost for the given plan and price, as an object with ``monthly_payment``
+    and ``loan_cost`` attributes. Precomputed quotes are used where available.
+    """
+    return utils.get_payment_quote(plan, price)
 
 
 @register.simple_tag
@@ -2,11 +2,15 @@ from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 from wellsfargo.models import FinancingPlan
+from wellsfargo.tests.base import run_on_commit_immediately
+import json
+import mock
 
 
 class EstimatedPaymentsTest(APITestCase):
     """"""
     def setUp(self):
+        run_on_commit_immediately(self)
         self.maxDiff = None
         self.plan1 = FinancingPlan.objects.create(
             plan_number=1001,
@@ -84,3 +88,203 @@ class EstimatedPaymentsTest(APITestCase):
             "monthly_payment": "115.37",
             "loan_cost": "268.88"
         })
+
+
+
+class MultipleEstimatedPaymentsTest(APITestCase):
+    def setUp(self):
+        run_on_commit_immediately(self)
+        self.maxDiff = None
+        self.plan1 = FinancingPlan.objects.create(
+            plan_number=1001,
+            description='Plan 1',
+            apr='0.00',
+            term_months=12,
+            product_price_threshold='1000.00',
+            advertising_enabled=True)
+        self.plan2 = FinancingPlan.objects.create(
+            plan_number=1002,
+            description='Plan 2',
+            apr='10.00',
+            term_months=24,
+            product_price_threshold='2000.00',
+            advertising_enabled=True)
+        self.plan3 = FinancingPlan.objects.create(
+            plan_number=1003,
+            description='Plan 3',
+            apr='0.00',
+            term_months=0,
+            product_price_threshold='100.00',
+            advertising_enabled=True)
+
+
+    def _plan_data(self, plan):
+        return {
+            "id": plan.pk,
+            "plan_number": plan.plan_number,
+            "description": plan.description,
+            "fine_print_superscript": "",
+            "apr": plan.apr,
+            "term_months": plan.term_months,
+            "allow_credit_application": True,
+            "product_price_threshold": plan.product_price_threshold,
+        }
+
+
+    def test_estimate_many_prices(self):
+        url = reverse('wfrs-api-estimated-payments')
+        resp = self.client.get('{}?price=500.00&price=1500.00&price=2500'.format(url))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(json.dumps(resp.data))
+        self.assertEqual(data, [
+            {
+                "principal": "500.00",
+                "estimates": [],
+            },
+            {
+                "principal": "1500.00",
+                "estimates": [
+                    {
+                        "plan": self._plan_data(self.plan1),
+                        "principal": "1500.00",
+                        "monthly_payment": "125.00",
+                        "loan_cost": "0.00",
+                    },
+                ],
+            },
+            {
+                "principal": "2500.00",
+                "estimates": [
+                    {
+                        "plan": self._plan_data(self.plan2),
+                        "principal": "2500.00",
+                        "monthly_payment": "115.37",
+                        "loan_cost": "268.88",
+                    },
+                    {
+                        "plan": self._plan_data(self.plan1),
+                        "principal": "2500.00",
+                        "monthly_payment": "208.33",
+                        "loan_cost": "0.00",
+                    },
+                ],
+            },
+        ])
+
+
+    def test_estimate_many_prices_without_queries(self):
+        url = reverse('wfrs-api-estimated-payments')
+        self.client.get('{}?price=1500.00'.format(url))
+        prices = '&'.join('price={}.00'.format(p) for p in range(1000, 5000, 100))
+        with self.assertNumQueries(0):
+            resp = self.client.get('{}?{}'.format(url, prices))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.data), 40)
+
+
+    def test_estimate_many_prices_invalid(self):
+        url = reverse('wfrs-api-estimated-payments')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get('{}?price=1500.00&price=foo'.format(url))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get('{}?{}'.format(url, '&'.join(['price=1500.00'] * 101)))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_endpoints_validate_prices_alike(self):
+        for price in ('foo', '', '0', '0.001', '-1500.00', 'NaN', 'Infinity', '1e100'):
+            resp = self.client.get(reverse('wfrs-api-estimated-payment'), {'price': price})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, price)
+            resp = self.client.get(reverse('wfrs-api-estimated-payments'), {'price': price})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, price)
+        resp = self.client.get(reverse('wfrs-api-estimated-payment'), {'price': '1500.004'})
+        self.assertEqual(resp.data['principal'], '1500.00')
+        resp = self.client.get(reverse('wfrs-api-estimated-payments'), {'price': '1500.004'})
+        self.assertEqual(resp.data[0]['principal'], '1500.00')
+
+
+    def test_estimate_empty_basket(self):
+        url = reverse('wfrs-api-estimated-payments')
+        resp = self.client.get('{}?basket=1'.format(url))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(json.dumps(resp.data)), [
+            {
+                "principal": "0.00",
+                "estimates": [],
+            },
+        ])
+
+
+
+class EstimatedPaymentCachingTest(APITestCase):
+    def setUp(self):
+        run_on_commit_immediately(self)
+        self.plan1 = FinancingPlan.objects.create(
+            plan_number=1001,
+            description='Plan 1',
+            apr='0.00',
+            term_months=12,
+            product_price_threshold='1000.00',
+            advertising_enabled=True)
+        self.url = '{}?price=1500.00'.format(reverse('wfrs-api-estimated-payment'))
+
+
+    def test_cache_headers(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.has_header('ETag'))
+        self.assertIn('public', resp['Cache-Control'])
+        self.assertIn('max-age=300', resp['Cache-Control'])
+
+        # Invalid prices aren't cacheable
+        resp = self.client.get('{}?price=foo'.format(reverse('wfrs-api-estimated-payment')))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(resp.has_header('ETag'))
+        self.assertFalse(resp.has_header('Cache-Control'))
+
+
+    def test_conditional_get(self):
+        resp = self.client.get(self.url)
+        etag = resp['ETag']
+        resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # The ETag is specific to the price
+        resp = self.client.get('{}?price=1600.00'.format(reverse('wfrs-api-estimated-payment')), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # Changing a plan changes the ETag
+        self.plan1.apr = '5.00'
+        self.plan1.save()
+        resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(resp.data['plan']['apr'], '5.00')
+
+
+    def test_etag_is_shared_between_processes(self):
+        resp = self.client.get(self.url)
+        etag = resp['ETag']
+        # Simulate a worker process with its own (unshared) cache, which has given the plan table another version
+        with mock.patch('wellsfargo.core.plans.FinancingPlanCatalog._get_version', return_value='other-process'):
+            resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+    def test_server_side_cache(self):
+        self.client.get(self.url)
+        # Load the plan catalog in this process, leaving only the response computation uncached
+        with self.assertNumQueries(0):
+            resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data['monthly_payment'], '125.00')
+
+        # Responses are cached server-side, even for prices without a plan
+        self.client.get('{}?price=500.00'.format(reverse('wfrs-api-estimated-payment')))
+        with mock.patch('wellsfargo.api.views.EstimatedPaymentView._estimate_payment') as estimate_payment:
+            resp = self.client.get(self.url)
+            self.assertEqual(resp.data['monthly_payment'], '125.00')
+            resp = self.client.get('{}?price=500.00'.format(reverse('wfrs-api-estimated-payment')))
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(estimate_payment.call_count, 0)
@@ -3,12 +3,24 @@ from django.contrib.auth.models import User
 from rest_framework.test import APITestCase
 from soap.tests import SoapTest
 from wellsfargo.models import USCreditApp, USJointCreditApp, APICredentials
+import mock
+
+
+def run_on_commit_immediately(test):
+    """
+    Test cases run in a transaction which is never committed, so make ``transaction.on_commit`` (used e.g. to
+    invalidate the in-process caches once a change commits) run its callbacks right away.
+    """
+    patcher = mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    patcher.start()
+    test.addCleanup(patcher.stop)
 
 
 class BaseTest(SoapTest, APITestCase):
     fixtures = ['wfrs-test']
 
     def setUp(self):
+        run_on_commit_immediately(self)
         self.joe = User.objects.create_user(
             username='joe',
             password='schmoe',
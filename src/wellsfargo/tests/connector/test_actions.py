@@ -1,14 +1,17 @@
 from decimal import Decimal
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from wellsfargo.connector import actions
+from requests.exceptions import ConnectTimeout, ReadTimeout
+from wellsfargo.connector import actions, retry
+from wellsfargo.connector.clients import PolicyTransport
 from wellsfargo.core.exceptions import CreditApplicationPending, CreditApplicationDenied, TransactionDenied
 from wellsfargo.core.structures import TransactionRequest
 from wellsfargo.core.constants import (
     PREQUAL_TRANS_STATUS_APPROVED,
     PREQUAL_CUSTOMER_RESP_ACCEPT,
 )
-from wellsfargo.models import FinancingPlan, PreQualificationRequest, PreQualificationResponse
+from wellsfargo.models import FinancingPlan, PreQualificationRequest, PreQualificationResponse, TransferMetadata
+from wellsfargo.settings import WFRS_CHECKOUT_DEADLINE
 from wellsfargo.tests.base import BaseTest
 from wellsfargo.tests import responses
 import mock
@@ -63,6 +66,145 @@ class SubmitTransactionTest(BaseTest):
 
 
 
+class SubmitTransactionRetryTest(BaseTest):
+    """Retries and deadlines, exercised through a real SOAP client whose HTTP session fails to reach WFRS"""
+    def setUp(self):
+        super().setUp()
+        # Simulated clock: sleeping, and each timed out attempt, move it forward
+        self.now = 1000.0
+        patcher = mock.patch('wellsfargo.connector.retry.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('wellsfargo.connector.retry.time.sleep', side_effect=self._sleep)
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('wellsfargo.connector.retry.random.uniform', side_effect=lambda a, b: b)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.timeouts = []
+        FinancingPlan.objects.create(plan_number='1001', description='', apr=0, term_months=0)
+
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+
+    def _build_failing_transport(self, error):
+        transport = PolicyTransport()
+
+        def post(url, timeout=None, **kwargs):
+            self.timeouts.append(timeout)
+            self.now += timeout[0] if error is ConnectTimeout else timeout[1]
+            raise error()
+
+        transport.session.post = mock.MagicMock(side_effect=post)
+        return transport
+
+
+    def _submit(self):
+        request = TransactionRequest()
+        request.user = self.joe
+        request.account_number = '9999999999999991'
+        request.plan_number = 1001
+        request.amount = Decimal('2159.99')
+        request.ticket_number = 'D1234567890'
+        return actions.submit_transaction(request)
+
+
+    @mock.patch('soap.get_transport')
+    def test_retries_unsent_requests(self, get_transport):
+        get_transport.return_value = self._build_failing_transport(ConnectTimeout)
+        policy = {'timeout': (3.05, 20), 'max_attempts': 3, 'backoff': 0.5}
+        with mock.patch.dict('wellsfargo.connector.retry.WFRS_RETRY_POLICIES', {'transaction': policy}):
+            with self.assertRaises(ConnectTimeout):
+                self._submit()
+        self.assertEqual(self.timeouts, [(3.05, 20)] * 3)
+        self.assertEqual(self.sleep.call_args_list, [mock.call(0.5), mock.call(1.0)])
+        self.assertEqual(TransferMetadata.objects.count(), 0)
+
+
+    @mock.patch('soap.get_transport')
+    def test_does_not_retry_sent_requests(self, get_transport):
+        get_transport.return_value = self._build_failing_transport(ReadTimeout)
+        policy = {'timeout': (3.05, 20), 'max_attempts': 3}
+        with mock.patch.dict('wellsfargo.connector.retry.WFRS_RETRY_POLICIES', {'transaction': policy}):
+            with self.assertRaises(ReadTimeout):
+                self._submit()
+        # WFRS may have authorized the transaction, so it mustn't be sent again
+        self.assertEqual(self.timeouts, [(3.05, 20)])
+        self.sleep.assert_not_called()
+
+
+    @mock.patch('soap.get_transport')
+    def test_checkout_deadline(self, get_transport):
+        get_transport.return_value = self._build_failing_transport(ConnectTimeout)
+        policy = {'timeout': (20, 60), 'max_attempts': 5, 'backoff': 5, 'max_backoff': 5}
+        with mock.patch.dict('wellsfargo.connector.retry.WFRS_RETRY_POLICIES', {'transaction': policy}):
+            with retry.deadline(WFRS_CHECKOUT_DEADLINE):
+                # Each attempt's timeouts are clamped to what's left of the deadline, and retrying stops once backing
+                # off would run past it
+                with self.assertRaises(ConnectTimeout) as cm:
+                    self._submit()
+                self.assertNotIsInstance(cm.exception, retry.DeadlineExceeded)
+                self.assertEqual(self.timeouts, [(20, 45), (20, 20)])
+                self.assertEqual(self.sleep.call_args_list, [mock.call(5)])
+                self.assertEqual(self.now, 1045)
+
+                # Now that the deadline has passed, further calls fail fast without sending anything
+                with self.assertRaises(retry.DeadlineExceeded):
+                    self._submit()
+                self.assertEqual(len(self.timeouts), 2)
+
+
+
+class PreparedTransactionTest(BaseTest):
+    def _build_client(self):
+        client = mock.MagicMock()
+        client.service.submitTransaction.return_value = mock.Mock(
+            accountNumber='9999999999999991',
+            uuid='6f9c34ae-2153-11e6-a8c1-0242ac110003',
+            amount='2159.99',
+            transactionCode='5',
+            ticketNumber='D1234567890',
+            planNumber='1001',
+            authorizationNumber='000000',
+            transactionStatus='A1',
+            transactionMessage='APPROVED: 123435',
+            disclosure='',
+            faults=[])
+        return client
+
+
+    @mock.patch('wellsfargo.connector.actions.encrypt_account_number', wraps=actions.encrypt_account_number)
+    @mock.patch('wellsfargo.connector.clients.get_client')
+    def test_submit_prepared_transaction(self, get_client, encrypt_account_number):
+        get_client.return_value = self._build_client()
+        plan = FinancingPlan.objects.create(plan_number='1001', description='', apr=0, term_months=0)
+
+        request = TransactionRequest()
+        request.user = self.joe
+        request.account_number = '9999999999999991'
+        request.plan_number = plan.plan_number
+        request.amount = Decimal('2159.99')
+        request.ticket_number = 'D1234567890'
+        prepared = actions.prepare_transaction(request, current_user=self.joe)
+        self.assertEqual(prepared.credentials, self.credentials)
+        self.assertEqual(prepared.financing_plan, plan)
+        self.assertEqual(encrypt_account_number.call_count, 1)
+
+        # Submitting only needs to save the transfer
+        with self.assertNumQueries(1):
+            transfer = actions.submit_transaction(request, current_user=self.joe, prepared=prepared)
+        self.assertEqual(encrypt_account_number.call_count, 1)
+        self.assertEqual(get_client.call_count, 1)
+        self.assertEqual(transfer.credentials, self.credentials)
+        self.assertEqual(transfer.financing_plan, plan)
+        self.assertEqual(transfer.encrypted_account_number, prepared.encrypted_account_number)
+        self.assertEqual(transfer.last4_account_number, '9991')
+        transfer = TransferMetadata.objects.get(pk=transfer.pk)
+        self.assertEqual(transfer.account_number, '9999999999999991')
+
+
 class CreditInquiryTest(BaseTest):
     @mock.patch('soap.get_transport')
     def test_submit_inquiry_success(self, get_transport):
@@ -0,0 +1,129 @@
+from django.test import SimpleTestCase
+from soap.tests import SoapTest
+from wellsfargo.connector.clients import SOAPClientPool, get_type_name
+import soap
+import threading
+import time
+import mock
+
+
+def fake_get_client(wsdl, log_prefix, plugins=[], **kwargs):
+    """Stand-in for soap.get_client that records the client in soap.clients without touching the network"""
+    if wsdl not in soap.clients:
+        time.sleep(0.01)
+        soap.clients[wsdl] = mock.MagicMock(name=wsdl)
+    return soap.clients[wsdl]
+
+
+def build_fake_client(num_types=200):
+    """Build a stand-in for a suds client whose service definition has a realistic number of types"""
+    names = ['ns{}:Type{}'.format(i % 3, i) for i in range(num_types)]
+    names += ['ns1:Transaction', 'ns1:Inquiry', 'ns1:CreditApp', 'ns2:WFRS_InstantPreScreenRequest', 'ns2:WFRS_OTBRequest']
+    names += ['ns3:Transaction', 'UnqualifiedType']
+    sd = mock.MagicMock()
+    sd.types = [(name, None) for name in names]
+    sd.xlate.side_effect = lambda stype: stype
+    client = mock.MagicMock()
+    client.sd = [sd]
+    return client
+
+
+
+@mock.patch('soap.get_client', side_effect=fake_get_client)
+class SOAPClientPoolTest(SoapTest, SimpleTestCase):
+    WSDL = 'https://retailservices-uat.wellsfargo.com/services/SubmitTransactionService?WSDL'
+
+    def test_reuses_client(self, get_client):
+        pool = SOAPClientPool()
+        client = pool.get_client(self.WSDL, 'WFRS')
+        self.assertIs(pool.get_client(self.WSDL, 'WFRS'), client)
+        self.assertIs(pool.get_client(self.WSDL, 'WFRS'), client)
+        self.assertEqual(get_client.call_count, 1)
+
+
+    def test_rebuilds_client_after_max_age(self, get_client):
+        pool = SOAPClientPool(max_age=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            client1 = pool.get_client(self.WSDL, 'WFRS')
+        with mock.patch('time.monotonic', return_value=1030):
+            self.assertIs(pool.get_client(self.WSDL, 'WFRS'), client1)
+        with mock.patch('time.monotonic', return_value=1061):
+            client2 = pool.get_client(self.WSDL, 'WFRS')
+        self.assertIsNot(client2, client1)
+        self.assertIs(soap.clients[self.WSDL], client2)
+
+
+    def test_rebuilds_client_when_soap_cache_is_reset(self, get_client):
+        pool = SOAPClientPool()
+        client1 = pool.get_client(self.WSDL, 'WFRS')
+        soap.clients = {}
+        client2 = pool.get_client(self.WSDL, 'WFRS')
+        self.assertIsNot(client2, client1)
+
+
+    def test_concurrent_first_use_builds_once(self, get_client):
+        pool = SOAPClientPool()
+        results = []
+
+        def worker():
+            results.append(pool.get_client(self.WSDL, 'WFRS'))
+
+        threads = [threading.Thread(target=worker) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len(set(id(c) for c in results)), 1)
+        self.assertEqual(get_client.call_count, 1)
+
+
+    def test_warm_up(self, get_client):
+        other_wsdl = 'https://retailservices-uat.wellsfargo.com/services/SubmitInquiryService?WSDL'
+        get_client.side_effect = lambda wsdl, *args, **kwargs: (
+            fake_get_client(wsdl, *args, **kwargs) if wsdl == self.WSDL else self.fail_wsdl(wsdl))
+
+        pool = SOAPClientPool()
+        pool.warm_up([self.WSDL, other_wsdl], 'WFRS')
+
+        self.assertIn(self.WSDL, soap.clients)
+        self.assertNotIn(other_wsdl, soap.clients)
+        self.assertIs(pool.get_client(self.WSDL, 'WFRS'), soap.clients[self.WSDL])
+
+
+    def fail_wsdl(self, wsdl):
+        raise IOError('Could not fetch {}'.format(wsdl))
+
+
+
+class TypeNameIndexTest(SimpleTestCase):
+    OPERATION_TYPES = (
+        ('Transaction', 'ns1:Transaction'),
+        ('Inquiry', 'ns1:Inquiry'),
+        ('CreditApp', 'ns1:CreditApp'),
+        ('WFRS_InstantPreScreenRequest', 'ns2:WFRS_InstantPreScreenRequest'),
+        ('WFRS_OTBRequest', 'ns2:WFRS_OTBRequest'),
+    )
+
+    def test_lookup(self):
+        client = build_fake_client()
+        for bare_name, namespaced_name in self.OPERATION_TYPES:
+            self.assertEqual(get_type_name(client, bare_name), namespaced_name)
+        self.assertEqual(get_type_name(client, 'UnqualifiedType'), 'UnqualifiedType')
+        self.assertEqual(get_type_name(client, 'DoesNotExist'), 'DoesNotExist')
+
+
+    def test_index_is_built_once_per_client(self):
+        client = build_fake_client()
+        num_types = len(client.sd[0].types)
+        for i in range(50):
+            for bare_name, namespaced_name in self.OPERATION_TYPES:
+                self.assertEqual(get_type_name(client, bare_name), namespaced_name)
+        self.assertEqual(client.sd[0].xlate.call_count, num_types)
+
+        # A rebuilt client (e.g. after the WSDL changed) gets a fresh index
+        client2 = build_fake_client()
+        client2.sd[0].types.insert(0, ('ns9:Transaction', None))
+        self.assertEqual(get_type_name(client2, 'Transaction'), 'ns9:Transaction')
+        self.assertEqual(get_type_name(client, 'Transaction'), 'ns1:Transaction')
@@ -0,0 +1,90 @@
+from django.test import SimpleTestCase
+from requests.exceptions import ConnectTimeout, ReadTimeout
+from soap.http import HttpTransport
+from wellsfargo.connector.clients import PolicyTransport
+from wellsfargo.connector.retry import RetryPolicy, DeadlineExceeded, deadline, get_deadline, send_timeout
+import mock
+
+
+@mock.patch('wellsfargo.connector.retry.time.sleep')
+class RetryPolicyTest(SimpleTestCase):
+    def test_retries_idempotent_operations(self, sleep):
+        policy = RetryPolicy('inquiry', max_attempts=3, idempotent=True)
+        func = mock.MagicMock(side_effect=[ReadTimeout(), ConnectTimeout(), 'resp'])
+        self.assertEqual(policy.call(func, 'request'), 'resp')
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with('request')
+        self.assertEqual(sleep.call_count, 2)
+
+
+    def test_only_retries_unsent_requests_for_other_operations(self, sleep):
+        policy = RetryPolicy('credit_app', max_attempts=3)
+        func = mock.MagicMock(side_effect=[ConnectTimeout(), ReadTimeout(), 'resp'])
+        with self.assertRaises(ReadTimeout):
+            policy.call(func)
+        self.assertEqual(func.call_count, 2)
+
+
+    def test_gives_up_after_max_attempts(self, sleep):
+        policy = RetryPolicy('otb', max_attempts=2, idempotent=True)
+        func = mock.MagicMock(side_effect=ReadTimeout())
+        with self.assertRaises(ReadTimeout):
+            policy.call(func)
+        self.assertEqual(func.call_count, 2)
+
+
+    def test_backoff(self, sleep):
+        policy = RetryPolicy('inquiry', backoff=0.5, max_backoff=3.0)
+        with mock.patch('wellsfargo.connector.retry.random.uniform', side_effect=lambda a, b: b) as uniform:
+            self.assertEqual([policy.get_backoff(i) for i in range(1, 6)], [0.5, 1.0, 2.0, 3.0, 3.0])
+        uniform.assert_called_with(0, 3.0)
+
+
+    def test_deadline_clamps_timeouts(self, sleep):
+        policy = RetryPolicy('inquiry', timeout=(3.05, 20))
+        self.assertEqual(policy.get_timeout(), (3.05, 20))
+        with mock.patch('time.monotonic', return_value=1000):
+            with deadline(10):
+                self.assertEqual(policy.get_timeout(), (3.05, 10))
+                # Nested deadlines can shorten the current one, but not extend it
+                with deadline(2):
+                    self.assertEqual(policy.get_timeout(), (2, 2))
+                with deadline(60):
+                    self.assertEqual(policy.get_timeout(), (3.05, 10))
+                with deadline(None):
+                    self.assertIsNone(get_deadline())
+                    self.assertEqual(policy.get_timeout(), (3.05, 20))
+        self.assertIsNone(get_deadline())
+
+        # Without its own timeout, the policy falls back to the transport's
+        with mock.patch('time.monotonic', return_value=1000):
+            with deadline(5):
+                self.assertEqual(RetryPolicy('inquiry').get_timeout(), (min(HttpTransport.send_timeout[0], 5), 5))
+
+
+    def test_deadline_exceeded(self, sleep):
+        policy = RetryPolicy('inquiry', max_attempts=3, backoff=1.0, idempotent=True)
+        func = mock.MagicMock(side_effect=ReadTimeout())
+        with mock.patch('time.monotonic', return_value=1000):
+            with deadline(0.5):
+                # Backing off would run past the deadline, so give up after the first attempt
+                with mock.patch('wellsfargo.connector.retry.random.uniform', return_value=0.75):
+                    with self.assertRaises(ReadTimeout):
+                        policy.call(func)
+                self.assertEqual(func.call_count, 1)
+                sleep.assert_not_called()
+
+        # Once the deadline has passed, nothing is sent
+        with mock.patch('time.monotonic', side_effect=[1000, 1001]):
+            with deadline(0.5):
+                with self.assertRaises(DeadlineExceeded):
+                    policy.call(func)
+        self.assertEqual(func.call_count, 1)
+
+
+    def test_policy_transport(self, sleep):
+        transport = PolicyTransport()
+        self.assertEqual(transport.send_timeout, HttpTransport.send_timeout)
+        with send_timeout((1, 2)):
+            self.assertEqual(transport.send_timeout, (1, 2))
+        self.assertEqual(transport.send_timeout, HttpTransport.send_timeout)
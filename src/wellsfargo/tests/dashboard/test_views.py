@@ -1,5 +1,7 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from wellsfargo.models import USCreditApp
+from wellsfargo.models import USCreditApp, FinancingPlan, FinancingPlanBenefit
 from wellsfargo.tests.base import BaseTest
 from wellsfargo.tests import responses
 import mock
@@ -114,3 +116,32 @@ class CreditApplicationViewTest(BaseTest):
         resp = self.client.post(url, data=self.build_valid_request(), follow=True)
         self.assertRedirects(resp, '/dashboard/wfrs/applications/')
         self.assertContains(resp, 'Credit Application approval is pending')
+
+
+
+class FinancingPlanBenefitListViewTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.plans = [FinancingPlan.objects.create(plan_number=1001 + i) for i in range(3)]
+
+
+    def _create_benefits(self, count):
+        for i in range(count):
+            benefit = FinancingPlanBenefit.objects.create(group_name='Plan Group')
+            benefit.plans.set(self.plans)
+
+
+    def _count_queries(self):
+        self.client.login(username='bill', password='schmoe')
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('wfrs-benefit-list'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'Causes the following Wells Fargo financing plans to be available: 1001, 1002, 1003')
+        return len(queries)
+
+
+    def test_query_count_is_constant(self):
+        self._create_benefits(1)
+        num_queries = self._count_queries()
+        self._create_benefits(49)
+        self.assertEqual(self._count_queries(), num_queries)
@@ -0,0 +1,359 @@
+from decimal import Decimal
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+from wellsfargo.core.quotes import catalog as quote_catalog
+from wellsfargo.tests.base import BaseTest, run_on_commit_immediately
+from wellsfargo.tests.test_security import FERNET_KEY_1, FERNET_KEY_2, patch_encryptor
+from wellsfargo.core.constants import TRANS_TYPE_AUTH, TRANS_APPROVED
+from wellsfargo.models import TransferMetadata, FinancingPlan, FinancingPlanPaymentQuote, SearchIndexQueueEntry
+from wellsfargo.utils import (
+    calculate_monthly_payments,
+    calculate_loan_cost,
+    get_payment_quote,
+    get_payment_quotes,
+    PaymentFactors,
+)
+from wellsfargo.security.fernet import FernetEncryption
+from wellsfargo.management.commands.wfrs_reencrypt_account_numbers import Command as ReencryptCommand
+from wellsfargo.management.commands.wfrs_update_index import _index_batch_in_worker
+from haystack import connections as haystack_connections
+from io import StringIO
+import json
+import mock
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+
+OLD_KEYS = [
+    {
+        'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+        'key_id': 'key1',
+        'encryptor_kwargs': {
+            'key': FERNET_KEY_1,
+        },
+    },
+]
+
+ROTATED_KEYS = [
+    {
+        'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+        'key_id': 'key2',
+        'encryptor_kwargs': {
+            'key': FERNET_KEY_2,
+        },
+    },
+] + OLD_KEYS
+
+
+class ReencryptAccountNumbersTest(BaseTest):
+    @patch_encryptor('wellsfargo.security.multi.MultiEncryption', encryptors=OLD_KEYS)
+    def setUp(self):
+        super().setUp()
+        self.transfers = []
+        for i in range(7):
+            transfer = TransferMetadata()
+            transfer.user = self.joe
+            transfer.credentials = self.credentials
+            transfer.merchant_reference = uuid.uuid1()
+            transfer.amount = Decimal('10.00')
+            transfer.type_code = TRANS_TYPE_AUTH
+            transfer.ticket_number = '123'
+            transfer.status = TRANS_APPROVED
+            transfer.message = 'message'
+            transfer.disclosure = 'disclosure'
+            transfer.account_number = '999999999999999{}'.format(i)
+            transfer.save()
+            self.transfers.append(transfer)
+        # A legacy, untagged blob
+        transfer = self.transfers[-1]
+        transfer.encrypted_account_number = FernetEncryption(FERNET_KEY_1).encrypt('9999999999999996')
+        transfer.save()
+        # A row without an account number
+        self.transfers[0].purge_encrypted_account_number()
+
+
+    def get_blobs(self):
+        qs = TransferMetadata.objects.order_by('pk').values_list('encrypted_account_number', flat=True)
+        return [bytes(blob) if blob else None for blob in qs]
+
+
+    @patch_encryptor('wellsfargo.security.multi.MultiEncryption', encryptors=ROTATED_KEYS)
+    def test_reencrypt(self):
+        out = StringIO()
+        call_command('wfrs_reencrypt_account_numbers', batch_size=3, stdout=out)
+        self.assertIn('wellsfargo.transfermetadata: re-encrypted 6 rows, skipped 0, failed to decrypt 0', out.getvalue())
+
+        blobs = self.get_blobs()
+        self.assertIsNone(blobs[0])
+        for blob in blobs[1:]:
+            self.assertTrue(blob.startswith(b'$key2$'))
+        transfers = TransferMetadata.objects.order_by('pk').with_account_numbers()
+        self.assertEqual([t.account_number for t in transfers][1:], ['999999999999999{}'.format(i) for i in range(1, 7)])
+
+        # Running again doesn't touch blobs which are already current
+        out = StringIO()
+        call_command('wfrs_reencrypt_account_numbers', batch_size=3, stdout=out)
+        self.assertIn('re-encrypted 0 rows, skipped 6', out.getvalue())
+        self.assertEqual(self.get_blobs(), blobs)
+
+
+    @patch_encryptor('wellsfargo.security.multi.MultiEncryption', encryptors=ROTATED_KEYS)
+    def test_resume_from_checkpoint(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            json.dump({'wellsfargo.transfermetadata': self.transfers[3].pk}, f)
+
+        out = StringIO()
+        call_command('wfrs_reencrypt_account_numbers', model=['wellsfargo.TransferMetadata'], checkpoint=path, stdout=out)
+        self.assertIn('Resuming wellsfargo.transfermetadata after pk {}'.format(self.transfers[3].pk), out.getvalue())
+        self.assertIn('re-encrypted 3 rows', out.getvalue())
+
+        blobs = self.get_blobs()
+        for blob in blobs[1:4]:
+            self.assertTrue(blob.startswith(b'$key1$'))
+        for blob in blobs[4:]:
+            self.assertTrue(blob.startswith(b'$key2$'))
+        with open(path, 'r') as f:
+            self.assertEqual(json.load(f), {'wellsfargo.transfermetadata': self.transfers[6].pk})
+
+
+    def test_parallel_checkpoints_are_contiguous(self):
+        # Later batches finish first, but the checkpoint must never skip past an unfinished batch
+        checkpoints = []
+        command = ReencryptCommand(stdout=StringIO())
+        command.batch_size = 1
+        command.workers = 3
+        command.checkpoint_path = None
+        command.checkpoint = {}
+
+        def reencrypt_batch(Model, bounds):
+            time.sleep(0.05 if bounds[1] == self.transfers[1].pk else 0)
+            return {'updated': 1, 'skipped': 0, 'failed': 0}
+
+        def save_checkpoint(label, pk):
+            checkpoints.append(pk)
+
+        with mock.patch.object(command, '_reencrypt_batch', side_effect=reencrypt_batch), \
+                mock.patch.object(command, '_save_checkpoint', side_effect=save_checkpoint):
+            command._reencrypt_model(TransferMetadata)
+
+        self.assertEqual(checkpoints, [t.pk for t in self.transfers[1:]])
+
+
+
+class PrecomputePaymentQuotesTest(TestCase):
+    def setUp(self):
+        run_on_commit_immediately(self)
+        self.plan1 = FinancingPlan.objects.create(
+            plan_number=1001,
+            apr=Decimal('0.00'),
+            term_months=12,
+            product_price_threshold=Decimal('1000.00'),
+            advertising_enabled=True)
+        self.plan2 = FinancingPlan.objects.create(
+            plan_number=1002,
+            apr=Decimal('27.99'),
+            term_months=60,
+            product_price_threshold=Decimal('0.00'),
+            advertising_enabled=True)
+        FinancingPlan.objects.create(
+            plan_number=1003,
+            apr=Decimal('9.99'),
+            term_months=24,
+            advertising_enabled=False)
+
+
+    def test_precompute(self):
+        out = StringIO()
+        call_command('wfrs_precompute_payment_quotes', step=Decimal('250.00'), max_price=Decimal('2000.00'), stdout=out)
+        self.assertIn('Precomputed 13 payment quotes for 2 plans at 8 prices', out.getvalue())
+        self.assertEqual(FinancingPlanPaymentQuote.objects.filter(plan=self.plan1).count(), 5)
+        self.assertEqual(FinancingPlanPaymentQuote.objects.filter(plan=self.plan2).count(), 8)
+
+        # Precomputed quotes match the calculated ones, to the cent
+        for quote in FinancingPlanPaymentQuote.objects.all():
+            monthly_payment = calculate_monthly_payments(quote.price, quote.plan.term_months, quote.plan.apr)
+            self.assertEqual(quote.monthly_payment, monthly_payment.quantize(Decimal('0.01')))
+            self.assertEqual(quote.loan_cost, calculate_loan_cost(quote.price, monthly_payment, quote.plan.term_months))
+
+        # Running it again replaces the table
+        call_command('wfrs_precompute_payment_quotes', step=Decimal('1000.00'), max_price=Decimal('2000.00'), stdout=StringIO())
+        self.assertEqual(FinancingPlanPaymentQuote.objects.count(), 4)
+
+
+    def test_serve_quotes(self):
+        call_command('wfrs_precompute_payment_quotes', step=Decimal('500.00'), max_price=Decimal('2000.00'), stdout=StringIO())
+        plan = FinancingPlan.objects.get(pk=self.plan2.pk)
+        with mock.patch('wellsfargo.utils.PaymentFactors', wraps=PaymentFactors) as factors:
+            quotes = get_payment_quotes([(plan, Decimal('1500.00')), (plan, Decimal('1499.99'))])
+        # Only the price between buckets was calculated
+        factors.assert_called_once_with(60, Decimal('27.99'))
+        self.assertEqual(quotes[0], (Decimal('46.70'), Decimal('1302.00')))
+        self.assertEqual(quotes[1], (Decimal('46.70'), Decimal('1302.01')))
+
+        # Quotes for a plan that's since been changed aren't used
+        plan.apr = Decimal('9.99')
+        plan.save()
+        with mock.patch('wellsfargo.utils.PaymentFactors', wraps=PaymentFactors) as factors:
+            quote = get_payment_quote(plan, Decimal('1500.00'))
+        factors.assert_called_once_with(60, Decimal('9.99'))
+        self.assertEqual(quote, (Decimal('31.87'), Decimal('412.20')))
+
+
+    def test_zero_apr_quotes_match(self):
+        plan = FinancingPlan.objects.get(pk=self.plan1.pk)
+        price = Decimal('1000.00')
+        quote_catalog.invalidate()
+        with mock.patch('wellsfargo.utils.PaymentFactors', wraps=PaymentFactors) as factors:
+            computed = get_payment_quote(plan, price)
+        factors.assert_called_once_with(12, Decimal('0.00'))
+        call_command('wfrs_precompute_payment_quotes', step=Decimal('1000.00'), max_price=Decimal('1000.00'), stdout=StringIO())
+        with mock.patch('wellsfargo.utils.PaymentFactors') as factors:
+            precomputed = get_payment_quote(plan, price)
+        factors.assert_not_called()
+        self.assertEqual(precomputed, computed)
+        self.assertEqual(str(computed.monthly_payment), '83.33')
+
+
+    def test_quote_table_max_age(self):
+        call_command('wfrs_precompute_payment_quotes', step=Decimal('500.00'), max_price=Decimal('2000.00'), stdout=StringIO())
+        plan = FinancingPlan.objects.get(pk=self.plan2.pk)
+        self.assertIsNotNone(quote_catalog.get_quote(plan, Decimal('500.00')))
+        # A change which didn't invalidate the cache, e.g. one made by a process which doesn't share it
+        FinancingPlanPaymentQuote.objects.all().delete()
+        self.assertIsNotNone(quote_catalog.get_quote(plan, Decimal('500.00')))
+        # Is picked up once the in-process table expires
+        quote_catalog._table.loaded -= 61
+        self.assertIsNone(quote_catalog.get_quote(plan, Decimal('500.00')))
+
+
+    def test_invalid_prices(self):
+        with self.assertRaises(CommandError):
+            call_command('wfrs_precompute_payment_quotes', min_price=Decimal('500.00'), max_price=Decimal('100.00'), stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('wfrs_precompute_payment_quotes', '--step', 'foo', stdout=StringIO())
+
+
+
+class BaseIndexCommandTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.transfers = []
+        for i in range(7):
+            transfer = TransferMetadata()
+            transfer.user = self.joe
+            transfer.credentials = self.credentials
+            transfer.merchant_reference = uuid.uuid1()
+            transfer.amount = Decimal('10.00')
+            transfer.type_code = TRANS_TYPE_AUTH
+            transfer.ticket_number = '123'
+            transfer.status = TRANS_APPROVED
+            transfer.message = 'message'
+            transfer.disclosure = 'disclosure'
+            transfer.account_number = '9999999999999999'
+            transfer.save()
+            self.transfers.append(transfer)
+        self.pks = [t.pk for t in self.transfers]
+        self.backend = mock.MagicMock()
+        patcher = mock.patch.object(haystack_connections['default'], 'get_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def get_indexed_pks(self):
+        return [obj.pk for c in self.backend.update.call_args_list for obj in c[0][1]]
+
+
+
+class UpdateIndexTest(BaseIndexCommandTest):
+    def test_update_index(self):
+        out = StringIO()
+        call_command('wfrs_update_index', model=['wellsfargo.TransferMetadata'], batch_size=2, shards=3, stdout=out)
+        self.assertIn('wellsfargo.transfermetadata: indexed 7 rows in 3 shards', out.getvalue())
+        self.assertEqual(sorted(self.get_indexed_pks()), self.pks)
+        # Each batch is posted in one request
+        self.assertEqual(max(len(c[0][1]) for c in self.backend.update.call_args_list), 2)
+
+
+    def _write_checkpoint(self, checkpoint):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'checkpoint.json')
+        with open(path, 'w') as f:
+            json.dump(checkpoint, f)
+        return path
+
+
+    def test_resume_from_checkpoint(self):
+        path = self._write_checkpoint({'wellsfargo.transfermetadata': [
+            [self.pks[0] - 1, self.pks[2], True],
+            [self.pks[3], self.pks[4], False],
+        ]})
+
+        # Stop after the first batch, as if the job were interrupted
+        with mock.patch.object(self.backend, 'update', side_effect=[None, KeyboardInterrupt()]):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('wfrs_update_index', model=['wellsfargo.TransferMetadata'], checkpoint=path, batch_size=1, stdout=StringIO())
+        with open(path, 'r') as f:
+            shards = json.load(f)['wellsfargo.transfermetadata']
+        self.assertEqual(shards[1:], [[self.pks[4], self.pks[4], True], [self.pks[4], self.pks[6], False]])
+
+        out = StringIO()
+        call_command('wfrs_update_index', model=['wellsfargo.TransferMetadata'], checkpoint=path, stdout=out)
+        self.assertIn('Resuming wellsfargo.transfermetadata: 1 of 3 shards remaining', out.getvalue())
+        # Rows created since the checkpoint was first written
+        self.assertEqual(sorted(self.get_indexed_pks()), self.pks[5:])
+        # The job is done, so its checkpoint is gone
+        self.assertFalse(os.path.exists(path))
+
+
+    def test_complete_checkpoint_starts_over(self):
+        path = self._write_checkpoint({'wellsfargo.transfermetadata': [
+            [self.pks[-1], self.pks[-1], True],
+        ]})
+        out = StringIO()
+        err = StringIO()
+        call_command('wfrs_update_index', model=['wellsfargo.TransferMetadata'], checkpoint=path, stdout=out, stderr=err)
+        self.assertIn('already done, so starting over', err.getvalue())
+        self.assertNotIn('Resuming', out.getvalue())
+        self.assertEqual(sorted(self.get_indexed_pks()), self.pks)
+        self.assertFalse(os.path.exists(path))
+
+
+    @mock.patch('wellsfargo.management.commands.wfrs_update_index._worker_pid', None)
+    def test_worker_resets_sessions_once(self):
+        with mock.patch.object(haystack_connections['default'], 'reset_sessions') as reset_sessions:
+            for pid in (100, 100, 200):
+                with mock.patch('wellsfargo.management.commands.wfrs_update_index.os.getpid', return_value=pid):
+                    _index_batch_in_worker('default', 'wellsfargo.transfermetadata', self.pks[0] - 1, self.pks[-1], 2)
+        # Once in each (simulated) worker process
+        self.assertEqual(reset_sessions.call_count, 2)
+        self.assertEqual(self.backend.update.call_count, 3)
+
+
+    def test_invalid_models(self):
+        with self.assertRaises(CommandError):
+            call_command('wfrs_update_index', model=['wellsfargo.Nope'], stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('wfrs_update_index', model=['wellsfargo.FinancingPlan'], stdout=StringIO())
+
+
+
+class ProcessIndexQueueTest(BaseIndexCommandTest):
+    def test_process_index_queue(self):
+        content_type = ContentType.objects.get_for_model(TransferMetadata)
+        SearchIndexQueueEntry.objects.bulk_create([
+            SearchIndexQueueEntry(content_type=content_type, object_id=pk) for pk in self.pks
+        ])
+        out = StringIO()
+        call_command('wfrs_process_index_queue', batch_size=3, stdout=out)
+        self.assertIn('Processed 7 queued objects', out.getvalue())
+        self.assertEqual(sorted(self.get_indexed_pks()), self.pks)
+        self.assertEqual(self.backend.update.call_count, 3)
+        self.assertFalse(SearchIndexQueueEntry.objects.exists())
@@ -1,9 +1,11 @@
 from django.test import TestCase, RequestFactory
 from oscar.test.factories import create_order
 from soap.tests import SoapTest
-from wellsfargo.fraud import screen_transaction, WFRS_FRAUD_PROTECTION
+from wellsfargo.fraud import screen_transaction, reset_fraud_screeners, _get_fraud_screener, WFRS_FRAUD_PROTECTION
 from wellsfargo.tests import responses
+from wellsfargo.tests.connector.test_clients import fake_get_client
 import mock
+import soap
 
 
 
@@ -88,3 +90,53 @@ class DecisionManagerFraudProtectionTest(SoapTest, TestCase):
         self.assertEqual(result.order, order)
         self.assertEqual(result.decision, 'REJECT')
         self.assertEqual(result.message, 'The fraud score exceeds your threshold. Reason code 400')
+
+
+
+class FraudScreenerCacheTest(SoapTest, TestCase):
+    KWARGS = DecisionManagerFraudProtectionTest.KWARGS
+
+    def setUp(self):
+        super().setUp()
+        reset_fraud_screeners()
+
+    def tearDown(self):
+        reset_fraud_screeners()
+        super().tearDown()
+
+
+    def test_screener_is_reused(self):
+        screener1 = _get_fraud_screener('wellsfargo.fraud.dummy.DummyFraudProtection', {})
+        screener2 = _get_fraud_screener('wellsfargo.fraud.dummy.DummyFraudProtection', {})
+        screener3 = _get_fraud_screener('wellsfargo.fraud.dummy.DummyFraudProtection', {'decision': 'REJECT'})
+        self.assertIs(screener1, screener2)
+        self.assertIsNot(screener1, screener3)
+
+        reset_fraud_screeners()
+        self.assertIsNot(_get_fraud_screener('wellsfargo.fraud.dummy.DummyFraudProtection', {}), screener1)
+
+
+    def fake_get_client(self, *args, **kwargs):
+        client = fake_get_client(*args, **kwargs)
+        client.service.runTransaction.return_value = mock.Mock(reasonCode=100, requestID='1234')
+        return client
+
+
+    @patch_fraud_protection('wellsfargo.fraud.cybersource.DecisionManagerFraudProtection', **KWARGS)
+    @mock.patch('soap.get_client')
+    def test_client_is_configured_once(self, get_client):
+        get_client.side_effect = self.fake_get_client
+        request = RequestFactory().get('/api/checkout/')
+        for i in range(3):
+            screen_transaction(request, create_order())
+        self.assertEqual(get_client.call_count, 1)
+        client = soap.clients[self.KWARGS['wsdl']]
+        self.assertEqual(client.service.runTransaction.call_count, 3)
+        self.assertEqual(client.set_options.call_count, 1)
+        self.assertEqual(client.set_options.call_args[1]['wsse'].tokens[0].username, 'mymerchantid')
+
+        # If the client is rebuilt, the security header is applied to the new one
+        soap.clients = {}
+        screen_transaction(request, create_order())
+        self.assertEqual(get_client.call_count, 2)
+        self.assertEqual(soap.clients[self.KWARGS['wsdl']].set_options.call_count, 1)
@@ -0,0 +1,271 @@
+from concurrent.futures import Future
+from decimal import Decimal
+from django.test import RequestFactory
+from oscar.test.factories import create_order
+from oscarapicheckout.states import Complete, Declined
+from requests.exceptions import ConnectTimeout, ReadTimeout
+from wellsfargo.connector import retry
+from wellsfargo.core import exceptions
+from wellsfargo.core.constants import (
+    TRANS_APPROVED,
+    TRANS_DECLINED,
+    TRANS_VOID_NO_MATCH_FOUND,
+    TRANS_TYPE_AUTH,
+    TRANS_TYPE_CANCEL_AUTH,
+    TRANS_JOURNAL_APPROVED,
+    TRANS_JOURNAL_DECLINED,
+    TRANS_JOURNAL_NOT_SENT,
+    TRANS_JOURNAL_UNKNOWN,
+)
+from wellsfargo.core.structures import TransactionRequest
+from wellsfargo.fraud.dummy import DummyFraudProtection
+from wellsfargo.methods import WellsFargo, _prepare_transaction
+from wellsfargo.models import TransferMetadata, TransactionJournalEntry, FinancingPlan, FraudScreenResult
+from wellsfargo.tests.base import BaseTest
+import mock
+import uuid
+
+
+class PerformAuthTransactionTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.transaction_uuid = str(uuid.uuid4())
+        self.trans_request = self._build_trans_request(TRANS_TYPE_AUTH)
+        self.cancel_trans_request = self._build_trans_request(TRANS_TYPE_CANCEL_AUTH)
+        self.method = WellsFargo()
+        patcher = mock.patch('wellsfargo.connector.retry.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def _build_trans_request(self, type_code):
+        trans_request = TransactionRequest()
+        trans_request.type_code = type_code
+        trans_request.user = self.joe
+        trans_request.account_number = '9999999999999999'
+        trans_request.plan_number = 9999
+        trans_request.amount = Decimal('10.00')
+        trans_request.ticket_number = '100001'
+        return trans_request
+
+
+    def _approve(self, trans_request, **kwargs):
+        transfer = TransferMetadata()
+        transfer.user = self.joe
+        transfer.merchant_reference = self.transaction_uuid
+        transfer.amount = trans_request.amount
+        transfer.type_code = trans_request.type_code
+        transfer.ticket_number = trans_request.ticket_number
+        transfer.status = TRANS_APPROVED
+        transfer.message = 'approved'
+        transfer.disclosure = ''
+        transfer.account_number = trans_request.account_number
+        transfer.save()
+        return transfer
+
+
+    def _cancel(self, trans_request, **kwargs):
+        return TransferMetadata(type_code=trans_request.type_code, status=TRANS_APPROVED)
+
+
+    def _submit(self, *outcomes):
+        """Patch submit_transaction to return or raise the given outcomes, in order"""
+        outcomes = list(outcomes)
+
+        def submit_transaction(trans_request, **kwargs):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome(trans_request, **kwargs)
+        return mock.patch('wellsfargo.methods.actions.submit_transaction', side_effect=submit_transaction)
+
+
+    def _perform(self):
+        return self.method._perform_auth_transaction(
+            trans_request=self.trans_request,
+            cancel_trans_request=self.cancel_trans_request,
+            current_user=self.joe,
+            transaction_uuid=self.transaction_uuid)
+
+
+    def _type_codes(self, submit_transaction):
+        return [c[0][0].type_code for c in submit_transaction.call_args_list]
+
+
+    def test_approved(self):
+        with self._submit(self._approve) as submit_transaction:
+            transfer = self._perform()
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH])
+        journal = TransactionJournalEntry.objects.get(transaction_uuid=self.transaction_uuid)
+        self.assertEqual(journal.state, TRANS_JOURNAL_APPROVED)
+        self.assertEqual(journal.attempts, 1)
+        self.assertEqual(journal.transfer, transfer)
+
+        # Performing the same transaction again doesn't resubmit it
+        with self._submit() as submit_transaction:
+            self.assertEqual(self._perform(), transfer)
+        self.assertEqual(submit_transaction.call_count, 0)
+
+
+    def test_declined(self):
+        with self._submit(exceptions.TransactionDenied('declined')):
+            with self.assertRaises(exceptions.TransactionDenied):
+                self._perform()
+        journal = TransactionJournalEntry.objects.get(transaction_uuid=self.transaction_uuid)
+        self.assertEqual(journal.state, TRANS_JOURNAL_DECLINED)
+
+
+    def test_read_timeout_cancels_and_resubmits(self):
+        with self._submit(ReadTimeout(), self._cancel, self._approve) as submit_transaction:
+            transfer = self._perform()
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH, TRANS_TYPE_CANCEL_AUTH, TRANS_TYPE_AUTH])
+        journal = TransactionJournalEntry.objects.get(transaction_uuid=self.transaction_uuid)
+        self.assertEqual(journal.state, TRANS_JOURNAL_APPROVED)
+        self.assertEqual(journal.attempts, 2)
+        self.assertEqual(journal.transfer, transfer)
+
+
+    def test_cancel_without_match_resubmits(self):
+        no_match = exceptions.TransactionDenied('no match')
+        no_match.status = TRANS_VOID_NO_MATCH_FOUND
+        with self._submit(ReadTimeout(), no_match, self._approve) as submit_transaction:
+            self._perform()
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH, TRANS_TYPE_CANCEL_AUTH, TRANS_TYPE_AUTH])
+
+
+    def test_connect_timeout_resubmits_without_cancel(self):
+        with self._submit(ConnectTimeout(), self._approve) as submit_transaction:
+            self._perform()
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH, TRANS_TYPE_AUTH])
+
+
+    def test_failed_cancel_stops_retrying(self):
+        declined = exceptions.TransactionDenied('already funded')
+        declined.status = TRANS_DECLINED
+        for cancel_outcome in (ReadTimeout(), declined):
+            with self._submit(ReadTimeout(), cancel_outcome) as submit_transaction:
+                with self.assertRaises(ReadTimeout):
+                    self._perform()
+            self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH, TRANS_TYPE_CANCEL_AUTH])
+            journal = TransactionJournalEntry.objects.get(transaction_uuid=self.transaction_uuid)
+            self.assertEqual(journal.state, TRANS_JOURNAL_UNKNOWN)
+
+
+    def test_detects_approval_by_another_attempt(self):
+        def approve_elsewhere_then_time_out(trans_request, **kwargs):
+            # E.g. a concurrent request for the same transaction got its response, but this one didn't
+            self._approve(trans_request)
+            raise ReadTimeout()
+
+        with self._submit(approve_elsewhere_then_time_out) as submit_transaction:
+            transfer = self._perform()
+        # Nothing was canceled or resubmitted
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH])
+        self.assertEqual(transfer.merchant_reference, self.transaction_uuid)
+        journal = TransactionJournalEntry.objects.get(transaction_uuid=self.transaction_uuid)
+        self.assertEqual(journal.state, TRANS_JOURNAL_APPROVED)
+        self.assertEqual(journal.transfer, transfer)
+
+
+    def test_stops_retrying_at_deadline(self):
+        with mock.patch('wellsfargo.connector.retry.random.uniform', return_value=1.0):
+            with self._submit(ConnectTimeout(), self._approve) as submit_transaction:
+                with retry.deadline(0.5):
+                    with self.assertRaises(ConnectTimeout):
+                        self._perform()
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH])
+        self.sleep.assert_not_called()
+        journal = TransactionJournalEntry.objects.get(transaction_uuid=self.transaction_uuid)
+        self.assertEqual(journal.state, TRANS_JOURNAL_NOT_SENT)
+
+
+    def test_cancel_ignores_deadline(self):
+        deadlines = []
+
+        def cancel(trans_request, **kwargs):
+            deadlines.append(retry.get_deadline())
+            return self._cancel(trans_request, **kwargs)
+
+        with mock.patch('wellsfargo.connector.retry.random.uniform', return_value=0.0):
+            with self._submit(ReadTimeout(), cancel, self._approve) as submit_transaction:
+                with retry.deadline(60):
+                    self._perform()
+        self.assertEqual(self._type_codes(submit_transaction), [TRANS_TYPE_AUTH, TRANS_TYPE_CANCEL_AUTH, TRANS_TYPE_AUTH])
+        self.assertEqual(deadlines, [None])
+
+
+
+@mock.patch('wellsfargo.methods.WFRS_CHECKOUT_PREPARE_CONCURRENTLY', True)
+class RecordPaymentConcurrentlyTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.method = WellsFargo()
+        self.order = create_order(user=self.joe)
+        self.plan = FinancingPlan.objects.create(plan_number=9999, apr='0.00', term_months=12)
+        self.request = RequestFactory().post('/api/checkout/')
+        self.request.user = self.joe
+        self.future = Future()
+        self.executor = mock.MagicMock()
+        self.executor.submit.return_value = self.future
+        patcher = mock.patch('wellsfargo.methods._get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def _approve(self, trans_request, transaction_uuid=None, **kwargs):
+        transfer = TransferMetadata()
+        transfer.user = self.joe
+        transfer.merchant_reference = transaction_uuid
+        transfer.amount = trans_request.amount
+        transfer.type_code = trans_request.type_code
+        transfer.ticket_number = trans_request.ticket_number
+        transfer.status = TRANS_APPROVED
+        transfer.message = 'approved'
+        transfer.disclosure = ''
+        transfer.account_number = trans_request.account_number
+        transfer.save()
+        return transfer
+
+
+    def _record_payment(self, decision=FraudScreenResult.DECISION_ACCEPT):
+        screener = DummyFraudProtection(decision=decision)
+        with mock.patch('wellsfargo.methods.screen_transaction', side_effect=screener.screen_transaction):
+            with mock.patch('wellsfargo.methods.actions.submit_transaction', side_effect=self._approve) as submit_transaction:
+                state = self.method._record_payment(
+                    request=self.request,
+                    order=self.order,
+                    method_key='wells-fargo',
+                    amount=Decimal('10.00'),
+                    reference='',
+                    account_number='9999999999999999',
+                    financing_plan=self.plan)
+        return state, submit_transaction
+
+
+    def test_uses_prepared_transaction(self):
+        prepared = mock.Mock()
+        self.future.set_result(prepared)
+        state, submit_transaction = self._record_payment()
+        self.assertIsInstance(state, Complete)
+        self.assertEqual(self.executor.submit.call_count, 1)
+        self.assertEqual(self.executor.submit.call_args[0][0], _prepare_transaction)
+        self.assertEqual(self.executor.submit.call_args[0][1].type_code, TRANS_TYPE_AUTH)
+        self.assertEqual(self.executor.submit.call_args[0][2], self.joe)
+        self.assertIs(submit_transaction.call_args[1]['prepared'], prepared)
+
+
+    def test_falls_back_when_preparing_fails(self):
+        self.future.set_exception(ConnectTimeout())
+        state, submit_transaction = self._record_payment()
+        self.assertIsInstance(state, Complete)
+        self.assertEqual(submit_transaction.call_count, 1)
+        self.assertIsNone(submit_transaction.call_args[1]['prepared'])
+
+
+    def test_fraud_reject_does_not_wait_for_preparation(self):
+        # Records whether checkout waits for the preparation to finish
+        self.executor.submit.return_value = mock.MagicMock(spec=Future)
+        state, submit_transaction = self._record_payment(decision=FraudScreenResult.DECISION_REJECT)
+        self.assertIsInstance(state, Declined)
+        self.executor.submit.return_value.result.assert_not_called()
+        submit_transaction.assert_not_called()
@@ -1,17 +1,24 @@
 from decimal import Decimal
 from django.contrib.auth.models import Group
+from django.db import transaction
+from django.test import TransactionTestCase
 from django.utils import timezone
 from oscar.core.loading import get_model, get_class
 from oscar.test import factories
 from wellsfargo.tests.base import BaseTest
 from wellsfargo.core.constants import TRANS_TYPE_AUTH, TRANS_APPROVED
+from wellsfargo.core.credentials import resolver as credentials_resolver
+from wellsfargo.core.plans import catalog as plan_catalog, FinancingPlanCatalog
 from wellsfargo.models import (
     APICredentials,
     TransferMetadata,
     FinancingPlan,
     FinancingPlanBenefit,
+    prefetch_financing_plans,
 )
+from wellsfargo.utils import list_plans_for_basket
 import datetime
+import mock
 import uuid
 
 Range = get_model('offer', 'Range')
@@ -76,6 +83,111 @@ class APICredentialsTest(BaseTest):
         self.assertEqual(APICredentials.get_credentials(self.joe).username, 'credsA')
 
 
+    def test_selection_is_cached(self):
+        group = Group.objects.create(name='Special Group')
+        APICredentials.objects.create(
+            username='credsA',
+            password='',
+            merchant_num='',
+            user_group=None,
+            priority=1)
+        APICredentials.objects.create(
+            username='credsB',
+            password='',
+            merchant_num='',
+            user_group=group,
+            priority=2)
+        self.joe.groups.add(group)
+        # Prime the cache
+        self.assertEqual(APICredentials.get_credentials(self.joe).username, 'credsB')
+        self.assertEqual(APICredentials.get_credentials(self.bill).username, 'credsA')
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA')
+        # Subsequent lookups should not touch the database
+        with self.assertNumQueries(0):
+            self.assertEqual(APICredentials.get_credentials(self.joe).username, 'credsB')
+            self.assertEqual(APICredentials.get_credentials(self.joe).username, 'credsB')
+            self.assertEqual(APICredentials.get_credentials(self.bill).username, 'credsA')
+            self.assertEqual(APICredentials.get_credentials().username, 'credsA')
+
+    def test_selection_cache_invalidation(self):
+        creds = APICredentials.objects.create(
+            username='credsA',
+            password='',
+            merchant_num='',
+            user_group=None,
+            priority=1)
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA')
+        # Changing a row should be reflected immediately
+        creds.username = 'credsA2'
+        creds.save()
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA2')
+        # So should adding a higher priority row
+        APICredentials.objects.create(
+            username='credsB',
+            password='',
+            merchant_num='',
+            user_group=None,
+            priority=2)
+        self.assertEqual(APICredentials.get_credentials().username, 'credsB')
+        # And deleting a row
+        APICredentials.objects.filter(username='credsB').get().delete()
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA2')
+
+    def test_selection_cache_max_age(self):
+        creds = APICredentials.objects.create(
+            username='credsA',
+            password='',
+            merchant_num='',
+            user_group=None,
+            priority=1)
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA')
+        # A change which didn't invalidate the cache, e.g. one made by a process which doesn't share it
+        APICredentials.objects.filter(pk=creds.pk).update(username='credsA2')
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA')
+        # Is picked up once the in-process table expires
+        credentials_resolver._table.loaded -= 61
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA2')
+
+    def test_selection_reverse_group_membership(self):
+        group = Group.objects.create(name='Special Group')
+        APICredentials.objects.create(
+            username='credsB',
+            password='',
+            merchant_num='',
+            user_group=group,
+            priority=2)
+        self.assertEqual(APICredentials.get_credentials(self.joe).username, 'WF1111111111111111')
+        group.user_set.add(self.joe)
+        self.assertEqual(APICredentials.get_credentials(self.joe).username, 'credsB')
+        group.user_set.clear()
+        self.assertEqual(APICredentials.get_credentials(self.joe).username, 'WF1111111111111111')
+
+
+
+class APICredentialsInvalidationTest(TransactionTestCase):
+    def _create_credentials(self):
+        return APICredentials.objects.create(username='credsA', password='', merchant_num='', user_group=None, priority=1)
+
+
+    def test_invalidates_after_commit(self):
+        version = credentials_resolver._get_version()
+        with transaction.atomic():
+            self._create_credentials()
+            # Another process reloading now would still read the old rows, so it mustn't see a new version yet
+            self.assertEqual(credentials_resolver._get_version(), version)
+        self.assertNotEqual(credentials_resolver._get_version(), version)
+        self.assertEqual(APICredentials.get_credentials().username, 'credsA')
+
+
+    def test_rollback_does_not_invalidate(self):
+        version = credentials_resolver._get_version()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self._create_credentials()
+                raise RuntimeError()
+        self.assertEqual(credentials_resolver._get_version(), version)
+
+
 
 class TransferMetadataTest(BaseTest):
     def test_account_number(self):
@@ -116,6 +228,108 @@ class TransferMetadataTest(BaseTest):
         self.assertEqual(transfer.masked_account_number, 'xxxxxxxxxxxx9991')
         self.assertEqual(transfer.account_number, 'xxxxxxxxxxxx9991')
 
+    def test_with_account_numbers(self):
+        for i in range(5):
+            transfer = TransferMetadata()
+            transfer.user = self.joe
+            transfer.credentials = self.credentials
+            transfer.merchant_reference = uuid.uuid1()
+            transfer.amount = Decimal('10.00')
+            transfer.type_code = TRANS_TYPE_AUTH
+            transfer.ticket_number = '123'
+            transfer.status = TRANS_APPROVED
+            transfer.message = 'message'
+            transfer.disclosure = 'disclosure'
+            if i < 4:
+                transfer.account_number = '999999999999999{}'.format(i)
+            transfer.save()
+
+        with mock.patch('wellsfargo.models.decrypt_account_number') as decrypt_account_number:
+            transfers = TransferMetadata.objects.order_by('id').with_account_numbers()
+            self.assertEqual([t.account_number for t in transfers], [
+                '9999999999999990',
+                '9999999999999991',
+                '9999999999999992',
+                '9999999999999993',
+                'xxxxxxxxxxxxxxxx',
+            ])
+            # Chained querysets keep decrypting in bulk
+            transfer = transfers.filter(last4_account_number='9992').first()
+            self.assertEqual(transfer.account_number, '9999999999999992')
+        self.assertEqual(decrypt_account_number.call_count, 0)
+
+
+class FinancingPlanTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        plan_catalog.invalidate()
+        self.plan1 = FinancingPlan.objects.create(plan_number=1001, apr='0.00', term_months=12, product_price_threshold='500.00', advertising_enabled=True)
+        self.plan2 = FinancingPlan.objects.create(plan_number=1002, apr='9.99', term_months=24, product_price_threshold='1000.00', advertising_enabled=True)
+        self.plan3 = FinancingPlan.objects.create(plan_number=1003, apr='5.99', term_months=24, product_price_threshold='1000.00', advertising_enabled=True)
+        self.plan4 = FinancingPlan.objects.create(plan_number=1004, apr='0.00', term_months=0, product_price_threshold='2000.00', advertising_enabled=True)
+        self.plan5 = FinancingPlan.objects.create(plan_number=1005, apr='0.00', term_months=36, product_price_threshold='3000.00', advertising_enabled=False)
+
+
+    def test_get_advertisable_plan_by_price(self):
+        self.assertIsNone(FinancingPlan.get_advertisable_plan_by_price(Decimal('499.99')))
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('500.00')), self.plan1)
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('999.99')), self.plan1)
+        # Ties on threshold go to the higher APR
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('1000.00')), self.plan2)
+        # Zero-term plans and plans with advertising disabled are skipped
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('5000.00')), self.plan2)
+        self.assertEqual(plan_catalog.get_advertisable_plan_by_price(Decimal('5000.00'), include_zero_term=True), self.plan4)
+
+
+    def test_catalog_is_cached(self):
+        FinancingPlan.get_advertisable_plan_by_price(Decimal('1000.00'))
+        with self.assertNumQueries(0):
+            plans = [FinancingPlan.get_advertisable_plan_by_price(Decimal(i * 100)) for i in range(20)]
+            self.assertIsNone(plan_catalog.get_default_plan())
+        self.assertEqual(plans, [None] * 5 + [self.plan1] * 5 + [self.plan2] * 10)
+
+
+    def test_catalog_invalidation(self):
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('1500.00')), self.plan2)
+
+        # Saving a plan invalidates the catalog
+        self.plan2.advertising_enabled = False
+        self.plan2.save()
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('1500.00')), self.plan3)
+
+        # Deleting a plan invalidates the catalog
+        self.plan3.delete()
+        self.assertEqual(FinancingPlan.get_advertisable_plan_by_price(Decimal('1500.00')), self.plan1)
+
+        # Changes made in another process reach this process via the cache
+        other_process_catalog = FinancingPlanCatalog()
+        self.assertEqual(other_process_catalog.get_advertisable_plan_by_price(Decimal('1500.00')), self.plan1)
+        FinancingPlan.objects.filter(pk=self.plan1.pk).update(is_default_plan=True)
+        plan_catalog.invalidate()
+        self.assertEqual(other_process_catalog.get_default_plan(), self.plan1)
+
+
+    def test_catalog_max_age(self):
+        self.assertIsNone(plan_catalog.get_default_plan())
+        # A change which didn't invalidate the catalog, e.g. one made by a process which doesn't share the cache
+        FinancingPlan.objects.filter(pk=self.plan1.pk).update(is_default_plan=True)
+        self.assertIsNone(plan_catalog.get_default_plan())
+        # Is picked up once the in-process table expires
+        plan_catalog._table.loaded -= 61
+        self.assertEqual(plan_catalog.get_default_plan(), self.plan1)
+
+
+class FinancingPlanInvalidationTest(TransactionTestCase):
+    def test_invalidates_after_commit(self):
+        version = plan_catalog.version
+        with transaction.atomic():
+            FinancingPlan.objects.create(plan_number=1001, term_months=12, advertising_enabled=True, is_default_plan=True)
+            # Another process reloading now would still read the old plans, so it mustn't see a new version yet
+            self.assertEqual(plan_catalog.version, version)
+        self.assertNotEqual(plan_catalog.version, version)
+        self.assertEqual(plan_catalog.get_default_plan().plan_number, 1001)
+
+
 
 class FinancingPlanBenefitTest(BaseTest):
     def test_apply_financing_offer(self):
@@ -309,6 +523,49 @@ class FinancingPlanBenefitTest(BaseTest):
         self.assertEqual(result['result'].description, None)
 
 
+    def test_list_plans_for_basket(self):
+        basket = self._create_basket()
+        offers = []
+        for i, plan_numbers in enumerate([(9999, ), (9998, ), (9997, 9996)]):
+            benefit = FinancingPlanBenefit.objects.create(group_name='Financing {}'.format(i))
+            benefit.plans.set([FinancingPlan.objects.create(plan_number=n, apr=Decimal(9999 - n)) for n in plan_numbers])
+            offers.append(self._create_offer('Financing {}'.format(i), benefit, group_name='Financing {}'.format(i), group_priority=i))
+        offer1, offer2, offer3 = ConditionalOffer.objects.filter(pk__in=[o.pk for o in offers]).order_by('pk')
+        Applicator().apply_offers(basket, [offer1, offer2, offer3])
+
+        # Plans for every financing offer are fetched in a single query
+        with self.assertNumQueries(1):
+            plans = list_plans_for_basket(basket)
+        self.assertEqual([p.plan_number for p in plans], [9999, 9998, 9997, 9996])
+
+        # The result is memoized until the basket's offers are re-applied
+        with self.assertNumQueries(0):
+            self.assertEqual(list_plans_for_basket(basket), plans)
+        Applicator().apply_offers(basket, [offer1])
+        self.assertEqual([p.plan_number for p in list_plans_for_basket(basket)], [9999])
+
+
+    def test_with_plans(self):
+        plans = [FinancingPlan.objects.create(plan_number=1001 + i) for i in range(3)]
+        for count in (1, 50):
+            FinancingPlanBenefit.objects.all().delete()
+            for i in range(count):
+                benefit = FinancingPlanBenefit.objects.create(group_name='Plan Group {}'.format(i))
+                benefit.plans.set(plans)
+            # One query for the benefits and one for all of their plans, regardless of how many benefits there are
+            with self.assertNumQueries(2):
+                benefits = list(FinancingPlanBenefit.objects.with_plans())
+                descriptions = [benefit.description for benefit in benefits]
+            self.assertEqual(len(descriptions), count)
+            self.assertEqual(descriptions[0], 'Causes the following Wells Fargo financing plans to be available: 1001, 1002, 1003')
+
+            # Benefits which have already been loaded can be prefetched too
+            benefits = list(FinancingPlanBenefit.objects.all())
+            with self.assertNumQueries(1):
+                prefetch_financing_plans(benefits)
+                self.assertEqual([[p.plan_number for p in b.plans.all()] for b in benefits], [[1001, 1002, 1003]] * count)
+
+
     def _create_product(self):
         product = factories.create_product(
             title='My Product',
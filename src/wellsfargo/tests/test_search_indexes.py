@@ -0,0 +1,283 @@
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from oscar.core.loading import get_model
+from oscar.test.factories import create_order
+from django.urls import reverse
+from wellsfargo.core.constants import TRANS_TYPE_AUTH, TRANS_APPROVED, INQUIRY_SUCCESS, PREQUAL_TRANS_STATUS_APPROVED
+from wellsfargo.methods import WellsFargo
+from wellsfargo.models import (
+    USCreditApp,
+    AccountInquiryResult,
+    TransferMetadata,
+    APICredentials,
+    PreQualificationRequest,
+    PreQualificationResponse,
+    get_order_merchant_names,
+)
+from wellsfargo.search_indexes import (
+    USCreditAppIndex,
+    PreQualificationIndex,
+    get_order_dependents,
+    get_transaction_dependents,
+    get_transfer_dependents,
+    get_inquiry_dependents,
+    get_prequal_response_dependents,
+)
+from wellsfargo.tests.base import BaseTest
+import uuid
+
+Source = get_model('payment', 'Source')
+SourceType = get_model('payment', 'SourceType')
+Transaction = get_model('payment', 'Transaction')
+
+
+class BaseIndexTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.other_credentials = APICredentials.objects.create(
+            name='Other Merchant',
+            username='WF2222222222222222',
+            password='FOOBAR',
+            merchant_num='2222222222222222',
+            user_group=None,
+            priority=2)
+
+
+    def _create_order(self, credentials, last4='0000', user=None):
+        order = create_order(user=user or self.joe)
+        transfer = TransferMetadata()
+        transfer.user = self.joe
+        transfer.credentials = credentials
+        transfer.merchant_reference = str(uuid.uuid1())
+        transfer.amount = order.total_incl_tax
+        transfer.type_code = TRANS_TYPE_AUTH
+        transfer.ticket_number = order.number
+        transfer.status = TRANS_APPROVED
+        transfer.message = 'approved'
+        transfer.disclosure = ''
+        transfer.account_number = '999999999999{}'.format(last4)
+        transfer.save()
+        source_type, _ = SourceType.objects.get_or_create(name=WellsFargo.name)
+        source = Source.objects.create(order=order, source_type=source_type, amount_allocated=order.total_incl_tax)
+        source.transactions.create(txn_type=Transaction.AUTHORISE, amount=order.total_incl_tax, reference=transfer.merchant_reference)
+        return order
+
+
+    def _create_app(self, i, email=None):
+        app = self._build_us_single_credit_app('999-99-{:04d}'.format(i))
+        app.email = email or self.joe.email
+        app.last4_account_number = '{:04d}'.format(i)
+        app.save()
+        return app
+
+
+    def _build_inquiry(self, app, credit_limit):
+        inquiry = AccountInquiryResult()
+        inquiry.credit_app_source = app
+        inquiry.status = INQUIRY_SUCCESS
+        inquiry.first_name = app.main_first_name
+        inquiry.last_name = app.main_last_name
+        inquiry.address = app.main_address_line1
+        inquiry.credit_limit = credit_limit
+        inquiry.balance = Decimal('0.00')
+        inquiry.open_to_buy = credit_limit
+        return inquiry
+
+
+    def _create_prequal(self, email, customer_order=None):
+        request = PreQualificationRequest.objects.create(
+            email=email,
+            first_name='Joe',
+            last_name='Schmoe',
+            line1='123 Evergreen Terrace',
+            city='Springfield',
+            state='NY',
+            postcode='10001',
+            phone='+1 (212) 209-1333',
+            credentials=self.credentials)
+        PreQualificationResponse.objects.create(
+            request=request,
+            status=PREQUAL_TRANS_STATUS_APPROVED,
+            message='approved',
+            offer_indicator='F1',
+            credit_limit=Decimal('5000.00'),
+            response_id='00000TKA',
+            application_url='https://localhost/ipscr.do',
+            customer_order=customer_order)
+        return request
+
+
+    def _prepare_fields(self, objs):
+        return [{name: getattr(self.index, 'prepare_{}'.format(name))(obj) for name in self.FIELDS} for obj in objs]
+
+
+
+class CreditAppIndexTest(BaseIndexTest):
+    FIELDS = ('credit_limit', 'order_total', 'order_placed', 'order_merchant_name')
+
+    def setUp(self):
+        super().setUp()
+        self.index = USCreditAppIndex()
+
+
+    def test_prefetch_matches_per_object(self):
+        apps = [self._create_app(i) for i in range(6)]
+        self._build_inquiry(apps[0], Decimal('1000.00')).save()
+        self._build_inquiry(apps[0], Decimal('2500.00')).save()
+        self._build_inquiry(apps[1], Decimal('500.00')).save()
+        orders = [
+            self._create_order(self.credentials, '0000'),
+            self._create_order(self.other_credentials, '0000'),
+            # Placed by someone else with the same card
+            self._create_order(self.other_credentials, '0002', user=self.bill),
+            self._create_order(None, '0003'),
+        ]
+
+        expected = self._prepare_fields(USCreditApp.objects.order_by('pk'))
+        self.assertEqual(expected[0], {
+            'credit_limit': Decimal('2500.00'),
+            'order_total': orders[0].total_incl_tax,
+            'order_placed': orders[0].date_placed,
+            'order_merchant_name': self.credentials.name,
+        })
+        self.assertEqual(expected[1]['credit_limit'], Decimal('500.00'))
+        self.assertIsNone(expected[2]['order_total'])
+        self.assertEqual(expected[3]['order_total'], orders[3].total_incl_tax)
+        self.assertIsNone(expected[3]['order_merchant_name'])
+
+        with CaptureQueriesContext(connection) as queries:
+            apps = list(self.index.index_queryset().order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self._prepare_fields(apps), expected)
+        self.assertEqual(len(queries), 7)
+
+
+    def test_queries_per_chunk(self):
+        """The number of queries needed to prepare a chunk of applications doesn't depend on its size"""
+        num_apps = 1000
+        chunk_size = 250
+        template = self._create_app(0)
+        USCreditApp.objects.filter(pk=template.pk).delete()
+        apps = []
+        for i in range(num_apps):
+            template.pk = None
+            template.last4_account_number = '{:04d}'.format(i)
+            apps.append(USCreditApp(**{f.attname: getattr(template, f.attname) for f in USCreditApp._meta.concrete_fields}))
+        USCreditApp.objects.bulk_create(apps)
+        apps = list(USCreditApp.objects.order_by('pk')[:100])
+        AccountInquiryResult.objects.bulk_create([self._build_inquiry(app, Decimal('1000.00')) for app in apps])
+        for app in apps[:10]:
+            self._create_order(self.credentials, app.last4_account_number)
+
+        qs = self.index.index_queryset().order_by('pk')
+        queries_per_chunk = []
+        for start in range(0, num_apps, chunk_size):
+            with CaptureQueriesContext(connection) as queries:
+                self._prepare_fields(qs[start:start + chunk_size])
+            queries_per_chunk.append(len(queries))
+        # Per-object preparation takes 4+ queries per application
+        self.assertEqual(len(queries_per_chunk), 4)
+        self.assertLessEqual(max(queries_per_chunk), 7)
+
+
+
+class PreQualificationIndexTest(BaseIndexTest):
+    FIELDS = ('order_total', 'order_date_placed', 'order_merchant_name')
+
+    def setUp(self):
+        super().setUp()
+        self.index = PreQualificationIndex()
+
+
+    def test_prefetch_matches_per_object(self):
+        prequals = [
+            self._create_prequal(self.joe.email),
+            self._create_prequal(self.bill.email),
+            self._create_prequal('nobody@example.com'),
+        ]
+        joe_order = self._create_order(self.credentials)
+        bill_order = self._create_order(self.other_credentials, user=self.bill)
+        prequals.append(self._create_prequal(self.joe.email, customer_order=bill_order))
+        # Placed before the request, so it can't have resulted from it
+        prequals.append(self._create_prequal(self.bill.email))
+
+        expected = self._prepare_fields(PreQualificationRequest.objects.order_by('pk'))
+        self.assertEqual([fields['order_merchant_name'] for fields in expected], [
+            self.credentials.name,
+            self.other_credentials.name,
+            None,
+            self.other_credentials.name,
+            None,
+        ])
+        self.assertEqual(expected[0]['order_total'], joe_order.total_incl_tax)
+
+        with CaptureQueriesContext(connection) as queries:
+            prequals = list(self.index.index_queryset().order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self._prepare_fields(prequals), expected)
+        self.assertEqual(len(queries), 5)
+
+
+    def test_order_merchant_names(self):
+        orders = [self._create_order(self.credentials), self._create_order(self.other_credentials), create_order()]
+        with self.assertNumQueries(2):
+            merchant_names = get_order_merchant_names(orders)
+        self.assertEqual(merchant_names, {
+            orders[0].pk: self.credentials.name,
+            orders[1].pk: self.other_credentials.name,
+        })
+
+        # Shown on the pre-qualification dashboard
+        prequal = self._create_prequal(self.joe.email, customer_order=orders[1])
+        self.client.login(username='bill', password='schmoe')
+        response = self.client.get(reverse('wfrs-prequal-detail', args=[prequal.uuid]))
+        self.assertContains(response, self.other_credentials.name)
+
+
+
+class IndexDependenciesTest(BaseIndexTest):
+    def _dependents(self, dependents):
+        return {Model: pks for Model, pks in dependents.items() if pks}
+
+
+    def test_order_dependents(self):
+        apps = [self._create_app(1), self._create_app(2), self._create_app(3, email=self.bill.email)]
+        # Same card, different email
+        apps[2].last4_account_number = '0001'
+        apps[2].save()
+        prequals = [
+            self._create_prequal(self.joe.email),
+            self._create_prequal(self.bill.email),
+            # Resulted in a different order
+            self._create_prequal(self.joe.email, customer_order=create_order()),
+        ]
+        order = self._create_order(self.credentials, '0001')
+        prequals.append(self._create_prequal('nobody@example.com', customer_order=order))
+        # Placed after the order
+        apps.append(self._create_app(4))
+        apps[3].last4_account_number = '0001'
+        apps[3].save()
+        prequals.append(self._create_prequal(self.joe.email))
+        transfer = TransferMetadata.objects.get(ticket_number=order.number)
+
+        expected = {
+            TransferMetadata: {transfer.pk},
+            USCreditApp: {apps[0].pk},
+            PreQualificationRequest: {prequals[0].pk, prequals[3].pk},
+        }
+        self.assertEqual(self._dependents(get_order_dependents([order])), expected)
+        self.assertEqual(self._dependents(get_transaction_dependents(Transaction.objects.filter(source__order=order))), expected)
+        self.assertEqual(self._dependents(get_transfer_dependents([transfer])), expected)
+
+        # Payments by other methods don't affect WFRS documents
+        other = Transaction(source=Source.objects.get(order=order), txn_type=Transaction.AUTHORISE, amount=Decimal('1.00'), reference='other')
+        self.assertEqual(self._dependents(get_transaction_dependents([other])), {})
+
+
+    def test_response_and_inquiry_dependents(self):
+        prequal = self._create_prequal(self.joe.email)
+        self.assertEqual(get_prequal_response_dependents([prequal.response]), {PreQualificationRequest: {prequal.pk}})
+        app = self._create_app(1)
+        inquiry = self._build_inquiry(app, Decimal('1000.00'))
+        self.assertEqual(self._dependents(get_inquiry_dependents([inquiry])), {USCreditApp: {app.pk}})
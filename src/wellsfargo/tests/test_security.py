@@ -1,16 +1,22 @@
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from mock import patch
 from wellsfargo.security import (
     encrypt_account_number,
     decrypt_account_number,
+    decrypt_account_numbers,
+    reset_encryptors,
+    _get_encryptor,
     WFRS_SECURITY,
 )
 from wellsfargo.security.fernet import FernetEncryption
 from wellsfargo.security.kms import KMSEncryption
 from wellsfargo.security.multi import MultiEncryption
+import boto3
 import botocore
 import base64
 import binascii
+import os
 
 
 FERNET_KEY_1 = b'U3Nyi57e55H2weKVmEPzrGdv18b0bGt3e542rg1J1N8='
@@ -22,6 +28,12 @@ _orig_make_api_call = botocore.client.BaseClient._make_api_call
 
 
 def mock_make_api_call(self, operation_name, kwargs):
+    if operation_name == 'GenerateDataKey':
+        plain_key = os.urandom(32)
+        return {
+            "Plaintext": plain_key,
+            "CiphertextBlob": base64.b64encode(plain_key),
+        }
     if operation_name == 'Encrypt':
         return {
             "CiphertextBlob": base64.b64encode(kwargs["Plaintext"]),
@@ -213,4 +225,342 @@ class AccountNumberTokenizationTest(TestCase):
         self.assertIsNone(fernet1.decrypt(blob5))
         self.assertIsNone(fernet2.decrypt(blob5))
         self.assertIsNone(fernet3.decrypt(blob5))
-        self.assertEqual(kms1.decrypt(blob5), acct5)
+        self.assertTrue(blob5.startswith(b'$'))
+        self.assertEqual(kms1.decrypt(blob5.split(b'$', 2)[2]), acct5)
+
+
+
+class UnidentifiedEncryption(object):
+    def encrypt(self, value):
+        return value
+
+    def decrypt(self, blob):
+        return blob
+
+
+
+class MultiEncryptionTaggingTest(TestCase):
+    def _build_encryptor(self, *keys, **kwargs):
+        return MultiEncryption(encryptors=[
+            {
+                'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                'encryptor_kwargs': {
+                    'key': key,
+                },
+            } for key in keys
+        ], **kwargs)
+
+
+    def test_tagged_blobs_skip_trial_decryption(self):
+        old = self._build_encryptor(FERNET_KEY_1)
+        old_blob = old.encrypt('9999999999999991')
+        self.assertTrue(old_blob.startswith(b'$'))
+
+        # Rotate keys
+        multi = self._build_encryptor(FERNET_KEY_3, FERNET_KEY_2, FERNET_KEY_1)
+        new_blob = multi.encrypt('9999999999999992')
+        self.assertNotEqual(new_blob.split(b'$')[1], old_blob.split(b'$')[1])
+
+        with patch.object(FernetEncryption, 'decrypt', autospec=True, side_effect=FernetEncryption.decrypt) as decrypt:
+            self.assertEqual(multi.decrypt(old_blob), '9999999999999991')
+            self.assertEqual(multi.decrypt(memoryview(new_blob)), '9999999999999992')
+        self.assertEqual(decrypt.call_count, 2)
+        self.assertIs(decrypt.call_args_list[0][0][0], multi.children[2])
+        self.assertIs(decrypt.call_args_list[1][0][0], multi.children[0])
+        self.assertEqual(multi.fallback_count, 0)
+
+
+    def test_legacy_blobs_fall_back_to_trial_decryption(self):
+        legacy_blob = FernetEncryption(FERNET_KEY_1).encrypt('9999999999999991')
+        multi = self._build_encryptor(FERNET_KEY_3, FERNET_KEY_2, FERNET_KEY_1)
+        self.assertEqual(multi.decrypt(legacy_blob), '9999999999999991')
+        self.assertEqual(multi.fallback_count, 1)
+
+        # Unknown tags (e.g. after changing a key_id) are also decrypted by trial
+        unknown_blob = b'$nope$' + legacy_blob
+        self.assertEqual(multi.decrypt(unknown_blob), '9999999999999991')
+        self.assertEqual(multi.fallback_count, 2)
+
+        blobs = [multi.encrypt('9999999999999992'), legacy_blob, multi.encrypt('9999999999999993'), FernetEncryption(FERNET_KEY_2).encrypt('9999999999999994')]
+        self.assertEqual(multi.decrypt_many(blobs), ['9999999999999992', '9999999999999991', '9999999999999993', '9999999999999994'])
+        self.assertEqual(multi.fallback_count, 4)
+
+
+    def test_explicit_key_ids(self):
+        multi = MultiEncryption(encryptors=[
+            {
+                'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                'key_id': 'f2',
+                'encryptor_kwargs': {
+                    'key': FERNET_KEY_2,
+                },
+            },
+        ])
+        blob = multi.encrypt('9999999999999991')
+        self.assertTrue(blob.startswith(b'$f2$'))
+        self.assertEqual(multi.decrypt(blob), '9999999999999991')
+        with self.assertRaises(ImproperlyConfigured):
+            MultiEncryption(encryptors=[
+                {
+                    'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                    'key_id': 'f$2',
+                    'encryptor_kwargs': {
+                        'key': FERNET_KEY_2,
+                    },
+                },
+            ])
+
+
+    def test_tags_only_depend_on_key_identity(self):
+        def build(*configs):
+            return MultiEncryption(encryptors=[{'encryptor': klass, 'encryptor_kwargs': kwargs} for klass, kwargs in configs])
+
+        fernet = 'wellsfargo.security.fernet.FernetEncryption'
+        kms = 'wellsfargo.security.kms.KMSEncryption'
+        multi = build(
+            (fernet, {'key': FERNET_KEY_1}),
+            (kms, {'key_id': KMS_KEY_ARN, 'region_name': 'us-east-1'}))
+        # Operational settings, or passing the same key as a str, don't change the tags
+        changed = build(
+            (fernet, {'key': FERNET_KEY_1.decode()}),
+            (kms, {'key_id': KMS_KEY_ARN, 'region_name': 'us-west-2', 'max_workers': 2, 'envelope': True, 'data_key_max_age': 60}))
+        self.assertEqual(changed.tags, multi.tags)
+        # Other keys do
+        other = build(
+            (fernet, {'key': FERNET_KEY_2}),
+            (kms, {'key_id': 'alias/other', 'region_name': 'us-east-1'}))
+        self.assertNotEqual(other.tags[0], multi.tags[0])
+        self.assertNotEqual(other.tags[1], multi.tags[1])
+
+        # Encryptors which can't identify their key need an explicit key_id
+        with self.assertRaises(ImproperlyConfigured):
+            build(('wellsfargo.tests.test_security.UnidentifiedEncryption', {}))
+        multi = MultiEncryption(encryptors=[{'encryptor': 'wellsfargo.tests.test_security.UnidentifiedEncryption', 'key_id': 'u1'}])
+        self.assertEqual(multi.tags, [b'u1'])
+
+
+    def test_untagged_mode(self):
+        multi = self._build_encryptor(FERNET_KEY_2, tag_blobs=False)
+        blob = multi.encrypt('9999999999999991')
+        self.assertEqual(FernetEncryption(FERNET_KEY_2).decrypt(blob), '9999999999999991')
+        self.assertEqual(multi.decrypt(blob), '9999999999999991')
+        self.assertEqual(multi.fallback_count, 1)
+
+
+class KMSEnvelopeEncryptionTest(TestCase):
+    def _build_encryptor(self, **kwargs):
+        return KMSEncryption(KMS_KEY_ARN, envelope=True, region_name='us-east-1', encryption_context={
+            'AppName': 'Oscar E-Commerce'
+        }, **kwargs)
+
+
+    @mock_kms
+    def test_round_trip(self):
+        encryptor = self._build_encryptor()
+        blob1 = encryptor.encrypt('9999999999999991')
+        blob2 = encryptor.encrypt('9999999999999992')
+        self.assertTrue(blob1.startswith(b'env1:'))
+        self.assertNotEqual(blob1, blob2)
+        self.assertEqual(encryptor.decrypt(blob1), '9999999999999991')
+        self.assertEqual(encryptor.decrypt(blob2), '9999999999999992')
+        # Tampered data shouldn't decrypt
+        self.assertIsNone(encryptor.decrypt(blob1[:-4] + b'AAA='))
+        self.assertIsNone(encryptor.decrypt(b'env1:!!!'))
+
+
+    @mock_kms
+    def test_steady_state_is_local(self):
+        encryptor = self._build_encryptor()
+        with patch.object(encryptor.client, 'generate_data_key', wraps=encryptor.client.generate_data_key) as generate_data_key, \
+                patch.object(encryptor.client, 'decrypt', wraps=encryptor.client.decrypt) as decrypt, \
+                patch.object(encryptor.client, 'encrypt', wraps=encryptor.client.encrypt) as encrypt:
+            blobs = [encryptor.encrypt('99999999999999{:02d}'.format(i)) for i in range(20)]
+            values = [encryptor.decrypt(blob) for blob in blobs]
+        self.assertEqual(values, ['99999999999999{:02d}'.format(i) for i in range(20)])
+        self.assertEqual(generate_data_key.call_count, 1)
+        self.assertEqual(decrypt.call_count, 0)
+        self.assertEqual(encrypt.call_count, 0)
+
+        # A different process (with a cold cache) unwraps each data key once
+        encryptor2 = self._build_encryptor()
+        with patch.object(encryptor2.client, 'decrypt', wraps=encryptor2.client.decrypt) as decrypt:
+            values = [encryptor2.decrypt(blob) for blob in blobs]
+        self.assertEqual(values, ['99999999999999{:02d}'.format(i) for i in range(20)])
+        self.assertEqual(decrypt.call_count, 1)
+
+
+    @mock_kms
+    def test_data_key_limits(self):
+        encryptor = self._build_encryptor(data_key_max_uses=3, data_key_max_age=60)
+        with patch.object(encryptor.client, 'generate_data_key', wraps=encryptor.client.generate_data_key) as generate_data_key:
+            with patch('time.monotonic', return_value=1000):
+                blobs = [encryptor.encrypt('9999999999999991') for i in range(7)]
+            self.assertEqual(generate_data_key.call_count, 3)
+            with patch('time.monotonic', return_value=1061):
+                blobs.append(encryptor.encrypt('9999999999999991'))
+            self.assertEqual(generate_data_key.call_count, 4)
+        self.assertEqual(set(encryptor.decrypt(blob) for blob in blobs), {'9999999999999991'})
+
+
+    @mock_kms
+    def test_interoperability(self):
+        envelope = self._build_encryptor()
+        legacy = KMSEncryption(KMS_KEY_ARN, region_name='us-east-1', encryption_context={
+            'AppName': 'Oscar E-Commerce'
+        })
+        fernet = FernetEncryption(FERNET_KEY_1)
+        envelope_blob = envelope.encrypt('9999999999999991')
+        legacy_blob = legacy.encrypt('9999999999999992')
+        fernet_blob = fernet.encrypt('9999999999999993')
+
+        # Either KMS mode can decrypt either format
+        self.assertEqual(envelope.decrypt(legacy_blob), '9999999999999992')
+        self.assertEqual(legacy.decrypt(envelope_blob), '9999999999999991')
+        self.assertIsNone(fernet.decrypt(envelope_blob))
+
+        multi = MultiEncryption(encryptors=[
+            {
+                'encryptor': 'wellsfargo.security.kms.KMSEncryption',
+                'encryptor_kwargs': {
+                    'key_id': KMS_KEY_ARN,
+                    'envelope': True,
+                    'region_name': 'us-east-1',
+                    'encryption_context': {
+                        'AppName': 'Oscar E-Commerce',
+                    },
+                },
+            },
+            {
+                'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                'encryptor_kwargs': {
+                    'key': FERNET_KEY_1,
+                },
+            },
+        ])
+        blob = multi.encrypt('9999999999999994')
+        self.assertTrue(blob.split(b'$', 2)[2].startswith(b'env1:'))
+        self.assertEqual(multi.decrypt(blob), '9999999999999994')
+        self.assertEqual(multi.decrypt(envelope_blob), '9999999999999991')
+        self.assertEqual(multi.decrypt(fernet_blob), '9999999999999993')
+
+
+class BulkDecryptionTest(TestCase):
+
+    @patch_encryptor('wellsfargo.security.fernet.FernetEncryption', key=FERNET_KEY_1)
+    def test_facade_fernet(self):
+        blob1 = encrypt_account_number('9999999999999991')
+        blob2 = encrypt_account_number('9999999999999992')
+        blob3 = FernetEncryption(FERNET_KEY_2).encrypt('9999999999999993')
+        self.assertEqual(decrypt_account_numbers([blob1, None, blob2, b'', blob3]), [
+            '9999999999999991',
+            None,
+            '9999999999999992',
+            None,
+            None,
+        ])
+        self.assertEqual(decrypt_account_numbers([]), [])
+
+
+    @mock_kms
+    def test_kms_decrypt_many(self):
+        encryptor = KMSEncryption(KMS_KEY_ARN, max_workers=4, region_name='us-east-1', encryption_context={
+            'AppName': 'Oscar E-Commerce'
+        })
+        accts = ['99999999999999{:02d}'.format(i) for i in range(20)]
+        blobs = [encryptor.encrypt(acct) for acct in accts]
+        self.assertEqual(encryptor.decrypt_many(blobs), accts)
+        self.assertEqual(encryptor.decrypt_many(blobs[:1]), accts[:1])
+        self.assertEqual(encryptor.decrypt_many([b'not base64']), [None])
+
+
+    def test_multi_decrypt_many(self):
+        fernet1 = FernetEncryption(FERNET_KEY_1)
+        fernet2 = FernetEncryption(FERNET_KEY_2)
+        fernet3 = FernetEncryption(FERNET_KEY_3)
+        multi = MultiEncryption(encryptors=[
+            {
+                'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                'encryptor_kwargs': {
+                    'key': FERNET_KEY_2,
+                },
+            },
+            {
+                'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                'encryptor_kwargs': {
+                    'key': FERNET_KEY_1,
+                },
+            },
+        ])
+        blobs = [
+            fernet1.encrypt('9999999999999991'),
+            fernet2.encrypt('9999999999999992'),
+            fernet3.encrypt('9999999999999993'),
+            fernet1.encrypt('9999999999999994'),
+        ]
+        self.assertEqual(multi.decrypt_many(blobs), [
+            '9999999999999991',
+            '9999999999999992',
+            None,
+            '9999999999999994',
+        ])
+
+
+class EncryptorCacheTest(TestCase):
+    def setUp(self):
+        reset_encryptors()
+
+    def tearDown(self):
+        reset_encryptors()
+
+
+    def test_encryptor_is_reused(self):
+        encryptor1 = _get_encryptor('wellsfargo.security.fernet.FernetEncryption', {'key': FERNET_KEY_1})
+        encryptor2 = _get_encryptor('wellsfargo.security.fernet.FernetEncryption', {'key': FERNET_KEY_1})
+        encryptor3 = _get_encryptor('wellsfargo.security.fernet.FernetEncryption', {'key': FERNET_KEY_2})
+        self.assertIs(encryptor1, encryptor2)
+        self.assertIsNot(encryptor1, encryptor3)
+
+        reset_encryptors()
+        encryptor4 = _get_encryptor('wellsfargo.security.fernet.FernetEncryption', {'key': FERNET_KEY_1})
+        self.assertIsNot(encryptor1, encryptor4)
+        self.assertEqual(encryptor4.decrypt(encryptor1.encrypt('9999999999999991')), '9999999999999991')
+
+
+    @mock_kms
+    @patch_encryptor('wellsfargo.security.kms.KMSEncryption', key_id=KMS_KEY_ARN, region_name='us-east-1', encryption_context={
+        'AppName': 'Oscar E-Commerce',
+    })
+    def test_kms_client_is_built_once(self):
+        with patch('boto3.client', wraps=boto3.client) as client:
+            blob1 = encrypt_account_number('9999999999999991')
+            blob2 = encrypt_account_number('9999999999999992')
+            self.assertEqual(decrypt_account_number(blob1), '9999999999999991')
+            self.assertEqual(decrypt_account_number(blob2), '9999999999999992')
+        self.assertEqual(client.call_count, 1)
+
+
+    def test_multi_builds_children_once(self):
+        kwargs = {
+            'encryptors': [
+                {
+                    'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                    'encryptor_kwargs': {
+                        'key': FERNET_KEY_2,
+                    },
+                },
+                {
+                    'encryptor': 'wellsfargo.security.fernet.FernetEncryption',
+                    'encryptor_kwargs': {
+                        'key': FERNET_KEY_1,
+                    },
+                },
+            ],
+        }
+        multi = _get_encryptor('wellsfargo.security.multi.MultiEncryption', kwargs)
+        self.assertIs(_get_encryptor('wellsfargo.security.multi.MultiEncryption', kwargs), multi)
+        self.assertIs(multi.children[1], _get_encryptor('wellsfargo.security.fernet.FernetEncryption', {'key': FERNET_KEY_1}))
+
+        blob = FernetEncryption(FERNET_KEY_1).encrypt('9999999999999991')
+        with patch('wellsfargo.security.fernet.Fernet') as Fernet:
+            self.assertEqual(multi.decrypt(blob), '9999999999999991')
+        self.assertEqual(Fernet.call_count, 0)
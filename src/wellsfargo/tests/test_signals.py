@@ -0,0 +1,142 @@
+from decimal import Decimal
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from haystack import connections as haystack_connections, connection_router
+from wellsfargo.core.constants import TRANS_TYPE_AUTH, TRANS_APPROVED, PREQUAL_TRANS_STATUS_APPROVED
+from wellsfargo.models import (
+    TransferMetadata,
+    APICredentials,
+    PreQualificationRequest,
+    PreQualificationResponse,
+    SearchIndexQueueEntry,
+)
+from wellsfargo.search_indexes import get_prequal_response_dependents
+from wellsfargo.signals import QueuedSignalProcessor, enqueue_index_updates, process_index_queue
+from wellsfargo.tests.base import BaseTest
+import mock
+import uuid
+
+
+class QueuedSignalProcessorTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        # Replace the configured signal processor
+        signal_processor = apps.get_app_config('haystack').signal_processor
+        signal_processor.teardown()
+        self.addCleanup(signal_processor.setup)
+        self.processor = QueuedSignalProcessor(haystack_connections, connection_router)
+        self.addCleanup(self.processor.teardown)
+        self.backend = mock.MagicMock()
+        patcher = mock.patch.object(haystack_connections['default'], 'get_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def _create_transfer(self):
+        transfer = TransferMetadata()
+        transfer.user = self.joe
+        transfer.credentials = self.credentials
+        transfer.merchant_reference = uuid.uuid1()
+        transfer.amount = Decimal('10.00')
+        transfer.type_code = TRANS_TYPE_AUTH
+        transfer.ticket_number = '123'
+        transfer.status = TRANS_APPROVED
+        transfer.message = 'message'
+        transfer.disclosure = 'disclosure'
+        transfer.account_number = '9999999999999999'
+        transfer.save()
+        return transfer
+
+
+    def _queued(self):
+        return sorted(SearchIndexQueueEntry.objects.values_list('content_type__model', 'object_id'))
+
+
+    def test_enqueues_indexed_objects(self):
+        transfers = [self._create_transfer() for i in range(3)]
+        # Saving an object again doesn't queue it twice
+        transfers[0].message = 'changed'
+        transfers[0].save()
+        # Not indexed
+        APICredentials.objects.create(username='WF2222222222222222', password='FOOBAR', merchant_num='2222222222222222')
+        self.assertEqual(self._queued(), [('transfermetadata', t.pk) for t in transfers])
+        self.backend.update.assert_not_called()
+
+
+    def test_enqueues_dependent_documents(self):
+        request = PreQualificationRequest.objects.create(
+            email=self.joe.email,
+            first_name='Joe',
+            last_name='Schmoe',
+            line1='123 Evergreen Terrace',
+            city='Springfield',
+            state='NY',
+            postcode='10001',
+            phone='+1 (212) 209-1333',
+            credentials=self.credentials)
+        SearchIndexQueueEntry.objects.all().delete()
+        get_dependents = mock.Mock(wraps=get_prequal_response_dependents)
+        with mock.patch.dict('wellsfargo.signals.INDEX_DEPENDENCIES', {PreQualificationResponse: get_dependents}):
+            response = PreQualificationResponse.objects.create(
+                request=request,
+                status=PREQUAL_TRANS_STATUS_APPROVED,
+                message='approved',
+                offer_indicator='F1',
+                credit_limit=Decimal('5000.00'),
+                response_id='00000TKA',
+                application_url='https://localhost/ipscr.do')
+            # Saving only queues the response itself...
+            self.assertEqual(self._queued(), [('prequalificationresponse', response.pk)])
+            get_dependents.assert_not_called()
+
+            # ...and processing the queue updates the documents which depend on it
+            self.assertEqual(process_index_queue(), {'entries': 1, 'updated': 1, 'removed': 0})
+            get_dependents.assert_called_once_with([response])
+        self.assertEqual([obj.pk for obj in self.backend.update.call_args[0][1]], [request.pk])
+
+        # Deleted objects can't be looked up later, so deleting one queues its dependents (found from its fields)
+        response.delete()
+        self.assertEqual(self._queued(), [('prequalificationrequest', request.pk)])
+
+
+    def test_skips_entries_queued_concurrently(self):
+        transfers = [self._create_transfer() for i in range(2)]
+        SearchIndexQueueEntry.objects.all().delete()
+        SearchIndexQueueEntry.objects.create(content_type=ContentType.objects.get_for_model(TransferMetadata), object_id=transfers[0].pk)
+        # The first transfer is queued (e.g. by another process) after checking which ones are already queued
+        with mock.patch.object(SearchIndexQueueEntry.objects, 'filter', return_value=SearchIndexQueueEntry.objects.none()):
+            enqueue_index_updates(TransferMetadata, [t.pk for t in transfers])
+        self.assertEqual(self._queued(), [('transfermetadata', t.pk) for t in transfers])
+
+
+    def test_process_index_queue(self):
+        transfers = [self._create_transfer() for i in range(3)]
+        deleted_pk = transfers[2].pk
+        transfers[2].delete()
+        self.assertEqual(len(self._queued()), 3)
+
+        counts = process_index_queue(batch_size=2)
+        self.assertEqual(counts, {'entries': 2, 'updated': 2, 'removed': 0})
+        self.assertEqual(len(self._queued()), 1)
+        counts = process_index_queue(batch_size=2)
+        self.assertEqual(counts, {'entries': 1, 'updated': 0, 'removed': 1})
+        self.assertEqual(self._queued(), [])
+
+        # Each batch is posted in one request
+        self.assertEqual(self.backend.update.call_count, 1)
+        self.assertEqual([obj.pk for obj in self.backend.update.call_args[0][1]], [transfers[0].pk, transfers[1].pk])
+        self.backend.remove.assert_called_once_with('wellsfargo.transfermetadata.{}'.format(deleted_pk))
+
+
+    def test_backend_failure_requeues(self):
+        transfer = self._create_transfer()
+        self.backend.update.side_effect = ConnectionError()
+        with self.assertRaises(ConnectionError):
+            process_index_queue()
+        self.assertEqual(self._queued(), [('transfermetadata', transfer.pk)])
+
+
+    def test_discards_unindexed_models(self):
+        SearchIndexQueueEntry.objects.create(content_type=ContentType.objects.get_for_model(APICredentials), object_id=self.credentials.pk)
+        self.assertEqual(process_index_queue(), {'entries': 1, 'updated': 0, 'removed': 0})
+        self.assertEqual(self._queued(), [])
@@ -1,9 +1,23 @@
-from django.test import TestCase
+from decimal import Decimal
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test import TestCase, RequestFactory
 from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
+from oscar.core.loading import get_class
+from oscar.test import factories
+from wellsfargo.core.plans import catalog as plan_catalog
 from wellsfargo.models import FinancingPlan
+from wellsfargo.tests.base import run_on_commit_immediately
+
+Selector = get_class('partner.strategy', 'Selector')
 
 
 class TestDefaultPlanTag(TestCase):
+    def setUp(self):
+        run_on_commit_immediately(self)
+
+
     def render_template(self, string, context=None):
         context = context or {}
         context = Context(context)
@@ -27,3 +41,68 @@ class TestDefaultPlanTag(TestCase):
             '{{ default_plan }}'
         )
         self.assertIn('2', rendered)
+
+
+
+class TestPlansForProductsTag(TestCase):
+    NUM_PRODUCTS = 48
+
+    def setUp(self):
+        run_on_commit_immediately(self)
+        plan_catalog.invalidate()
+        self.plan1 = FinancingPlan.objects.create(plan_number=1001, term_months=12, product_price_threshold='100.00', advertising_enabled=True)
+        self.plan2 = FinancingPlan.objects.create(plan_number=1002, term_months=24, product_price_threshold='1000.00', advertising_enabled=True)
+        self.products = [factories.create_product(price=Decimal(50 * (i + 1))) for i in range(self.NUM_PRODUCTS)]
+
+
+    def build_request(self):
+        request = RequestFactory().get('/catalogue/')
+        request.user = AnonymousUser()
+        request.strategy = Selector().strategy(request)
+        return request
+
+
+    def expected_plan(self, product):
+        price = product.stockrecords.first().price_excl_tax
+        return self.plan2 if price >= 1000 else self.plan1 if price >= 100 else None
+
+
+    def render_template(self, string, context):
+        return Template(string).render(Context(context))
+
+
+    def test_get_plans_for_products(self):
+        expected = [self.expected_plan(p) for p in self.products]
+        products = list(factories.ProductFactory._meta.model.objects.filter(pk__in=[p.pk for p in self.products]).order_by('pk'))
+        plan_catalog.get_plans()
+
+        # One query for product classes and one for stock records, no matter how many products there are
+        request = self.build_request()
+        with self.assertNumQueries(2):
+            rendered = self.render_template(
+                '{% load wfrs_default_plan %}'
+                '{% get_plans_for_products request products as product_plans %}'
+                '{% for product, plan in product_plans %}{{ product.pk }}:{{ plan.plan_number }},{% endfor %}'
+                '{% for product in products %}{% get_plan_for_product request product as plan %}{{ plan.plan_number }},{% endfor %}',
+                {'request': request, 'products': products})
+        batched, single = rendered.split(',', self.NUM_PRODUCTS)[:self.NUM_PRODUCTS], rendered.split(',')[self.NUM_PRODUCTS:-1]
+        self.assertEqual(batched, ['{}:{}'.format(p.pk, plan.plan_number if plan else '') for p, plan in zip(products, expected)])
+        self.assertEqual(single, [str(plan.plan_number) if plan else '' for plan in expected])
+
+
+    def test_query_counts(self):
+        """Compare the queries made by the per-product tag and the batched tag over a 48 product listing page"""
+        plan_catalog.get_plans()
+        Product = factories.ProductFactory._meta.model
+        ids = [p.pk for p in self.products]
+        single = '{% for product in products %}{% get_plan_for_product request product as plan %}{{ plan.pk }}{% endfor %}'
+        batched = '{% get_plans_for_products request products as product_plans %}{% for product, plan in product_plans %}{{ plan.pk }}{% endfor %}'
+
+        products = list(Product.objects.filter(pk__in=ids))
+        with self.assertNumQueries(2):
+            self.render_template('{% load wfrs_default_plan %}' + batched, {'request': self.build_request(), 'products': products})
+
+        products = list(Product.objects.filter(pk__in=ids))
+        with CaptureQueriesContext(connection) as queries:
+            self.render_template('{% load wfrs_default_plan %}' + single, {'request': self.build_request(), 'products': products})
+        self.assertGreaterEqual(len(queries), self.NUM_PRODUCTS)
@@ -0,0 +1,45 @@
+from decimal import Decimal
+from django.test import SimpleTestCase
+from wellsfargo.models import FinancingPlan
+from wellsfargo.utils import calculate_monthly_payments, calculate_monthly_payments_matrix, PaymentFactors
+import mock
+import random
+
+
+class CalculateMonthlyPaymentsMatrixTest(SimpleTestCase):
+    def setUp(self):
+        rand = random.Random(1234)
+        self.principals = [Decimal('0.01'), Decimal('1.00'), Decimal('99.99'), Decimal('2159.99'), Decimal('1000000.00')]
+        self.principals += [Decimal(rand.randint(1, 5000000)) / 100 for i in range(200)]
+        self.plans = [
+            FinancingPlan(term_months=0, apr=Decimal('0.00')),
+            FinancingPlan(term_months=0, apr=Decimal('27.99')),
+            FinancingPlan(term_months=12, apr=Decimal('0.00')),
+            FinancingPlan(term_months=7, apr=Decimal('0.00')),
+            FinancingPlan(term_months=12, apr=Decimal('9.99')),
+            FinancingPlan(term_months=24, apr=Decimal('9.99')),
+            FinancingPlan(term_months=60, apr=Decimal('27.99')),
+            FinancingPlan(term_months=1, apr=Decimal('100.00')),
+            FinancingPlan(term_months=12, apr=Decimal('0.01')),
+            FinancingPlan(term_months=12, apr=Decimal('9.99')),
+        ]
+        self.plans += [FinancingPlan(term_months=rand.randint(1, 72), apr=Decimal(rand.randint(1, 10000)) / 100) for i in range(40)]
+
+
+    def test_matches_scalar_function(self):
+        matrix = calculate_monthly_payments_matrix(self.principals, self.plans)
+        self.assertEqual(len(matrix), len(self.principals))
+        for principal, row in zip(self.principals, matrix):
+            self.assertEqual(len(row), len(self.plans))
+            for plan, payment in zip(self.plans, row):
+                expected = calculate_monthly_payments(principal, plan.term_months, plan.apr)
+                # Compare the exact representation (digits and exponent), not just the numeric value
+                self.assertEqual(payment.as_tuple(), expected.as_tuple(), (principal, plan.term_months, plan.apr))
+
+
+    def test_factors_are_computed_once_per_plan(self):
+        plans = [FinancingPlan(term_months=12, apr=Decimal('9.99')) for i in range(5)]
+        with mock.patch('wellsfargo.utils.PaymentFactors', wraps=PaymentFactors) as factors:
+            matrix = calculate_monthly_payments_matrix([Decimal('100.00'), Decimal('200.00')], plans)
+        factors.assert_called_once_with(12, Decimal('9.99'))
+        self.assertEqual(matrix, [[Decimal('8.80')] * 5, [Decimal('17.59')] * 5])
@@ -1,16 +1,45 @@
-from decimal import ROUND_UP
-from .models import FinancingPlanBenefit
+from decimal import Decimal, ROUND_UP
+from django.db.models import prefetch_related_objects
+from .core.plans import catalog as plan_catalog
+from .core.quotes import catalog as quote_catalog, PaymentQuote
+from .models import FinancingPlanBenefit, prefetch_financing_plans
+
+#: Precision of the monthly payments in payment quotes, precomputed or not
+CENTS = Decimal('0.01')
+
+#: Request attribute used to remember which plan to advertise for each product, by product ID
+PRODUCT_PLANS_REQUEST_ATTR = '_wfrs_product_plans'
+
+#: Basket attribute used to memoize the plans made available to it by offers, along with its offer application state
+BASKET_PLANS_ATTR = '_wfrs_basket_plans'
 
 
 def list_plans_for_basket(basket):
-    plans = []
-    for application in basket.offer_applications.post_order_actions:
+    """
+    List the financing plans made available to the basket by the offers applied to it. The plans for every applied
+    offer are fetched in one query, and the result is memoized on the basket for as long as its offer applications
+    stay the same, so calling this repeatedly during a request (e.g. from the payment method serializer and again
+    while placing the order) doesn't query again.
+    """
+    applications = basket.offer_applications.post_order_actions
+    state = (basket.offer_applications, tuple(application['offer'].pk for application in applications))
+    cached = getattr(basket, BASKET_PLANS_ATTR, None)
+    if cached is not None and cached[0] == state:
+        return list(cached[1])
+
+    benefits = []
+    for application in applications:
         benefit = application['offer'].benefit.proxy()
         if isinstance(benefit, FinancingPlanBenefit):
-            plans += benefit.plans.all()
+            benefits.append(benefit)
+    prefetch_financing_plans(benefits)
+    plans = []
+    for benefit in benefits:
+        plans += benefit.plans.all()
     plans = { p.pk: p for p in plans }.values()
     plans = sorted(plans, key=lambda plan: '%s-%s' % (plan.apr, plan.term_months))
-    return plans
+    setattr(basket, BASKET_PLANS_ATTR, (state, plans))
+    return list(plans)
 
 
 def calculate_monthly_payments(principal, term_months, apr):
@@ -29,3 +58,128 @@ def calculate_monthly_payments(principal, term_months, apr):
     payment = principal * (interest * (1 + interest) ** term_months) / ((1 + interest) ** term_months - 1)
 
     return payment.quantize(principal, rounding=ROUND_UP)
+
+
+def calculate_loan_cost(principal, monthly_payment, term_months):
+    """Calculate the total interest paid over the life of a loan"""
+    loan_cost = (monthly_payment * term_months) - principal
+    loan_cost = max(Decimal('0.00'), loan_cost)
+    return loan_cost.quantize(principal, rounding=ROUND_UP)
+
+
+class PaymentFactors(object):
+    """
+    The parts of the amortized payment formula used by :func:`calculate_monthly_payments` which only depend on the
+    plan (term and APR), computed once so they can be reused for any number of principals.
+    """
+    def __init__(self, term_months, apr):
+        self.term_months = term_months
+        self.apr = apr
+        self.numerator = None
+        self.denominator = None
+        if term_months != 0 and apr != 0:
+            interest = (apr / 100 / 12)
+            growth = (1 + interest) ** term_months
+            self.numerator = interest * growth
+            self.denominator = growth - 1
+
+    def calculate_monthly_payments(self, principal):
+        """Same as ``calculate_monthly_payments(principal, self.term_months, self.apr)``, down to the last digit"""
+        if self.term_months == 0:
+            return principal
+        if self.apr == 0:
+            return principal / self.term_months
+        payment = principal * self.numerator / self.denominator
+        return payment.quantize(principal, rounding=ROUND_UP)
+
+
+def calculate_monthly_payments_matrix(principals, plans):
+    """
+    Calculate the monthly payment for every combination of principal and plan (anything with ``term_months`` and
+    ``apr`` attributes, like :class:`wellsfargo.models.FinancingPlan`). Returns a list with a row per principal and a
+    column per plan. Results are identical to calling :func:`calculate_monthly_payments` for each pair, but the
+    exponentiation is only done once per distinct plan, rather than once per pair.
+    """
+    factors = {}
+    columns = []
+    for plan in plans:
+        key = (plan.term_months, plan.apr)
+        if key not in factors:
+            factors[key] = PaymentFactors(plan.term_months, plan.apr)
+        columns.append(factors[key].calculate_monthly_payments)
+    return [[calculate(principal) for calculate in columns] for principal in principals]
+
+
+def get_payment_quotes(plans_and_principals):
+    """
+    Get the monthly payment and total loan cost (as a :class:`wellsfargo.core.quotes.PaymentQuote`) for each of the
+    given ``(plan, principal)`` pairs, in order. Quotes precomputed by the ``wfrs_precompute_payment_quotes``
+    management command are used where there is one for the exact plan and principal. The rest are calculated, working
+    out each distinct plan's amortization factors once, and rounded to the cent the same way as precomputed quotes.
+    """
+    plans_and_principals = list(plans_and_principals)
+    quotes = [quote_catalog.get_quote(plan, principal) for plan, principal in plans_and_principals]
+    factors = {}
+    for i, (plan, principal) in enumerate(plans_and_principals):
+        if quotes[i] is not None:
+            continue
+        key = (plan.term_months, plan.apr)
+        if key not in factors:
+            factors[key] = PaymentFactors(plan.term_months, plan.apr)
+        monthly_payment = factors[key].calculate_monthly_payments(principal)
+        loan_cost = calculate_loan_cost(principal, monthly_payment, plan.term_months)
+        quotes[i] = PaymentQuote(monthly_payment.quantize(CENTS), loan_cost)
+    return quotes
+
+
+def get_payment_quote(plan, principal):
+    """Get the monthly payment and total loan cost for the given plan and principal. See :func:`get_payment_quotes`."""
+    return get_payment_quotes([(plan, principal)])[0]
+
+
+def get_product_price(request, product):
+    """Get the price of the given product to use when picking a financing plan to advertise for it"""
+    if product.is_parent:
+        purchase_info = request.strategy.fetch_for_parent(product)
+    else:
+        purchase_info = request.strategy.fetch_for_product(product)
+    if purchase_info.price.is_tax_known:
+        return purchase_info.price.incl_tax
+    return purchase_info.price.excl_tax
+
+
+def get_plans_for_prices(prices):
+    """Get the financing plan to advertise for each of the given prices, in order"""
+    get_plan = plan_catalog.get_advertisable_plan_by_price
+    return [get_plan(price, include_zero_term=True) if price is not None else None for price in prices]
+
+
+def get_plan_for_product(request, product):
+    """Get the financing plan to advertise for the given product"""
+    plans = getattr(request, PRODUCT_PLANS_REQUEST_ATTR, None)
+    if plans is not None and product.pk in plans:
+        return plans[product.pk]
+    return get_plans_for_prices([get_product_price(request, product)])[0]
+
+
+def get_plans_for_products(request, products):
+    """
+    Get the financing plan to advertise for each of the given products, in order. Stock records for all of the
+    products are fetched up front, rather than once per product. The results are remembered on the request, so that
+    later calls to :func:`get_plan_for_product` for the same products (e.g. from a product card template) are free.
+    """
+    products = list(products)
+    plans = getattr(request, PRODUCT_PLANS_REQUEST_ATTR, None)
+    if plans is None:
+        plans = {}
+        setattr(request, PRODUCT_PLANS_REQUEST_ATTR, plans)
+
+    # Fetch product classes and stock records for every product (and every child of every parent product) in bulk
+    to_fetch = list({p.pk: p for p in products if p.pk not in plans}.values())
+    prefetch_related_objects([p for p in to_fetch if not p.is_parent], 'product_class', 'stockrecords')
+    prefetch_related_objects([p for p in to_fetch if p.is_parent], 'product_class', 'children__stockrecords')
+
+    prices = [get_product_price(request, product) for product in to_fetch]
+    for product, plan in zip(to_fetch, get_plans_for_prices(prices)):
+        plans[product.pk] = plan
+    return [plans[product.pk] for product in products]